@@ -6,9 +6,16 @@ admin.site.register([
     models.EdinitsaIzmereniya, models.Bank,
     models.Professiya, models.Specialnost, models.Klassifikaciya, models.StruktPodrazdelenie,
     models.Dolzhnost, models.GruppaTovarov,
-    models.Magazin, models.Tovar, models.MagazinTovar,
+    models.Magazin, models.Tovar,
     models.Postavshchik, models.Postavka,
     models.Vyruchka, models.TovarVyruchka,
     models.Otdel, models.Rabotnik, models.RabotnikVyruchka,
     models.MestoRaboty, models.ZapisiTrudKnizhke,
 ])
+
+
+@admin.register(models.MagazinTovar)
+class MagazinTovarAdmin(admin.ModelAdmin):
+    def get_readonly_fields(self, request, obj=None):
+        # остаток существующей позиции меняют только складские документы (MagazinTovar.save)
+        return ("kolichestvo",) if obj else ()
@@ -0,0 +1,124 @@
+"""
+Групповая запись чеков (group commit).
+
+Каждый чек, пришедший в пиковые часы отдельным запросом, — это своя транзакция,
+свои блокировки magazin_tovar и свой fsync на COMMIT. SalesGroupWriter собирает
+чеки, пришедшие в течение короткого окна (или до max_batch штук), и проводит
+их одной транзакцией через services.post_vyruchka_batch.
+
+Отдельного фонового потока нет: первый поток, заставший пустую очередь,
+становится «лидером» — забирает пачку и проводит её в своём соединении с БД;
+остальные ждут результата своего чека. Окно ожидания выдерживается, только
+если в очереди уже есть чеки других запросов (есть нагрузка) — одиночный чек
+проводится сразу, без задержки.
+
+Пачки собираются в пределах одного процесса: чеки, пришедшие в разные
+процессы gunicorn/uwsgi, в одну транзакцию не попадут. Выигрыш растёт с числом
+потоков на процесс (--threads), а не с числом процессов.
+
+Если пачка упала не из-за остатков (ошибка БД, неверные данные одного чека),
+её чеки проводятся по одному — ошибку получает только чек, который её вызвал.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from .services import StockError, post_vyruchka_batch
+
+
+class _Slot:
+    __slots__ = ("vyr", "items", "done", "error")
+
+    def __init__(self, vyr, items):
+        self.vyr = vyr
+        self.items = items
+        self.done = False
+        self.error = None
+
+
+class SalesGroupWriter:
+    def __init__(self, window_ms: float = 10, max_batch: int = 50):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._pending = []
+        self._leader = False
+
+    def submit(self, vyr, items):
+        """
+        Ставит чек в очередь и ждёт, пока его пачка будет проведена.
+        Возвращает None (чек сохранён) или StockError (чек отклонён из-за остатков).
+        Прочие ошибки проведения пробрасываются — только тому чеку, на котором они возникли.
+        """
+        if connection.in_atomic_block:
+            # внутри чужой транзакции общий COMMIT невозможен — проводим сразу
+            return post_vyruchka_batch([(vyr, items)])[0]
+
+        slot = _Slot(vyr, items)
+        with self._cond:
+            self._pending.append(slot)
+            self._cond.notify_all()
+
+        while True:
+            with self._cond:
+                while not slot.done and self._leader:
+                    self._cond.wait()
+                if slot.done:
+                    break
+                self._leader = True
+                batch = self._collect()
+
+            try:
+                results = post_vyruchka_batch([(s.vyr, s.items) for s in batch])
+            except Exception as e:
+                # пачка откатилась целиком — чтобы чужая ошибка не отклонила остальные
+                # чеки, проводим их по одному
+                results = [e] if len(batch) == 1 else [self._post_one(s) for s in batch]
+
+            with self._cond:
+                for s, res in zip(batch, results):
+                    s.error = res
+                    s.done = True
+                self._leader = False
+                self._cond.notify_all()
+
+        if slot.error is not None and not isinstance(slot.error, StockError):
+            raise slot.error
+        return slot.error
+
+    @staticmethod
+    def _post_one(slot):
+        try:
+            return post_vyruchka_batch([(slot.vyr, slot.items)])[0]
+        except Exception as e:
+            return e
+
+    def _collect(self):
+        # вызывается лидером под self._cond; в очереди только свой чек — ждать некого
+        deadline = time.monotonic() + self.window
+        while 1 < len(self._pending) < self.max_batch:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            self._cond.wait(left)
+        batch = self._pending[:self.max_batch]
+        del self._pending[:self.max_batch]
+        return batch
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_sales_writer() -> SalesGroupWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            conf = getattr(settings, "VYRUCHKA_GROUP_COMMIT", {})
+            _writer = SalesGroupWriter(
+                window_ms=conf.get("WINDOW_MS", 10),
+                max_batch=conf.get("MAX_BATCH", 50),
+            )
+        return _writer
@@ -0,0 +1,55 @@
+"""
+Замеры блокировок складских строк.
+
+transaction_stats(service) оборачивает внешнюю транзакцию сервиса (его ставит
+core/retry.py) и пишет в core.metrics:
+  tx_seconds        — длительность транзакции вместе с COMMIT;
+  lock_hold_seconds — от первой взятой блокировки до конца транзакции
+                      (строковые блокировки держатся до COMMIT/ROLLBACK).
+locking(table) оборачивает сам запрос, который берёт блокировки:
+  lock_wait_seconds — время запроса (в основном — ожидание чужих блокировок);
+  locked_rows       — счётчик заблокированных строк по сервису;
+  hot:<table>       — частота обращений к строкам (magazin_id, tovar_id).
+Метка у всех — имя сервиса; вне transaction_stats — "other".
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from . import metrics
+
+_current = ContextVar("lock_stats_tx", default=None)
+
+
+@contextmanager
+def transaction_stats(service: str):
+    state = {"service": service, "locked_at": None}
+    token = _current.set(state)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        finished = time.monotonic()
+        metrics.observe("tx_seconds", service, finished - started)
+        if state["locked_at"] is not None:
+            metrics.observe("lock_hold_seconds", service, finished - state["locked_at"])
+
+
+@contextmanager
+def locking(table: str):
+    """
+    Замер одного блокирующего запроса. Вызывающий дописывает в отдаваемый
+    список ключи заблокированных строк: (magazin_id | None, tovar_id).
+    """
+    state = _current.get()
+    service = state["service"] if state else "other"
+    rows = []
+    started = time.monotonic()
+    yield rows
+    acquired = time.monotonic()
+    if state is not None and state["locked_at"] is None:
+        state["locked_at"] = acquired
+    metrics.observe("lock_wait_seconds", service, acquired - started)
+    metrics.incr("locked_rows", service, len(rows))
+    metrics.hot(f"hot:{table}", rows)
@@ -0,0 +1,25 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from core.services import issue_api_token, revoke_api_token
+
+
+class Command(BaseCommand):
+    help = "Ключ API для внешних систем (кассы): выдать новый или отозвать"
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", help="пользователь, от имени которого работает система")
+        parser.add_argument("--revoke", action="store_true", help="отозвать ключ")
+
+    def handle(self, *args, **opts):
+        try:
+            user = get_user_model().objects.get(username=opts["username"])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f"Пользователь {opts['username']} не найден")
+
+        if opts["revoke"]:
+            revoke_api_token(user)
+            self.stdout.write(self.style.SUCCESS(f"OK: ключ пользователя {user.username} отозван"))
+            return
+        # ключ показывается один раз — в БД только его хэш
+        self.stdout.write(issue_api_token(user))
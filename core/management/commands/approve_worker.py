@@ -0,0 +1,47 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from core.models import ZayavkaApproveJob
+from core.services import run_approval_job
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Воркер фонового проведения заявок (можно запускать несколько процессов)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sleep", type=float, default=1.0, help="пауза при пустой очереди, сек")
+        parser.add_argument("--once", action="store_true", help="обработать очередь и выйти")
+
+    def handle(self, *args, **opts):
+        try:
+            while True:
+                try:
+                    job = run_approval_job()
+                except Exception as e:
+                    # ошибка самой очереди (БД недоступна, исчерпаны повторы и т. п.):
+                    # задание осталось PENDING, воркер переподключается и продолжает
+                    logger.exception("approve_worker: ошибка обработки очереди")
+                    self.stderr.write(self.style.ERROR(f"ERR: {type(e).__name__}: {e}"))
+                    if opts["once"]:
+                        raise
+                    connection.close()
+                    time.sleep(opts["sleep"])
+                    continue
+                if job is None:
+                    if opts["once"]:
+                        return
+                    close_old_connections()
+                    time.sleep(opts["sleep"])
+                    continue
+
+                if job.status == ZayavkaApproveJob.Status.DONE:
+                    self.stdout.write(self.style.SUCCESS(f"OK: заявка #{job.id_zayavka_id}"))
+                else:
+                    self.stdout.write(self.style.ERROR(f"ERR: заявка #{job.id_zayavka_id}: {job.error}"))
+        except KeyboardInterrupt:
+            pass
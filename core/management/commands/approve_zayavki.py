@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Zayavka
+from core.services import approve_zayavki
+
+
+class Command(BaseCommand):
+    help = "Массовое проведение заявок (по списку id или все отправленные)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("ids", nargs="*", type=int, help="id заявок")
+        parser.add_argument("--all-sent", action="store_true", help="провести все заявки в статусе 'Отправлена'")
+        parser.add_argument("--chunk-size", type=int, default=None,
+                            help="сколько заявок проводить в одной транзакции (по умолчанию — все)")
+
+    def handle(self, *args, **opts):
+        ids = list(opts["ids"])
+        if opts["all_sent"]:
+            ids += list(Zayavka.objects.filter(status=Zayavka.Status.SENT).values_list("pk", flat=True))
+        if not ids:
+            raise CommandError("Не указаны заявки: передайте id или --all-sent")
+
+        result = approve_zayavki(ids, chunk_size=opts["chunk_size"])
+
+        ok = 0
+        for pk, error in result.items():
+            if error is None:
+                ok += 1
+                self.stdout.write(self.style.SUCCESS(f"OK: заявка #{pk}"))
+            else:
+                self.stdout.write(self.style.ERROR(f"ERR: заявка #{pk}: {error}"))
+        for pk in sorted(set(ids) - set(result)):
+            self.stdout.write(self.style.WARNING(f"SKIP: заявка #{pk} не найдена"))
+        self.stdout.write(f"Проведено {ok} из {len(result)}")
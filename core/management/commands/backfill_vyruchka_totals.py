@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.services import backfill_vyruchka_totals
+
+
+class Command(BaseCommand):
+    help = "Пересчитать итоги чеков (vyruchka.qty / amount / items_cnt) по строкам"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=10000,
+                            help="чеков в одной транзакции (по умолчанию 10000)")
+
+    def handle(self, *args, **opts):
+        fixed = backfill_vyruchka_totals(batch=opts["batch"])
+        self.stdout.write(self.style.SUCCESS(f"OK: исправлено чеков: {fixed}"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core.services import compact_stock_movements
+
+
+class Command(BaseCommand):
+    help = "Свернуть журнал движения товара в остатки (stock_balance)"
+
+    def handle(self, *args, **opts):
+        upto = compact_stock_movements()
+        self.stdout.write(self.style.SUCCESS(f"OK: свёрнуты движения транзакций до xid {upto}"))
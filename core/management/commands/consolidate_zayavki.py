@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import Tovar
+from core.services import consolidate_zayavki
+
+
+class Command(BaseCommand):
+    help = "Проведение всех отправленных заявок одним проходом с распределением дефицита"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rule", choices=["demand", "velocity"], default="demand",
+                            help="как делить дефицит: по запрошенному количеству или по продажам магазинов")
+        parser.add_argument("--days", type=int, default=28, help="окно продаж для --rule velocity, дней")
+        parser.add_argument("--dry-run", action="store_true", help="показать распределение и откатить")
+
+    def handle(self, *args, **opts):
+        with transaction.atomic():
+            result = consolidate_zayavki(rule=opts["rule"], days=opts["days"])
+            if opts["dry_run"]:
+                transaction.set_rollback(True)
+
+        names = dict(Tovar.objects.filter(pk__in={tid for _, tid, _, _ in result["cut"]})
+                                  .values_list("pk", "nazvanie"))
+        for zid, tid, want, got in result["cut"]:
+            self.stdout.write(self.style.WARNING(f"CUT: заявка #{zid}: '{names.get(tid)}' {want} -> {got}"))
+        for pk in result["postponed"]:
+            self.stdout.write(self.style.WARNING(f"WAIT: заявка #{pk}: товара не досталось, остаётся отправленной"))
+        for pk, error in result["errors"].items():
+            self.stdout.write(self.style.ERROR(f"ERR: заявка #{pk}: {error}"))
+
+        prefix = "[dry-run] " if opts["dry_run"] else ""
+        self.stdout.write(
+            f"{prefix}Проведено заявок: {len(result['approved'])}, урезано позиций: {len(result['cut'])}, "
+            f"отложено: {len(result['postponed'])}, ошибок: {len(result['errors'])}"
+        )
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.services import VyruchkaImportError, import_vyruchka
+
+
+class Command(BaseCommand):
+    help = (
+        "Массовая загрузка чеков из выгрузки касс (CSV или JSON lines): "
+        "COPY во временную таблицу, проверка и проводка одной транзакцией"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="файл выгрузки (.csv / .jsonl)")
+        parser.add_argument("--format", choices=["csv", "jsonl"],
+                            help="формат файла (по умолчанию — по расширению)")
+        parser.add_argument("--magazin", type=int,
+                            help="разрешить строки только этого магазина")
+
+    def handle(self, *args, **opts):
+        path = opts["path"]
+        fmt = opts["format"] or ("jsonl" if path.endswith((".jsonl", ".ndjson", ".json")) else "csv")
+        t0 = time.monotonic()
+        try:
+            with open(path, "rb") as f:
+                res = import_vyruchka(f, fmt=fmt, magazin_id=opts["magazin"])
+        except OSError as e:
+            raise CommandError(str(e))
+        except VyruchkaImportError as e:
+            for line in e.errors:
+                self.stderr.write(line)
+            raise CommandError(str(e))
+
+        for mid, msg in res["rejected"].items():
+            self.stderr.write(f"Магазин #{mid} отклонён: {msg}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Чеков: {res['receipts']}, позиций: {res['lines']}, магазинов: {res['magazins']}, "
+            f"пропущено загруженных ранее: {res['duplicates']}, "
+            f"отклонено магазинов: {len(res['rejected'])} ({time.monotonic() - t0:.2f} с)"
+        ))
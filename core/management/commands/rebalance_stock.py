@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.models import Magazin, Tovar
+from core.planning import create_transfer_drafts, load_stock_matrix, plan_rebalance
+
+
+class Command(BaseCommand):
+    help = "Предложить перемещения товара между магазинами (избытки -> дефициты), затем с центрального склада"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=28,
+                            help="за сколько последних дней считать скорость продаж (по умолчанию 28)")
+        parser.add_argument("--cover", type=float, default=14,
+                            help="дефицит: запас меньше чем на N дней продаж (по умолчанию 14)")
+        parser.add_argument("--max-cover", type=float, default=60,
+                            help="избыток: запас больше чем на N дней продаж (по умолчанию 60)")
+        parser.add_argument("--create", action="store_true",
+                            help="сохранить предложенные перемещения черновиками")
+
+    def handle(self, *args, **opts):
+        t0 = time.monotonic()
+        matrix = load_stock_matrix(days=opts["days"])
+        t1 = time.monotonic()
+        plan = plan_rebalance(matrix, cover_days=opts["cover"], max_cover_days=opts["max_cover"])
+        t2 = time.monotonic()
+
+        transfers = plan.transfer_docs()
+        central = plan.central_docs()
+        mag = dict(Magazin.objects.values_list("pk", "nazvanie"))
+        tov = dict(Tovar.objects.filter(
+            pk__in=set(plan.tovar.tolist()) | set(plan.central_tovar.tolist())
+        ).values_list("pk", "nazvanie"))
+
+        for (src, dst), items in transfers:
+            self.stdout.write(self.style.SUCCESS(f"Перемещение: {mag[src]} (#{src}) -> {mag[dst]} (#{dst})"))
+            for tid, qty in items:
+                self.stdout.write(f"    {tov[tid]} (#{tid}): {qty}")
+        for mid, items in central:
+            self.stdout.write(self.style.WARNING(f"С центрального склада: {mag[mid]} (#{mid})"))
+            for tid, qty in items:
+                self.stdout.write(f"    {tov[tid]} (#{tid}): {qty}")
+
+        self.stdout.write(
+            f"Магазинов: {len(matrix.magazin_ids)}, товаров: {len(matrix.tovar_ids)}; "
+            f"перемещений: {len(transfers)}, заявок с центрального склада: {len(central)} "
+            f"(загрузка {t1 - t0:.2f} с, расчёт {t2 - t1:.2f} с)"
+        )
+
+        if opts["create"] and transfers:
+            docs = create_transfer_drafts(plan)
+            self.stdout.write(self.style.SUCCESS(
+                f"Создано черновиков перемещений: {len(docs)} (#{docs[0].pk}..#{docs[-1].pk})"
+            ))
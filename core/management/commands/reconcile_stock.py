@@ -0,0 +1,65 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core.models import Magazin
+from core.services import central_stock_diff, fix_stock_diff, magazin_stock_diff
+
+
+def _init_worker():
+    # при start method "spawn" дочерний процесс стартует без настроенного Django
+    django.setup()
+
+
+def _run(task):
+    kind, ids = task
+    try:
+        return magazin_stock_diff(ids) if kind == "magazin" else central_stock_diff()
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Сверка остатков магазинов и центрального склада с документами (заявки, продажи, поставки)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("magaziny", nargs="*", type=int, help="id магазинов (по умолчанию — все)")
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="число процессов (1 — без пула, в текущем процессе)")
+        parser.add_argument("--chunk", type=int, default=16,
+                            help="сколько магазинов сверять одним запросом")
+        parser.add_argument("--no-central", action="store_true", help="не сверять центральный склад")
+        parser.add_argument("--fix", action="store_true", help="привести остатки к ожидаемым")
+
+    def handle(self, *args, **opts):
+        ids = opts["magaziny"] or list(Magazin.objects.order_by("pk").values_list("pk", flat=True))
+        chunk = max(1, opts["chunk"])
+        tasks = [("magazin", ids[i:i + chunk]) for i in range(0, len(ids), chunk)]
+        if not opts["no_central"]:
+            tasks.insert(0, ("central", None))
+
+        if opts["workers"] > 1 and len(tasks) > 1:
+            # открытое соединение нельзя делить между процессами
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=opts["workers"], initializer=_init_worker) as pool:
+                parts = list(pool.map(_run, tasks))
+        else:
+            parts = [magazin_stock_diff(t[1]) if t[0] == "magazin" else central_stock_diff() for t in tasks]
+
+        rows = [row for part in parts for row in part]
+        for magazin_id, tovar_id, actual, expected in rows:
+            where = "центр. склад" if magazin_id is None else f"магазин #{magazin_id}"
+            self.stdout.write(self.style.WARNING(
+                f"DIFF: {where}, товар #{tovar_id}: факт {actual}, ожидается {expected} ({expected - actual:+d})"
+            ))
+
+        if rows and opts["fix"]:
+            fix_stock_diff(rows)
+            self.stdout.write(self.style.SUCCESS(f"Исправлено расхождений: {len(rows)}"))
+        elif rows:
+            self.stdout.write(f"Расхождений: {len(rows)} (для исправления запустите с --fix)")
+        else:
+            self.stdout.write(self.style.SUCCESS("OK: расхождений нет"))
@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.models import Magazin
+from core.planning import create_replenishment_drafts, load_open_zayavki, load_stock_matrix, plan_replenishment
+
+
+class Command(BaseCommand):
+    help = (
+        "Автопополнение: черновики заявок на центральный склад по скорости продаж "
+        "(для ночного запуска по всей сети)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=28,
+                            help="за сколько последних дней считать скорость продаж (по умолчанию 28)")
+        parser.add_argument("--cover", type=float, default=14,
+                            help="целевой запас, дней продаж (по умолчанию 14)")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="только показать, сколько заявок и позиций будет создано")
+
+    def handle(self, *args, **opts):
+        t0 = time.monotonic()
+        matrix = load_stock_matrix(days=opts["days"])
+        pending = load_open_zayavki(matrix)
+        t1 = time.monotonic()
+        plan = plan_replenishment(matrix, cover_days=opts["cover"], pending=pending)
+        t2 = time.monotonic()
+
+        docs = plan.zayavka_docs()
+        if opts["verbosity"] > 1:
+            mag = dict(Magazin.objects.values_list("pk", "nazvanie"))
+            for mid, items in docs:
+                self.stdout.write(f"{mag[mid]} (#{mid}): позиций {len(items)}, штук {sum(q for _, q in items)}")
+
+        created = []
+        if not opts["dry_run"] and docs:
+            created = create_replenishment_drafts(plan, cover_days=opts["cover"])
+        t3 = time.monotonic()
+
+        prefix = "[dry-run] " if opts["dry_run"] else ""
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix}Магазинов: {len(matrix.magazin_ids)}, товаров: {len(matrix.tovar_ids)}; "
+            f"заявок: {len(docs)}, позиций: {len(plan.qty)}, штук: {int(plan.qty.sum())} "
+            f"(загрузка {t1 - t0:.2f} с, расчёт {t2 - t1:.2f} с, запись {t3 - t2:.2f} с)"
+        ))
+        if created:
+            self.stdout.write(f"Созданы черновики заявок #{created[0].pk}..#{created[-1].pk}")
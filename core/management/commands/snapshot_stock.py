@@ -0,0 +1,30 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.services import take_stock_snapshot
+
+
+class Command(BaseCommand):
+    help = "Записать дневной срез остатков магазинов и центрального склада (запускать раз в сутки)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--date", default=None,
+                            help="дата среза ГГГГ-ММ-ДД (по умолчанию — вчера)")
+
+    def handle(self, *args, **opts):
+        d = None
+        if opts["date"]:
+            try:
+                d = date.fromisoformat(opts["date"])
+            except ValueError:
+                raise CommandError("Дата должна быть в формате ГГГГ-ММ-ДД")
+
+        snap = take_stock_snapshot(d)
+        if snap is None:
+            self.stdout.write(self.style.WARNING("SKIP: срез на эту или более позднюю дату уже есть"))
+            return
+        n = snap.stocksnapshotitem_set.count()
+        self.stdout.write(self.style.SUCCESS(
+            f"OK: срез на {snap.data} (транзакции до xid {snap.upto_xid}, изменённых строк: {n})"
+        ))
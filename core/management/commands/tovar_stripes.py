@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.services import fold_tovar_stripes, set_tovar_stripes
+
+
+class Command(BaseCommand):
+    help = "Под-счётчики остатка центрального склада: включить / выключить / свернуть"
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["enable", "disable", "fold"])
+        parser.add_argument("ids", nargs="*", type=int, help="id товаров")
+        parser.add_argument("--stripes", type=int, default=8, help="число под-счётчиков на товар (для enable)")
+
+    def handle(self, *args, **opts):
+        action, ids = opts["action"], opts["ids"]
+
+        if action == "fold":
+            n = fold_tovar_stripes(ids or None)
+            self.stdout.write(self.style.SUCCESS(f"OK: свёрнуто товаров: {n}"))
+            return
+
+        if not ids:
+            raise CommandError("Укажите id товаров")
+        if action == "enable":
+            if opts["stripes"] < 1:
+                raise CommandError("--stripes должно быть >= 1")
+            set_tovar_stripes(ids, opts["stripes"])
+            self.stdout.write(self.style.SUCCESS(f"OK: {len(ids)} товаров, по {opts['stripes']} под-счётчиков"))
+        else:
+            set_tovar_stripes(ids, 0)
+            self.stdout.write(self.style.SUCCESS(f"OK: под-счётчики выключены для {len(ids)} товаров"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from core.services import detach_vyruchka_partitions, ensure_vyruchka_partitions
+
+
+class Command(BaseCommand):
+    help = "Создать помесячные секции выручки заранее и отсоединить старые"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ahead", type=int, default=3,
+                            help="на сколько месяцев вперёд создавать секции (по умолчанию 3)")
+        parser.add_argument("--detach-older-than", type=int, default=None, metavar="MONTHS",
+                            help="отсоединить секции старше N полных месяцев (по умолчанию не трогать)")
+
+    def handle(self, *args, **opts):
+        created = ensure_vyruchka_partitions(ahead=opts["ahead"])
+        for name in created:
+            self.stdout.write(f"создана секция {name}")
+
+        detached = []
+        if opts["detach_older_than"] is not None:
+            detached = detach_vyruchka_partitions(keep_months=opts["detach_older_than"])
+            for name in detached:
+                self.stdout.write(f"отсоединена секция {name}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"OK: создано секций: {len(created)}, отсоединено: {len(detached)}"
+        ))
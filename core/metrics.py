@@ -0,0 +1,92 @@
+"""
+Простые счётчики процесса (без внешних зависимостей).
+
+Счётчик — имя + метка, например ("tx_retry", "approve_zayavka").
+Гистограмма — то же, но копит распределение значений (секунды) по корзинам.
+«Горячие» ключи — частоты ключей (например, строк magazin_tovar), из которых
+держатся только самые частые.
+Значения живут в памяти процесса и сбрасываются при перезапуске;
+при нескольких воркерах у каждого свои счётчики.
+"""
+import bisect
+import threading
+from collections import Counter, defaultdict
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+HOT_KEEP = 1000         # сколько ключей оставлять при подрезке
+HOT_LIMIT = 5 * HOT_KEEP
+
+_lock = threading.Lock()
+_counters: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+_histograms: dict[str, dict[str, dict]] = defaultdict(dict)
+_hot: dict[str, Counter] = defaultdict(Counter)
+
+
+def incr(name: str, label: str = "", n: int = 1):
+    with _lock:
+        _counters[name][label] += n
+
+
+def observe(name: str, label: str, value: float):
+    """Добавляет значение в гистограмму name/label (корзины BUCKETS, последняя — всё, что больше)."""
+    i = bisect.bisect_left(BUCKETS, value)
+    with _lock:
+        h = _histograms[name].get(label)
+        if h is None:
+            h = _histograms[name][label] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * (len(BUCKETS) + 1)}
+        h["count"] += 1
+        h["sum"] += value
+        h["max"] = max(h["max"], value)
+        h["buckets"][i] += 1
+
+
+def hot(name: str, keys):
+    """Учитывает обращения к ключам; при переполнении оставляет HOT_KEEP самых частых."""
+    with _lock:
+        c = _hot[name]
+        c.update(keys)
+        if len(c) > HOT_LIMIT:
+            _hot[name] = Counter(dict(c.most_common(HOT_KEEP)))
+
+
+def snapshot() -> dict[str, dict[str, int]]:
+    """Копия всех счётчиков: {имя: {метка: значение}}."""
+    with _lock:
+        return {name: dict(by_label) for name, by_label in _counters.items()}
+
+
+def _quantile(h: dict, q: float) -> float:
+    # верхняя граница корзины, в которую попадает q-я доля наблюдений
+    rank = q * h["count"]
+    seen = 0
+    for bound, n in zip(BUCKETS, h["buckets"]):
+        seen += n
+        if seen >= rank:
+            return min(bound, h["max"])
+    return h["max"]
+
+
+def histograms() -> dict[str, dict[str, dict]]:
+    """{имя: {метка: {count, sum, avg, p50, p95, max, buckets}}}."""
+    with _lock:
+        data = {name: {label: dict(h, buckets=list(h["buckets"])) for label, h in by_label.items()}
+                for name, by_label in _histograms.items()}
+    for by_label in data.values():
+        for h in by_label.values():
+            h["avg"] = h["sum"] / h["count"]
+            h["p50"] = _quantile(h, 0.5)
+            h["p95"] = _quantile(h, 0.95)
+    return data
+
+
+def hot_top(name: str, n: int = 20) -> list[tuple]:
+    """[(ключ, число обращений)] — n самых частых ключей."""
+    with _lock:
+        return _hot[name].most_common(n) if name in _hot else []
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+        _hot.clear()
@@ -0,0 +1,58 @@
+# Generated by Django 6.0 on 2026-10-18 03:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_remove_gorod_id_strana_remove_ulitsa_id_gorod'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kolichestvo', models.IntegerField(default=0)),
+                ('upto_movement_id', models.BigIntegerField(default=0)),
+                ('id_magazin', models.ForeignKey(blank=True, db_column='id_magazin', null=True, on_delete=django.db.models.deletion.PROTECT, to='core.magazin')),
+                ('id_tovar', models.ForeignKey(db_column='id_tovar', on_delete=django.db.models.deletion.PROTECT, to='core.tovar')),
+            ],
+            options={
+                'db_table': 'stock_balance',
+                'constraints': [models.UniqueConstraint(fields=('id_magazin', 'id_tovar'), name='uniq_stock_balance'), models.UniqueConstraint(condition=models.Q(('id_magazin__isnull', True)), fields=('id_tovar',), name='uniq_stock_balance_central')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doc_type', models.CharField(choices=[('OPENING', 'Начальный остаток'), ('POSTAVKA', 'Поставка'), ('ZAYAVKA', 'Заявка'), ('VYRUCHKA', 'Выручка')], max_length=20)),
+                ('doc_id', models.BigIntegerField(blank=True, null=True)),
+                ('kolichestvo', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('id_magazin', models.ForeignKey(blank=True, db_column='id_magazin', null=True, on_delete=django.db.models.deletion.PROTECT, to='core.magazin')),
+                ('id_tovar', models.ForeignKey(db_column='id_tovar', on_delete=django.db.models.deletion.PROTECT, to='core.tovar')),
+            ],
+            options={
+                'db_table': 'stock_movement',
+                'indexes': [models.Index(fields=['id_tovar', 'id_magazin', 'id'], name='stock_movement_key_idx'), models.Index(fields=['doc_type', 'doc_id'], name='stock_movement_doc_idx')],
+            },
+        ),
+        # начальные остатки: журнал стартует с текущих значений счётчиков
+        migrations.RunSQL(
+            sql="""
+                INSERT INTO stock_movement (doc_type, doc_id, id_magazin, id_tovar, kolichestvo, created_at)
+                SELECT 'OPENING', NULL, NULL, id, kolichestvo_na_sklade, now()
+                  FROM tovar
+                 WHERE COALESCE(kolichestvo_na_sklade, 0) <> 0;
+                INSERT INTO stock_movement (doc_type, doc_id, id_magazin, id_tovar, kolichestvo, created_at)
+                SELECT 'OPENING', NULL, id_magazin, id_tovar, kolichestvo, now()
+                  FROM magazin_tovar
+                 WHERE COALESCE(kolichestvo, 0) <> 0;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
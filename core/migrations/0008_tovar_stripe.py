@@ -0,0 +1,27 @@
+# Generated by Django 6.0 on 2026-10-18 03:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_stock_movement'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TovarStripe',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stripe', models.PositiveSmallIntegerField()),
+                ('delta', models.IntegerField(default=0)),
+                ('id_tovar', models.ForeignKey(db_column='id_tovar', on_delete=django.db.models.deletion.CASCADE, to='core.tovar')),
+            ],
+            options={
+                'db_table': 'tovar_stripe',
+                'constraints': [models.UniqueConstraint(fields=('id_tovar', 'stripe'), name='uniq_tovar_stripe')],
+            },
+        ),
+    ]
@@ -0,0 +1,112 @@
+# Учёт поставок на центральном складе переносится из Python-сигналов
+# (core/signals.py) в statement-level триггеры с transition tables:
+# одна агрегированная дельта на товар за весь DML-оператор, в том числе
+# для bulk_create / QuerySet.update() / QuerySet.delete() / COPY.
+
+from django.db import migrations
+
+
+CREATE_SQL = """
+CREATE FUNCTION postavka_stock_apply(ch_id bigint[], ch_tovar bigint[], ch_qty integer[])
+RETURNS void LANGUAGE plpgsql AS $$
+BEGIN
+    -- журнал: чистое изменение по каждой поставке и товару
+    INSERT INTO stock_movement (doc_type, doc_id, id_magazin, id_tovar, kolichestvo, created_at)
+    SELECT 'POSTAVKA', c.id, NULL, c.id_tovar, SUM(c.qty), clock_timestamp()
+      FROM unnest(ch_id, ch_tovar, ch_qty) AS c(id, id_tovar, qty)
+     GROUP BY c.id, c.id_tovar
+    HAVING SUM(c.qty) <> 0;
+
+    -- остатки: одна дельта на товар; под-счётчики — как в services._apply_central_delta
+    WITH v AS (
+        SELECT c.id_tovar, SUM(c.qty) AS delta
+          FROM unnest(ch_tovar, ch_qty) AS c(id_tovar, qty)
+         GROUP BY c.id_tovar
+        HAVING SUM(c.qty) <> 0
+    ),
+    pick AS (
+        SELECT v.id_tovar, v.delta, floor(random() * s.n)::int AS stripe
+          FROM v
+          JOIN (SELECT id_tovar, COUNT(*) AS n
+                  FROM tovar_stripe
+                 WHERE id_tovar IN (SELECT id_tovar FROM v)
+                 GROUP BY id_tovar) AS s ON s.id_tovar = v.id_tovar
+    ),
+    striped AS (
+        UPDATE tovar_stripe AS ts
+           SET delta = ts.delta + pick.delta
+          FROM pick
+         WHERE ts.id_tovar = pick.id_tovar AND ts.stripe = pick.stripe
+        RETURNING ts.id_tovar
+    )
+    UPDATE tovar AS t
+       SET kolichestvo_na_sklade = COALESCE(t.kolichestvo_na_sklade, 0) + v.delta
+      FROM v
+     WHERE t.id = v.id_tovar
+       AND t.id NOT IN (SELECT id_tovar FROM striped);
+END;
+$$;
+
+-- количество поставки (numeric) округляется до целого: round() — половина от нуля,
+-- как ROUND_HALF_UP в прежнем Python-коде
+CREATE FUNCTION postavka_stock_ins() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM postavka_stock_apply(array_agg(n.id), array_agg(n.id_tovar),
+                                 array_agg(round(COALESCE(n.kolichestvo, 0))::int))
+       FROM new_rows AS n;
+    RETURN NULL;
+END;
+$$;
+
+CREATE FUNCTION postavka_stock_upd() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM postavka_stock_apply(array_agg(c.id), array_agg(c.id_tovar), array_agg(c.qty))
+       FROM (SELECT n.id, n.id_tovar, round(COALESCE(n.kolichestvo, 0))::int AS qty FROM new_rows AS n
+             UNION ALL
+             SELECT o.id, o.id_tovar, -round(COALESCE(o.kolichestvo, 0))::int FROM old_rows AS o) AS c;
+    RETURN NULL;
+END;
+$$;
+
+CREATE FUNCTION postavka_stock_del() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM postavka_stock_apply(array_agg(o.id), array_agg(o.id_tovar),
+                                 array_agg(-round(COALESCE(o.kolichestvo, 0))::int))
+       FROM old_rows AS o;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER postavka_stock_ins AFTER INSERT ON postavka
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION postavka_stock_ins();
+
+CREATE TRIGGER postavka_stock_upd AFTER UPDATE ON postavka
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION postavka_stock_upd();
+
+CREATE TRIGGER postavka_stock_del AFTER DELETE ON postavka
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION postavka_stock_del();
+"""
+
+DROP_SQL = """
+DROP TRIGGER IF EXISTS postavka_stock_ins ON postavka;
+DROP TRIGGER IF EXISTS postavka_stock_upd ON postavka;
+DROP TRIGGER IF EXISTS postavka_stock_del ON postavka;
+DROP FUNCTION IF EXISTS postavka_stock_ins();
+DROP FUNCTION IF EXISTS postavka_stock_upd();
+DROP FUNCTION IF EXISTS postavka_stock_del();
+DROP FUNCTION IF EXISTS postavka_stock_apply(bigint[], bigint[], integer[]);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_tovar_stripe'),
+    ]
+
+    operations = [
+        migrations.RunSQL(sql=CREATE_SQL, reverse_sql=DROP_SQL),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 6.0 on 2026-10-18 03:13
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_postavka_stock_triggers'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ZayavkaApproveJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('PENDING', 'В очереди'), ('DONE', 'Выполнено'), ('FAILED', 'Ошибка')], default='PENDING', max_length=20)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='zayavka_approve_jobs', to=settings.AUTH_USER_MODEL)),
+                ('id_zayavka', models.ForeignKey(db_column='id_zayavka', on_delete=django.db.models.deletion.CASCADE, to='core.zayavka')),
+            ],
+            options={
+                'db_table': 'zayavka_approve_job',
+                'indexes': [models.Index(condition=models.Q(('status', 'PENDING')), fields=['id'], name='zayavka_job_pending_idx')],
+            },
+        ),
+    ]
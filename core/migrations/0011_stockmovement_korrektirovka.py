@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_zayavkaapprovejob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stockmovement',
+            name='doc_type',
+            field=models.CharField(choices=[('OPENING', 'Начальный остаток'), ('POSTAVKA', 'Поставка'), ('ZAYAVKA', 'Заявка'), ('VYRUCHKA', 'Выручка'), ('KORREKTIROVKA', 'Корректировка')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 6.0 on 2026-10-18 12:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_stockmovement_korrektirovka'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.DateField(unique=True)),
+                ('upto_movement_id', models.BigIntegerField(default=0)),
+                ('taken_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'stock_snapshot',
+            },
+        ),
+        migrations.CreateModel(
+            name='StockSnapshotItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kolichestvo', models.IntegerField(default=0)),
+                ('id_magazin', models.ForeignKey(blank=True, db_column='id_magazin', null=True, on_delete=django.db.models.deletion.PROTECT, to='core.magazin')),
+                ('id_snapshot', models.ForeignKey(db_column='id_snapshot', on_delete=django.db.models.deletion.CASCADE, to='core.stocksnapshot')),
+                ('id_tovar', models.ForeignKey(db_column='id_tovar', on_delete=django.db.models.deletion.PROTECT, to='core.tovar')),
+            ],
+            options={
+                'db_table': 'stock_snapshot_item',
+                'indexes': [models.Index(fields=['id_magazin', 'id_tovar', 'id_snapshot'], name='stock_snapshot_key_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 6.0 on 2026-10-18 13:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_stock_snapshot'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stockmovement',
+            name='doc_type',
+            field=models.CharField(choices=[('OPENING', 'Начальный остаток'), ('POSTAVKA', 'Поставка'), ('ZAYAVKA', 'Заявка'), ('VYRUCHKA', 'Выручка'), ('KORREKTIROVKA', 'Корректировка'), ('PEREMESHCHENIE', 'Перемещение')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='Peremeshchenie',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.DateField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('DRAFT', 'Черновик'), ('DONE', 'Проведено')], default='DRAFT', max_length=20)),
+                ('comment', models.TextField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='peremeshcheniya_created', to=settings.AUTH_USER_MODEL)),
+                ('id_magazin_iz', models.ForeignKey(db_column='id_magazin_iz', on_delete=django.db.models.deletion.PROTECT, related_name='peremeshcheniya_iz', to='core.magazin')),
+                ('id_magazin_v', models.ForeignKey(db_column='id_magazin_v', on_delete=django.db.models.deletion.PROTECT, related_name='peremeshcheniya_v', to='core.magazin')),
+            ],
+            options={
+                'db_table': 'peremeshchenie',
+                'permissions': [('post_peremeshchenie', 'Может проводить перемещения')],
+            },
+        ),
+        migrations.CreateModel(
+            name='PeremeshchenieItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kolichestvo', models.IntegerField(blank=True, null=True)),
+                ('id_peremeshchenie', models.ForeignKey(db_column='id_peremeshchenie', on_delete=django.db.models.deletion.CASCADE, to='core.peremeshchenie')),
+                ('id_tovar', models.ForeignKey(db_column='id_tovar', on_delete=django.db.models.deletion.PROTECT, to='core.tovar')),
+            ],
+            options={
+                'db_table': 'peremeshchenie_item',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='peremeshchenie',
+            constraint=models.CheckConstraint(condition=models.Q(('id_magazin_iz', models.F('id_magazin_v')), _negated=True), name='peremeshchenie_magaziny_check'),
+        ),
+        migrations.AddConstraint(
+            model_name='peremeshchenieitem',
+            constraint=models.UniqueConstraint(fields=('id_peremeshchenie', 'id_tovar'), name='uniq_peremeshchenie_item'),
+        ),
+    ]
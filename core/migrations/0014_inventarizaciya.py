@@ -0,0 +1,50 @@
+# Generated by Django 6.0 on 2026-10-18 13:50
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_peremeshchenie'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stockmovement',
+            name='doc_type',
+            field=models.CharField(choices=[('OPENING', 'Начальный остаток'), ('POSTAVKA', 'Поставка'), ('ZAYAVKA', 'Заявка'), ('VYRUCHKA', 'Выручка'), ('KORREKTIROVKA', 'Корректировка'), ('PEREMESHCHENIE', 'Перемещение'), ('INVENTARIZACIYA', 'Инвентаризация')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='Inventarizaciya',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.DateField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('DRAFT', 'Черновик'), ('DONE', 'Проведена')], default='DRAFT', max_length=20)),
+                ('comment', models.TextField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='inventarizacii_created', to=settings.AUTH_USER_MODEL)),
+                ('id_magazin', models.ForeignKey(db_column='id_magazin', on_delete=django.db.models.deletion.PROTECT, to='core.magazin')),
+            ],
+            options={
+                'db_table': 'inventarizaciya',
+                'permissions': [('post_inventarizaciya', 'Может проводить инвентаризации')],
+            },
+        ),
+        migrations.CreateModel(
+            name='InventarizaciyaItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kolichestvo_fakt', models.IntegerField()),
+                ('kolichestvo_uchet', models.IntegerField(blank=True, null=True)),
+                ('id_inventarizaciya', models.ForeignKey(db_column='id_inventarizaciya', on_delete=django.db.models.deletion.CASCADE, to='core.inventarizaciya')),
+                ('id_tovar', models.ForeignKey(db_column='id_tovar', on_delete=django.db.models.deletion.PROTECT, to='core.tovar')),
+            ],
+            options={
+                'db_table': 'inventarizaciya_item',
+                'constraints': [models.UniqueConstraint(fields=('id_inventarizaciya', 'id_tovar'), name='uniq_inventarizaciya_item')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_inventarizaciya'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='zayavkaitem',
+            name='kolichestvo_zaprosheno',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 6.0 on 2026-10-18 14:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_zayavkaitem_kolichestvo_zaprosheno'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockAlert',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kolichestvo', models.IntegerField()),
+                ('min_kolichestvo', models.IntegerField()),
+                ('opened_at', models.DateTimeField(auto_now_add=True)),
+                ('closed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'stock_alert',
+            },
+        ),
+        migrations.AddField(
+            model_name='magazintovar',
+            name='min_kolichestvo',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='magazintovar',
+            index=models.Index(condition=models.Q(('kolichestvo__lt', models.F('min_kolichestvo'))), fields=['id_magazin', 'id_tovar'], name='magazin_tovar_low_idx'),
+        ),
+        migrations.AddField(
+            model_name='stockalert',
+            name='id_magazin',
+            field=models.ForeignKey(db_column='id_magazin', on_delete=django.db.models.deletion.CASCADE, to='core.magazin'),
+        ),
+        migrations.AddField(
+            model_name='stockalert',
+            name='id_tovar',
+            field=models.ForeignKey(db_column='id_tovar', on_delete=django.db.models.deletion.CASCADE, to='core.tovar'),
+        ),
+        migrations.AddConstraint(
+            model_name='stockalert',
+            constraint=models.UniqueConstraint(condition=models.Q(('closed_at__isnull', True)), fields=('id_magazin', 'id_tovar'), name='stock_alert_open_uniq'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 6.0 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_stock_alert'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vyruchka',
+            name='amount',
+            field=models.DecimalField(db_default=0, decimal_places=2, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='vyruchka',
+            name='items_cnt',
+            field=models.IntegerField(db_default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='vyruchka',
+            name='qty',
+            field=models.IntegerField(db_default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='vyruchka',
+            index=models.Index(fields=['amount'], name='vyruchka_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vyruchka',
+            index=models.Index(fields=['id_magazin', 'amount'], name='vyruchka_magazin_amount_idx'),
+        ),
+    ]
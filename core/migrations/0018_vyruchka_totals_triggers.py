@@ -0,0 +1,88 @@
+# Итоги чека (vyruchka.qty / amount / items_cnt) ведутся statement-level
+# триггерами tovar_vyruchka с transition tables — как остатки поставок в 0009:
+# одна дельта на чек за весь DML-оператор, в той же транзакции, что и запись
+# строк, в том числе для bulk_create / bulk_update / QuerySet.delete() / COPY.
+# Уже существующие чеки пересчитывает manage.py backfill_vyruchka_totals.
+
+from django.db import migrations
+
+
+CREATE_SQL = """
+CREATE FUNCTION vyruchka_totals_apply(ch_id bigint[], ch_qty integer[], ch_summa numeric[], ch_cnt integer[])
+RETURNS void LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE vyruchka AS v
+       SET qty = v.qty + d.qty,
+           amount = v.amount + d.amount,
+           items_cnt = v.items_cnt + d.cnt
+      FROM (SELECT c.id, SUM(c.qty) AS qty, SUM(c.summa) AS amount, SUM(c.cnt) AS cnt
+              FROM unnest(ch_id, ch_qty, ch_summa, ch_cnt) AS c(id, qty, summa, cnt)
+             GROUP BY c.id
+            HAVING SUM(c.qty) <> 0 OR SUM(c.summa) <> 0 OR SUM(c.cnt) <> 0) AS d
+     WHERE v.id = d.id;
+END;
+$$;
+
+CREATE FUNCTION vyruchka_totals_ins() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM vyruchka_totals_apply(array_agg(n.id_vyruchka), array_agg(COALESCE(n.kolichestvo, 0)),
+                                  array_agg(COALESCE(n.summa, 0)), array_agg(1))
+       FROM new_rows AS n;
+    RETURN NULL;
+END;
+$$;
+
+CREATE FUNCTION vyruchka_totals_upd() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM vyruchka_totals_apply(array_agg(c.id), array_agg(c.qty), array_agg(c.summa), array_agg(c.cnt))
+       FROM (SELECT n.id_vyruchka AS id, COALESCE(n.kolichestvo, 0) AS qty, COALESCE(n.summa, 0) AS summa, 1 AS cnt
+               FROM new_rows AS n
+             UNION ALL
+             SELECT o.id_vyruchka, -COALESCE(o.kolichestvo, 0), -COALESCE(o.summa, 0), -1
+               FROM old_rows AS o) AS c;
+    RETURN NULL;
+END;
+$$;
+
+CREATE FUNCTION vyruchka_totals_del() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM vyruchka_totals_apply(array_agg(o.id_vyruchka), array_agg(-COALESCE(o.kolichestvo, 0)),
+                                  array_agg(-COALESCE(o.summa, 0)), array_agg(-1))
+       FROM old_rows AS o;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER vyruchka_totals_ins AFTER INSERT ON tovar_vyruchka
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION vyruchka_totals_ins();
+
+CREATE TRIGGER vyruchka_totals_upd AFTER UPDATE ON tovar_vyruchka
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION vyruchka_totals_upd();
+
+CREATE TRIGGER vyruchka_totals_del AFTER DELETE ON tovar_vyruchka
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION vyruchka_totals_del();
+"""
+
+DROP_SQL = """
+DROP TRIGGER IF EXISTS vyruchka_totals_ins ON tovar_vyruchka;
+DROP TRIGGER IF EXISTS vyruchka_totals_upd ON tovar_vyruchka;
+DROP TRIGGER IF EXISTS vyruchka_totals_del ON tovar_vyruchka;
+DROP FUNCTION IF EXISTS vyruchka_totals_ins();
+DROP FUNCTION IF EXISTS vyruchka_totals_upd();
+DROP FUNCTION IF EXISTS vyruchka_totals_del();
+DROP FUNCTION IF EXISTS vyruchka_totals_apply(bigint[], integer[], numeric[], integer[]);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_vyruchka_totals'),
+    ]
+
+    operations = [
+        migrations.RunSQL(sql=CREATE_SQL, reverse_sql=DROP_SQL),
+    ]
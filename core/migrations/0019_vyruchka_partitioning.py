@@ -0,0 +1,183 @@
+# Выручка секционируется по месяцам: vyruchka и tovar_vyruchka становятся
+# PARTITION BY RANGE (data). Дата чека переносится в строки (tovar_vyruchka.data),
+# чтобы выборки за период отсекали секции строк, а не только чеков.
+#
+# Ограничения PostgreSQL, которые определяют схему:
+# - первичный ключ секционированной таблицы обязан включать ключ секций —
+#   PK становится (id, data), а vyruchka.data — NOT NULL;
+# - поэтому строки ссылаются на чек составным FK (id_vyruchka, data) с ON UPDATE
+#   CASCADE: смена даты чека переносит и строки в нужную секцию;
+# - identity-столбцы у секционированных таблиц (до PG 17) не поддерживаются —
+#   id берётся из обычной последовательности, привязанной к столбцу (OWNED BY),
+#   pg_get_serial_sequence() продолжает её находить.
+#
+# Секции создаются на месяцы существующих данных (не глубже 5 лет назад) и на 3 месяца
+# вперёд; дальше их заранее создаёт manage.py vyruchka_partitions. Всё, на что секции
+# нет (в том числе ошибочные даты в далёком прошлом), попадает в секцию DEFAULT,
+# откуда vyruchka_partitions переносит строки при создании месяца.
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+FILL_DATA_SQL = """
+-- даты у чеков без даты: день проведения по журналу движения, иначе сегодня
+UPDATE vyruchka AS v
+   SET data = COALESCE(
+           (SELECT MIN(sm.created_at)::date
+              FROM stock_movement AS sm
+             WHERE sm.doc_type = 'VYRUCHKA' AND sm.doc_id = v.id),
+           CURRENT_DATE)
+ WHERE v.data IS NULL;
+"""
+
+ADD_LINE_DATA_SQL = """
+ALTER TABLE tovar_vyruchka ADD COLUMN data date;
+UPDATE tovar_vyruchka AS tv SET data = v.data FROM vyruchka AS v WHERE v.id = tv.id_vyruchka;
+ALTER TABLE tovar_vyruchka ALTER COLUMN data SET NOT NULL;
+"""
+
+DROP_LINE_DATA_SQL = """
+ALTER TABLE tovar_vyruchka DROP COLUMN data;
+"""
+
+# общая часть: ключи, внешние ключи, индексы и триггеры итогов (0018) новой пары таблиц
+CONSTRAINTS_SQL = """
+ALTER TABLE vyruchka ADD CONSTRAINT vyruchka_id_magazin_a7bdeea9_fk_magazin_id
+    FOREIGN KEY (id_magazin) REFERENCES magazin (id) DEFERRABLE INITIALLY DEFERRED;
+ALTER TABLE vyruchka ADD CONSTRAINT vyruchka_id_rabotnik_0cc67b6a_fk_rabotnik_id
+    FOREIGN KEY (id_rabotnik) REFERENCES rabotnik (id) DEFERRABLE INITIALLY DEFERRED;
+ALTER TABLE tovar_vyruchka ADD CONSTRAINT tovar_vyruchka_id_tovar_191c2c77_fk_tovar_id
+    FOREIGN KEY (id_tovar) REFERENCES tovar (id) DEFERRABLE INITIALLY DEFERRED;
+
+CREATE INDEX vyruchka_id_magazin_a7bdeea9 ON vyruchka (id_magazin);
+CREATE INDEX vyruchka_id_rabotnik_0cc67b6a ON vyruchka (id_rabotnik);
+CREATE INDEX vyruchka_amount_idx ON vyruchka (amount);
+CREATE INDEX vyruchka_magazin_amount_idx ON vyruchka (id_magazin, amount);
+CREATE INDEX tovar_vyruchka_id_tovar_191c2c77 ON tovar_vyruchka (id_tovar);
+CREATE INDEX tovar_vyruchka_id_vyruchka_b512a88f ON tovar_vyruchka (id_vyruchka);
+
+CREATE TRIGGER vyruchka_totals_ins AFTER INSERT ON tovar_vyruchka
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION vyruchka_totals_ins();
+CREATE TRIGGER vyruchka_totals_upd AFTER UPDATE ON tovar_vyruchka
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION vyruchka_totals_upd();
+CREATE TRIGGER vyruchka_totals_del AFTER DELETE ON tovar_vyruchka
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION vyruchka_totals_del();
+"""
+
+PARTITION_SQL = """
+CREATE TABLE vyruchka_p (LIKE vyruchka INCLUDING DEFAULTS) PARTITION BY RANGE (data);
+CREATE TABLE tovar_vyruchka_p (LIKE tovar_vyruchka INCLUDING DEFAULTS) PARTITION BY RANGE (data);
+
+DO $$
+DECLARE
+    m date;
+    upto date := date_trunc('month', CURRENT_DATE) + interval '3 months';
+BEGIN
+    -- одна опечатка в дате (0202 вместо 2022) не должна порождать тысячи пустых секций
+    SELECT GREATEST(date_trunc('month', LEAST(MIN(data), CURRENT_DATE)),
+                    date_trunc('month', CURRENT_DATE) - interval '5 years')
+      INTO m FROM vyruchka;
+    WHILE m <= upto LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF vyruchka_p FOR VALUES FROM (%L) TO (%L)',
+                       'vyruchka_' || to_char(m, '"y"YYYY"m"MM'), m, m + interval '1 month');
+        EXECUTE format('CREATE TABLE %I PARTITION OF tovar_vyruchka_p FOR VALUES FROM (%L) TO (%L)',
+                       'tovar_vyruchka_' || to_char(m, '"y"YYYY"m"MM'), m, m + interval '1 month');
+        m := m + interval '1 month';
+    END LOOP;
+END;
+$$;
+
+CREATE TABLE vyruchka_default PARTITION OF vyruchka_p DEFAULT;
+CREATE TABLE tovar_vyruchka_default PARTITION OF tovar_vyruchka_p DEFAULT;
+
+INSERT INTO vyruchka_p SELECT * FROM vyruchka;
+INSERT INTO tovar_vyruchka_p SELECT * FROM tovar_vyruchka;
+
+-- вместе со старыми таблицами уходят их identity-последовательности и триггеры итогов
+DROP TABLE tovar_vyruchka;
+DROP TABLE vyruchka;
+ALTER TABLE vyruchka_p RENAME TO vyruchka;
+ALTER TABLE tovar_vyruchka_p RENAME TO tovar_vyruchka;
+
+CREATE SEQUENCE vyruchka_id_seq OWNED BY vyruchka.id;
+CREATE SEQUENCE tovar_vyruchka_id_seq OWNED BY tovar_vyruchka.id;
+SELECT setval('vyruchka_id_seq', COALESCE(MAX(id), 0) + 1, false) FROM vyruchka;
+SELECT setval('tovar_vyruchka_id_seq', COALESCE(MAX(id), 0) + 1, false) FROM tovar_vyruchka;
+ALTER TABLE vyruchka ALTER COLUMN id SET DEFAULT nextval('vyruchka_id_seq');
+ALTER TABLE tovar_vyruchka ALTER COLUMN id SET DEFAULT nextval('tovar_vyruchka_id_seq');
+
+ALTER TABLE vyruchka ADD CONSTRAINT vyruchka_pkey PRIMARY KEY (id, data);
+ALTER TABLE tovar_vyruchka ADD CONSTRAINT tovar_vyruchka_pkey PRIMARY KEY (id, data);
+ALTER TABLE tovar_vyruchka ADD CONSTRAINT tovar_vyruchka_vyruchka_fk
+    FOREIGN KEY (id_vyruchka, data) REFERENCES vyruchka (id, data)
+    ON UPDATE CASCADE DEFERRABLE INITIALLY DEFERRED;
+""" + CONSTRAINTS_SQL
+
+# обратно — в обычные таблицы; отсоединённые (архивные) секции не возвращаются
+UNPARTITION_SQL = """
+CREATE TABLE vyruchka_u (LIKE vyruchka INCLUDING DEFAULTS);
+CREATE TABLE tovar_vyruchka_u (LIKE tovar_vyruchka INCLUDING DEFAULTS);
+ALTER TABLE vyruchka_u ALTER COLUMN id DROP DEFAULT;
+ALTER TABLE tovar_vyruchka_u ALTER COLUMN id DROP DEFAULT;
+
+INSERT INTO vyruchka_u SELECT * FROM vyruchka;
+INSERT INTO tovar_vyruchka_u SELECT * FROM tovar_vyruchka;
+
+DROP TABLE tovar_vyruchka;
+DROP TABLE vyruchka;
+ALTER TABLE vyruchka_u RENAME TO vyruchka;
+ALTER TABLE tovar_vyruchka_u RENAME TO tovar_vyruchka;
+
+ALTER TABLE vyruchka ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY;
+ALTER TABLE tovar_vyruchka ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY;
+SELECT setval(pg_get_serial_sequence('vyruchka', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM vyruchka;
+SELECT setval(pg_get_serial_sequence('tovar_vyruchka', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM tovar_vyruchka;
+
+ALTER TABLE vyruchka ADD CONSTRAINT vyruchka_pkey PRIMARY KEY (id);
+ALTER TABLE tovar_vyruchka ADD CONSTRAINT tovar_vyruchka_pkey PRIMARY KEY (id);
+""" + CONSTRAINTS_SQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_vyruchka_totals_triggers'),
+    ]
+
+    operations = [
+        migrations.RunSQL(sql=FILL_DATA_SQL, reverse_sql=migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='vyruchka',
+            name='data',
+            field=models.DateField(default=django.utils.timezone.localdate),
+        ),
+        migrations.AlterField(
+            model_name='rabotnikvyruchka',
+            name='id_vyruchka',
+            field=models.ForeignKey(db_column='id_vyruchka', db_constraint=False, on_delete=django.db.models.deletion.PROTECT, to='core.vyruchka'),
+        ),
+        migrations.AlterField(
+            model_name='tovarvyruchka',
+            name='id_vyruchka',
+            field=models.ForeignKey(db_column='id_vyruchka', db_constraint=False, on_delete=django.db.models.deletion.PROTECT, to='core.vyruchka'),
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddField(
+                    model_name='tovarvyruchka',
+                    name='data',
+                    field=models.DateField(editable=False),
+                    preserve_default=False,
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(sql=ADD_LINE_DATA_SQL, reverse_sql=DROP_LINE_DATA_SQL),
+            ],
+        ),
+        migrations.RunSQL(sql=PARTITION_SQL, reverse_sql=UNPARTITION_SQL),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 6.0 on 2026-10-18 16:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_vyruchka_partitioning'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VyruchkaArkhiv',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mesyac', models.DateField()),
+                ('kolichestvo', models.IntegerField(default=0)),
+                ('summa', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('id_magazin', models.ForeignKey(blank=True, db_column='id_magazin', null=True, on_delete=django.db.models.deletion.PROTECT, to='core.magazin')),
+                ('id_tovar', models.ForeignKey(db_column='id_tovar', on_delete=django.db.models.deletion.PROTECT, to='core.tovar')),
+            ],
+            options={
+                'db_table': 'vyruchka_arkhiv',
+                'constraints': [models.UniqueConstraint(fields=('mesyac', 'id_magazin', 'id_tovar'), name='uniq_vyruchka_arkhiv', nulls_distinct=False)],
+            },
+        ),
+    ]
@@ -0,0 +1,125 @@
+# Итоги чека после секционирования (0019): vyruchka уникальна только по (id, data),
+# а UPDATE ... WHERE v.id = d.id без даты не отсекает секции — перебирает их все.
+# Триггеры строк передают дату строки (= дате чека), итог ищется по (id, data).
+# Смена даты чека каскадом обновляет и строки — их старые версии относятся к чеку
+# уже с новой датой.
+
+from django.db import migrations
+
+
+CREATE_SQL = """
+DROP FUNCTION vyruchka_totals_apply(bigint[], integer[], numeric[], integer[]);
+
+CREATE FUNCTION vyruchka_totals_apply(ch_id bigint[], ch_data date[], ch_qty integer[],
+                                      ch_summa numeric[], ch_cnt integer[])
+RETURNS void LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE vyruchka AS v
+       SET qty = v.qty + d.qty,
+           amount = v.amount + d.amount,
+           items_cnt = v.items_cnt + d.cnt
+      FROM (SELECT c.id, c.data, SUM(c.qty) AS qty, SUM(c.summa) AS amount, SUM(c.cnt) AS cnt
+              FROM unnest(ch_id, ch_data, ch_qty, ch_summa, ch_cnt) AS c(id, data, qty, summa, cnt)
+             GROUP BY c.id, c.data
+            HAVING SUM(c.qty) <> 0 OR SUM(c.summa) <> 0 OR SUM(c.cnt) <> 0) AS d
+     WHERE v.id = d.id AND v.data = d.data;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION vyruchka_totals_ins() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM vyruchka_totals_apply(array_agg(n.id_vyruchka), array_agg(n.data), array_agg(COALESCE(n.kolichestvo, 0)),
+                                  array_agg(COALESCE(n.summa, 0)), array_agg(1))
+       FROM new_rows AS n;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION vyruchka_totals_upd() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM vyruchka_totals_apply(array_agg(c.id), array_agg(c.data), array_agg(c.qty),
+                                  array_agg(c.summa), array_agg(c.cnt))
+       FROM (SELECT n.id_vyruchka AS id, n.data, COALESCE(n.kolichestvo, 0) AS qty,
+                    COALESCE(n.summa, 0) AS summa, 1 AS cnt
+               FROM new_rows AS n
+             UNION ALL
+             -- строка осталась в том же чеке — у чека уже новая дата (смена даты чека
+             -- приходит сюда каскадом ON UPDATE по составному FK), иначе — дата старого чека
+             SELECT o.id_vyruchka, COALESCE(n.data, o.data), -COALESCE(o.kolichestvo, 0),
+                    -COALESCE(o.summa, 0), -1
+               FROM old_rows AS o
+               LEFT JOIN new_rows AS n ON n.id = o.id AND n.id_vyruchka = o.id_vyruchka) AS c;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION vyruchka_totals_del() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM vyruchka_totals_apply(array_agg(o.id_vyruchka), array_agg(o.data), array_agg(-COALESCE(o.kolichestvo, 0)),
+                                  array_agg(-COALESCE(o.summa, 0)), array_agg(-1))
+       FROM old_rows AS o;
+    RETURN NULL;
+END;
+$$;
+"""
+
+# обратно — функции из 0018 (сопоставление только по id)
+DROP_SQL = """
+DROP FUNCTION vyruchka_totals_apply(bigint[], date[], integer[], numeric[], integer[]);
+
+CREATE FUNCTION vyruchka_totals_apply(ch_id bigint[], ch_qty integer[], ch_summa numeric[], ch_cnt integer[])
+RETURNS void LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE vyruchka AS v
+       SET qty = v.qty + d.qty,
+           amount = v.amount + d.amount,
+           items_cnt = v.items_cnt + d.cnt
+      FROM (SELECT c.id, SUM(c.qty) AS qty, SUM(c.summa) AS amount, SUM(c.cnt) AS cnt
+              FROM unnest(ch_id, ch_qty, ch_summa, ch_cnt) AS c(id, qty, summa, cnt)
+             GROUP BY c.id
+            HAVING SUM(c.qty) <> 0 OR SUM(c.summa) <> 0 OR SUM(c.cnt) <> 0) AS d
+     WHERE v.id = d.id;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION vyruchka_totals_ins() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM vyruchka_totals_apply(array_agg(n.id_vyruchka), array_agg(COALESCE(n.kolichestvo, 0)),
+                                  array_agg(COALESCE(n.summa, 0)), array_agg(1))
+       FROM new_rows AS n;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION vyruchka_totals_upd() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM vyruchka_totals_apply(array_agg(c.id), array_agg(c.qty), array_agg(c.summa), array_agg(c.cnt))
+       FROM (SELECT n.id_vyruchka AS id, COALESCE(n.kolichestvo, 0) AS qty, COALESCE(n.summa, 0) AS summa, 1 AS cnt
+               FROM new_rows AS n
+             UNION ALL
+             SELECT o.id_vyruchka, -COALESCE(o.kolichestvo, 0), -COALESCE(o.summa, 0), -1
+               FROM old_rows AS o) AS c;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION vyruchka_totals_del() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM vyruchka_totals_apply(array_agg(o.id_vyruchka), array_agg(-COALESCE(o.kolichestvo, 0)),
+                                  array_agg(-COALESCE(o.summa, 0)), array_agg(-1))
+       FROM old_rows AS o;
+    RETURN NULL;
+END;
+$$;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_vyruchka_arkhiv'),
+    ]
+
+    operations = [
+        migrations.RunSQL(sql=CREATE_SQL, reverse_sql=DROP_SQL),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 6.0 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_vyruchka_totals_by_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vyruchka',
+            name='chek',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='vyruchka',
+            constraint=models.UniqueConstraint(condition=models.Q(('chek__isnull', False)), fields=('id_magazin', 'chek', 'data'), name='uniq_vyruchka_chek'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='api_token_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 6.0 on 2026-10-18 17:40
+
+# Версия данных плана закупок ведётся в БД: statement-level триггеры таблиц,
+# от которых зависит план, добавляют строку в purchase_plan_change в той же
+# транзакции, что и изменение, — в том числе для bulk_create / QuerySet.update() /
+# COPY и записей из других процессов (approve_worker, другие воркеры gunicorn).
+
+from django.db import migrations, models
+
+
+PLAN_TABLES = ("postavka", "zayavka", "zayavka_item", "tovar", "tovar_stripe")
+
+CREATE_SQL = """
+CREATE FUNCTION purchase_plan_bump() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO purchase_plan_change DEFAULT VALUES;
+    RETURN NULL;
+END;
+$$;
+""" + "".join(
+    f"""
+CREATE TRIGGER purchase_plan_bump AFTER INSERT OR UPDATE OR DELETE ON {table}
+    FOR EACH STATEMENT EXECUTE FUNCTION purchase_plan_bump();
+"""
+    for table in PLAN_TABLES
+)
+
+DROP_SQL = "".join(
+    f"DROP TRIGGER IF EXISTS purchase_plan_bump ON {table};\n" for table in PLAN_TABLES
+) + "DROP FUNCTION IF EXISTS purchase_plan_bump();\n"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_vyruchka_import_api'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PurchasePlanChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('n', models.BigIntegerField(db_default=1)),
+            ],
+            options={
+                'db_table': 'purchase_plan_change',
+            },
+        ),
+        migrations.RunSQL(sql=CREATE_SQL, reverse_sql=DROP_SQL),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 6.0 on 2026-10-18 17:55
+
+# Свёртка журнала отсекает движения по транзакции (xid), а не по id: id выдаются
+# в порядке вставки, и движение долгой транзакции могло получить id ниже уже
+# свёрнутой границы. Прежние остатки stock_balance свёрнуты по id — их граница
+# в xid не переводится, поэтому они удаляются (это производные данные):
+# следующий manage.py compact_stock_movements свернёт журнал заново.
+
+import core.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0023_purchase_plan_change'),
+    ]
+
+    operations = [
+        migrations.RunSQL(sql="DELETE FROM stock_balance", reverse_sql="DELETE FROM stock_balance"),
+        migrations.RemoveIndex(
+            model_name='stockmovement',
+            name='stock_movement_key_idx',
+        ),
+        migrations.RemoveField(
+            model_name='stockbalance',
+            name='upto_movement_id',
+        ),
+        migrations.AddField(
+            model_name='stockbalance',
+            name='upto_xid',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stockmovement',
+            name='xid',
+            field=models.BigIntegerField(db_default=core.models.CurrentXactId(), editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='stockmovement',
+            index=models.Index(fields=['id_tovar', 'id_magazin', 'xid'], name='stock_movement_key_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stockmovement',
+            index=models.Index(fields=['xid'], name='stock_movement_xid_idx'),
+        ),
+    ]
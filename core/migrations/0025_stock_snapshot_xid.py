@@ -0,0 +1,34 @@
+# Generated by Django 6.0 on 2026-10-18 18:10
+
+# Срезы остатков, как и свёртка журнала (0024), отсекают движения по xid.
+# Прежние срезы взяты по границе id и могли не учесть движения транзакций,
+# шедших в момент среза, — они удаляются (остатки на дату без среза считаются
+# по журналу целиком), manage.py snapshot_stock снимает новые.
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_stock_movement_xid'),
+    ]
+
+    operations = [
+        migrations.RunSQL(sql="DELETE FROM stock_snapshot_item; DELETE FROM stock_snapshot",
+                          reverse_sql=migrations.RunSQL.noop),
+        migrations.RemoveField(
+            model_name='stocksnapshot',
+            name='upto_movement_id',
+        ),
+        migrations.AddField(
+            model_name='stocksnapshot',
+            name='tail_xid',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stocksnapshot',
+            name='upto_xid',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 6.0 on 2026-10-18 18:40
+
+# postavka_stock_apply (миграция 0009) обновлял tovar_stripe и tovar в порядке плана
+# запроса и мог взаимно заблокироваться с проведением заявок, которое блокирует tovar
+# по id. Теперь функция сначала блокирует строки tovar по id, затем под-счётчики
+# по (id_tovar, stripe) — в общем порядке всех складских операций. FOR NO KEY UPDATE —
+# тот же режим, что берёт сам UPDATE: он не конфликтует с проверками внешних ключей
+# (FOR KEY SHARE) при вставке поставок и движений.
+
+from django.db import migrations
+
+
+APPLY_SQL = """
+CREATE OR REPLACE FUNCTION postavka_stock_apply(ch_id bigint[], ch_tovar bigint[], ch_qty integer[])
+RETURNS void LANGUAGE plpgsql AS $$
+BEGIN{lock}
+    -- журнал: чистое изменение по каждой поставке и товару
+    INSERT INTO stock_movement (doc_type, doc_id, id_magazin, id_tovar, kolichestvo, created_at)
+    SELECT 'POSTAVKA', c.id, NULL, c.id_tovar, SUM(c.qty), clock_timestamp()
+      FROM unnest(ch_id, ch_tovar, ch_qty) AS c(id, id_tovar, qty)
+     GROUP BY c.id, c.id_tovar
+    HAVING SUM(c.qty) <> 0;
+
+    -- остатки: одна дельта на товар; под-счётчики — как в services._apply_central_delta
+    WITH v AS (
+        SELECT c.id_tovar, SUM(c.qty) AS delta
+          FROM unnest(ch_tovar, ch_qty) AS c(id_tovar, qty)
+         GROUP BY c.id_tovar
+        HAVING SUM(c.qty) <> 0
+    ),
+    pick AS (
+        SELECT v.id_tovar, v.delta, floor(random() * s.n)::int AS stripe
+          FROM v
+          JOIN (SELECT id_tovar, COUNT(*) AS n
+                  FROM tovar_stripe
+                 WHERE id_tovar IN (SELECT id_tovar FROM v)
+                 GROUP BY id_tovar) AS s ON s.id_tovar = v.id_tovar
+    ),
+    striped AS (
+        UPDATE tovar_stripe AS ts
+           SET delta = ts.delta + pick.delta
+          FROM pick
+         WHERE ts.id_tovar = pick.id_tovar AND ts.stripe = pick.stripe
+        RETURNING ts.id_tovar
+    )
+    UPDATE tovar AS t
+       SET kolichestvo_na_sklade = COALESCE(t.kolichestvo_na_sklade, 0) + v.delta
+      FROM v
+     WHERE t.id = v.id_tovar
+       AND t.id NOT IN (SELECT id_tovar FROM striped);
+END;
+$$;
+"""
+
+LOCK_SQL = """
+    -- блокировки в общем порядке складских операций: tovar по id, затем под-счётчики
+    PERFORM 1 FROM tovar WHERE id = ANY(ch_tovar) ORDER BY id FOR NO KEY UPDATE;
+    PERFORM 1 FROM tovar_stripe WHERE id_tovar = ANY(ch_tovar) ORDER BY id_tovar, stripe FOR NO KEY UPDATE;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0025_stock_snapshot_xid'),
+    ]
+
+    operations = [
+        migrations.RunSQL(sql=APPLY_SQL.format(lock=LOCK_SQL), reverse_sql=APPLY_SQL.format(lock="")),
+    ]
@@ -1,7 +1,8 @@
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import F, Q
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 
 # ===== Справочники =====
 
@@ -150,13 +151,86 @@ class MagazinTovar(models.Model):
     id_magazin = models.ForeignKey(Magazin, on_delete=models.PROTECT, db_column="id_magazin")
     id_tovar = models.ForeignKey(Tovar, on_delete=models.PROTECT, db_column="id_tovar")
     kolichestvo = models.IntegerField(null=True, blank=True)
+    # неснижаемый остаток: ниже него позиция считается «низкой» (StockAlert)
+    min_kolichestvo = models.PositiveIntegerField(null=True, blank=True)
 
     class Meta:
         db_table = "magazin_tovar"
         constraints = [
             models.UniqueConstraint(fields=["id_magazin", "id_tovar"], name="uniq_magazin_tovar"),
         ]
+        indexes = [
+            # в индексе только строки ниже минимума — страница и счётчик «низких остатков»
+            # читают его целиком, не просматривая всю таблицу
+            models.Index(
+                fields=["id_magazin", "id_tovar"],
+                condition=Q(kolichestvo__lt=F("min_kolichestvo")),
+                name="magazin_tovar_low_idx",
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        # остаток меняют только складские операции (core/services.py) — каждая с движением
+        # в журнале stock_movement. Сохранение позиции через ORM (админка, форма минимума)
+        # остаток не пишет: иначе оно затёрло бы продажи, проведённые после загрузки формы.
+        # Новая позиция с ненулевым остатком записывается в журнал как начальный остаток.
+        adding = self._state.adding
+        if not adding:
+            fields = kwargs.get("update_fields")
+            if fields is None:
+                fields = [f.name for f in self._meta.concrete_fields if not f.primary_key]
+            kwargs["update_fields"] = [name for name in fields if name != "kolichestvo"]
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding and self.kolichestvo:
+                StockMovement.objects.create(
+                    doc_type=StockMovement.DocType.OPENING,
+                    id_magazin_id=self.id_magazin_id, id_tovar_id=self.id_tovar_id, kolichestvo=self.kolichestvo,
+                )
+
+
+class StockAlert(models.Model):
+    """
+    Журнал «низких остатков»: запись открывается, когда остаток позиции магазина
+    опускается ниже min_kolichestvo, и закрывается, когда поднимается обратно.
+    Ведётся services.refresh_stock_alerts — её вызывает _magazin_stock_changed при каждом
+    изменении остатка складскими операциями.
+    """
+    id_magazin = models.ForeignKey(Magazin, on_delete=models.CASCADE, db_column="id_magazin")
+    id_tovar = models.ForeignKey(Tovar, on_delete=models.CASCADE, db_column="id_tovar")
+    kolichestvo = models.IntegerField()
+    min_kolichestvo = models.IntegerField()
+    opened_at = models.DateTimeField(auto_now_add=True)
+    closed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = "stock_alert"
+        constraints = [
+            # не больше одной открытой записи на позицию
+            models.UniqueConstraint(
+                fields=["id_magazin", "id_tovar"],
+                condition=Q(closed_at__isnull=True),
+                name="stock_alert_open_uniq",
+            ),
+        ]
+
+
+class TovarStripe(models.Model):
+    """
+    Под-счётчик остатка центрального склада для «горячих» товаров.
+    Если у товара есть под-счётчики, приходы/списания пишутся в случайный из них,
+    а остаток = tovar.kolichestvo_na_sklade + сумма delta. Фоновая свёртка
+    (manage.py tovar_stripes fold) переносит delta обратно в tovar.
+    """
+    id_tovar = models.ForeignKey(Tovar, on_delete=models.CASCADE, db_column="id_tovar")
+    stripe = models.PositiveSmallIntegerField()
+    delta = models.IntegerField(default=0)
 
+    class Meta:
+        db_table = "tovar_stripe"
+        constraints = [
+            models.UniqueConstraint(fields=["id_tovar", "stripe"], name="uniq_tovar_stripe"),
+        ]
 
 
 # ===== Поставщики / поставки =====
@@ -204,15 +278,54 @@ class Vyruchka(models.Model):
     id_rabotnik = models.ForeignKey(
         "Rabotnik", on_delete=models.PROTECT, null=True, blank=True, db_column="id_rabotnik"
     )
-    data = models.DateField(null=True, blank=True)
+    # ключ секционирования vyruchka / tovar_vyruchka по месяцам (миграция 0019)
+    data = models.DateField(default=timezone.localdate)
+    # номер чека кассы (массовая загрузка): повторная загрузка того же чека пропускается
+    chek = models.CharField(max_length=64, null=True, blank=True, editable=False)
+
+    # итоги по строкам чека; ведутся триггерами tovar_vyruchka (миграция 0018),
+    # пересчёт существующих чеков — manage.py backfill_vyruchka_totals
+    qty = models.IntegerField(db_default=0, editable=False)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, db_default=0, editable=False)
+    items_cnt = models.IntegerField(db_default=0, editable=False)
 
     class Meta:
         db_table = "vyruchka"
+        indexes = [
+            models.Index(fields=["amount"], name="vyruchka_amount_idx"),
+            models.Index(fields=["id_magazin", "amount"], name="vyruchka_magazin_amount_idx"),
+        ]
+        constraints = [
+            # уникальность на секционированной таблице обязана включать ключ секций (data).
+            # Частичный индекс: проверка FK строк (id, data) не может выбрать его вместо PK —
+            # на свежей секции без статистики она уходила в полный проход по нему
+            models.UniqueConstraint(
+                fields=["id_magazin", "chek", "data"], condition=Q(chek__isnull=False), name="uniq_vyruchka_chek"
+            ),
+        ]
+
+    TOTALS = ("qty", "amount", "items_cnt")
+
+    def save(self, *args, **kwargs):
+        # итоги пишут только триггеры: сохранение загруженного ранее чека
+        # не должно затирать их устаревшими значениями из памяти
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.TOTALS
+            ]
+        super().save(*args, **kwargs)
 
 
 class TovarVyruchka(models.Model):
     id_tovar = models.ForeignKey(Tovar, on_delete=models.PROTECT, db_column="id_tovar")
-    id_vyruchka = models.ForeignKey(Vyruchka, on_delete=models.PROTECT, db_column="id_vyruchka")
+    # в БД — составной FK (id_vyruchka, data) -> vyruchka (id, data) ON UPDATE CASCADE
+    # (у секционированной vyruchka уникален только (id, data)), см. миграцию 0019
+    id_vyruchka = models.ForeignKey(
+        Vyruchka, on_delete=models.PROTECT, db_column="id_vyruchka", db_constraint=False
+    )
+    # дата чека — ключ секции строки; пишется вместе со строкой (= id_vyruchka.data)
+    data = models.DateField(editable=False)
     kolichestvo = models.IntegerField(null=True, blank=True)
 
     cena_prodazhi = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
@@ -221,6 +334,32 @@ class TovarVyruchka(models.Model):
     class Meta:
         db_table = "tovar_vyruchka"
 
+    def save(self, *args, **kwargs):
+        if self.data is None and self.id_vyruchka_id:
+            self.data = self.id_vyruchka.data
+        super().save(*args, **kwargs)
+
+
+class VyruchkaArkhiv(models.Model):
+    """
+    Итоги продаж за месяц отсоединённых (архивных) секций выручки: пишутся
+    detach_vyruchka_partitions перед DETACH, чтобы сверка остатков продолжала
+    учитывать эти продажи. mesyac — первое число месяца.
+    """
+    mesyac = models.DateField()
+    id_magazin = models.ForeignKey(Magazin, on_delete=models.PROTECT, null=True, blank=True, db_column="id_magazin")
+    id_tovar = models.ForeignKey(Tovar, on_delete=models.PROTECT, db_column="id_tovar")
+    kolichestvo = models.IntegerField(default=0)
+    summa = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        db_table = "vyruchka_arkhiv"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["mesyac", "id_magazin", "id_tovar"], nulls_distinct=False, name="uniq_vyruchka_arkhiv"
+            ),
+        ]
+
 
 
 class Otdel(models.Model):
@@ -273,7 +412,11 @@ class Rabotnik(models.Model):
 
 class RabotnikVyruchka(models.Model):
     id_rabotnik = models.ForeignKey(Rabotnik, on_delete=models.PROTECT, db_column="id_rabotnik")
-    id_vyruchka = models.ForeignKey(Vyruchka, on_delete=models.PROTECT, db_column="id_vyruchka")
+    # ссылочную целостность держит только ORM: FK на секционированную vyruchka
+    # возможен лишь по (id, data), а даты чека в этой таблице нет
+    id_vyruchka = models.ForeignKey(
+        Vyruchka, on_delete=models.PROTECT, db_column="id_vyruchka", db_constraint=False
+    )
 
     class Meta:
         db_table = "rabotnik_vyruchka"
@@ -356,6 +499,8 @@ class ZayavkaItem(models.Model):
     id_zayavka = models.ForeignKey(Zayavka, on_delete=models.CASCADE, db_column="id_zayavka")
     id_tovar = models.ForeignKey(Tovar, on_delete=models.PROTECT, db_column="id_tovar")
     kolichestvo = models.IntegerField(null=True, blank=True)
+    # исходное количество, если при распределении дефицита (consolidate_zayavki) выдано меньше
+    kolichestvo_zaprosheno = models.IntegerField(null=True, blank=True)
 
     class Meta:
         db_table = "zayavka_item"
@@ -364,12 +509,240 @@ class ZayavkaItem(models.Model):
         ]
 
 
+class ZayavkaApproveJob(models.Model):
+    """Очередь фонового проведения заявок (обрабатывает manage.py approve_worker)."""
+    class Status(models.TextChoices):
+        PENDING = "PENDING", "В очереди"
+        DONE = "DONE", "Выполнено"
+        FAILED = "FAILED", "Ошибка"
+
+    id_zayavka = models.ForeignKey(Zayavka, on_delete=models.CASCADE, db_column="id_zayavka")
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.PENDING)
+    error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL,
+        null=True, blank=True, related_name="zayavka_approve_jobs"
+    )
+
+    class Meta:
+        db_table = "zayavka_approve_job"
+        indexes = [
+            models.Index(fields=["id"], condition=Q(status="PENDING"), name="zayavka_job_pending_idx"),
+        ]
+
+
+class Peremeshchenie(models.Model):
+    """Перемещение товара между магазинами сети."""
+    class Status(models.TextChoices):
+        DRAFT = "DRAFT", "Черновик"
+        DONE = "DONE", "Проведено"
+
+    id_magazin_iz = models.ForeignKey(
+        Magazin, on_delete=models.PROTECT, db_column="id_magazin_iz", related_name="peremeshcheniya_iz"
+    )
+    id_magazin_v = models.ForeignKey(
+        Magazin, on_delete=models.PROTECT, db_column="id_magazin_v", related_name="peremeshcheniya_v"
+    )
+    data = models.DateField(null=True, blank=True)
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.DRAFT)
+    comment = models.TextField(null=True, blank=True)
+
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL,
+        null=True, blank=True, related_name="peremeshcheniya_created"
+    )
+
+    class Meta:
+        db_table = "peremeshchenie"
+        permissions = [
+            ("post_peremeshchenie", "Может проводить перемещения"),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                condition=~Q(id_magazin_iz=F("id_magazin_v")),
+                name="peremeshchenie_magaziny_check",
+            ),
+        ]
+
+    def __str__(self):
+        return f"Перемещение #{self.pk} ({self.get_status_display()})"
+
+
+class PeremeshchenieItem(models.Model):
+    id_peremeshchenie = models.ForeignKey(Peremeshchenie, on_delete=models.CASCADE, db_column="id_peremeshchenie")
+    id_tovar = models.ForeignKey(Tovar, on_delete=models.PROTECT, db_column="id_tovar")
+    kolichestvo = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        db_table = "peremeshchenie_item"
+        constraints = [
+            models.UniqueConstraint(fields=["id_peremeshchenie", "id_tovar"], name="uniq_peremeshchenie_item"),
+        ]
+
+
+class Inventarizaciya(models.Model):
+    """Инвентаризация (пересчёт) склада магазина."""
+    class Status(models.TextChoices):
+        DRAFT = "DRAFT", "Черновик"
+        DONE = "DONE", "Проведена"
+
+    id_magazin = models.ForeignKey(Magazin, on_delete=models.PROTECT, db_column="id_magazin")
+    data = models.DateField(null=True, blank=True)
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.DRAFT)
+    comment = models.TextField(null=True, blank=True)
+
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL,
+        null=True, blank=True, related_name="inventarizacii_created"
+    )
+
+    class Meta:
+        db_table = "inventarizaciya"
+        permissions = [
+            ("post_inventarizaciya", "Может проводить инвентаризации"),
+        ]
+
+    def __str__(self):
+        return f"Инвентаризация #{self.pk} ({self.get_status_display()})"
+
+
+class InventarizaciyaItem(models.Model):
+    id_inventarizaciya = models.ForeignKey(Inventarizaciya, on_delete=models.CASCADE, db_column="id_inventarizaciya")
+    id_tovar = models.ForeignKey(Tovar, on_delete=models.PROTECT, db_column="id_tovar")
+    kolichestvo_fakt = models.IntegerField()
+    # учётный остаток на момент проведения (до проведения — пусто)
+    kolichestvo_uchet = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        db_table = "inventarizaciya_item"
+        constraints = [
+            models.UniqueConstraint(fields=["id_inventarizaciya", "id_tovar"], name="uniq_inventarizaciya_item"),
+        ]
+
+
 User = get_user_model()
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="profile")
     id_magazin = models.ForeignKey("Magazin", on_delete=models.PROTECT, null=True, blank=True, db_column="id_magazin")
     id_otdel = models.ForeignKey("Otdel", on_delete=models.PROTECT, null=True, blank=True, db_column="id_otdel")
+    # SHA-256 ключа API для внешних систем (кассы); сам ключ не хранится, см. manage.py api_token
+    api_token_hash = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
+
+    class Meta:
+        db_table = "user_profile"
+
+# ===== Движение товара =====
+
+class CurrentXactId(models.Func):
+    """pg_current_xact_id() пишущей транзакции (xid8 как bigint)."""
+    template = "pg_current_xact_id()::text::bigint"
+    output_field = models.BigIntegerField()
+
+
+class StockMovement(models.Model):
+    """
+    Журнал движения товара (только добавление записей).
+    id_magazin = NULL — центральный склад.
+    xid — транзакция, записавшая движение (заполняет БД): id выдаются в порядке
+    вставки, а не фиксации, поэтому свёртки отсекают движения по xid —
+    всё, что ниже xmin снимка, уже зафиксировано или откатано.
+    """
+    class DocType(models.TextChoices):
+        OPENING = "OPENING", "Начальный остаток"
+        POSTAVKA = "POSTAVKA", "Поставка"
+        ZAYAVKA = "ZAYAVKA", "Заявка"
+        VYRUCHKA = "VYRUCHKA", "Выручка"
+        KORREKTIROVKA = "KORREKTIROVKA", "Корректировка"
+        PEREMESHCHENIE = "PEREMESHCHENIE", "Перемещение"
+        INVENTARIZACIYA = "INVENTARIZACIYA", "Инвентаризация"
+
+    doc_type = models.CharField(max_length=20, choices=DocType.choices)
+    doc_id = models.BigIntegerField(null=True, blank=True)
+    id_magazin = models.ForeignKey(Magazin, on_delete=models.PROTECT, null=True, blank=True, db_column="id_magazin")
+    id_tovar = models.ForeignKey(Tovar, on_delete=models.PROTECT, db_column="id_tovar")
+    kolichestvo = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    xid = models.BigIntegerField(db_default=CurrentXactId(), editable=False)
+
+    class Meta:
+        db_table = "stock_movement"
+        indexes = [
+            models.Index(fields=["id_tovar", "id_magazin", "xid"], name="stock_movement_key_idx"),
+            models.Index(fields=["xid"], name="stock_movement_xid_idx"),
+            models.Index(fields=["doc_type", "doc_id"], name="stock_movement_doc_idx"),
+        ]
+
+
+class StockBalance(models.Model):
+    """
+    Свёрнутый остаток по журналу: сумма всех движений транзакций с xid < upto_xid.
+    Текущий остаток = kolichestvo + движения с xid >= upto_xid.
+    """
+    id_magazin = models.ForeignKey(Magazin, on_delete=models.PROTECT, null=True, blank=True, db_column="id_magazin")
+    id_tovar = models.ForeignKey(Tovar, on_delete=models.PROTECT, db_column="id_tovar")
+    kolichestvo = models.IntegerField(default=0)
+    upto_xid = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = "stock_balance"
+        constraints = [
+            models.UniqueConstraint(fields=["id_magazin", "id_tovar"], name="uniq_stock_balance"),
+            models.UniqueConstraint(
+                fields=["id_tovar"], condition=Q(id_magazin__isnull=True), name="uniq_stock_balance_central"
+            ),
+        ]
+
+
+class StockSnapshot(models.Model):
+    """
+    Дневной срез остатков (manage.py snapshot_stock): остатки на конец дня data
+    по движениям, созданным до конца дня транзакциями с xid < upto_xid (к моменту
+    среза они уже завершились). Не вошедшие в срез движения — более поздние и
+    запоздавшие (их транзакция ещё шла) — все имеют xid >= tail_xid.
+    """
+    data = models.DateField(unique=True)
+    upto_xid = models.BigIntegerField(default=0)
+    tail_xid = models.BigIntegerField(default=0)
+    taken_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = "stock_snapshot"
+
+    def __str__(self):
+        return f"Срез остатков на {self.data}"
+
+
+class StockSnapshotItem(models.Model):
+    """
+    Строка среза пишется только для пар (магазин, товар), остаток которых
+    изменился с предыдущего среза. id_magazin = NULL — центральный склад.
+    """
+    id_snapshot = models.ForeignKey(StockSnapshot, on_delete=models.CASCADE, db_column="id_snapshot")
+    id_magazin = models.ForeignKey(Magazin, on_delete=models.PROTECT, null=True, blank=True, db_column="id_magazin")
+    id_tovar = models.ForeignKey(Tovar, on_delete=models.PROTECT, db_column="id_tovar")
+    kolichestvo = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = "stock_snapshot_item"
+        indexes = [
+            # последняя строка пары на дату: ORDER BY id_snapshot DESC LIMIT 1
+            models.Index(fields=["id_magazin", "id_tovar", "id_snapshot"], name="stock_snapshot_key_idx"),
+        ]
+
+
+class PurchasePlanChange(models.Model):
+    """
+    Счётчик изменений данных плана закупок (services.purchase_plan): строку пишут
+    statement-триггеры postavka, zayavka, zayavka_item, tovar и tovar_stripe
+    (миграция 0023), сумма n — версия данных, часть ключа кэша. Таблица только
+    пополняется, поэтому пишущие транзакции не ждут друг друга на одной строке;
+    purchase_plan время от времени сворачивает её в одну строку с той же суммой.
+    """
+    n = models.BigIntegerField(db_default=1)
 
     class Meta:
-        db_table = "user_profile"
\ No newline at end of file
+        db_table = "purchase_plan_change"
@@ -0,0 +1,282 @@
+"""
+Планирование перемещений товара между магазинами сети.
+
+Остатки magazin_tovar и скорость продаж (tovar_vyruchka за последние дни)
+загружаются в матрицы магазин × товар (NumPy), избыток и дефицит считаются
+по всей матрице сразу, а план перемещений строится без циклов по строкам:
+избытки и дефициты каждого товара раскладываются на общую числовую ось
+(cumsum), и каждый отрезок между соседними границами — это одно перемещение
+«источник -> получатель» (searchsorted). Что не покрыто внутри сети,
+предлагается закрыть с центрального склада.
+
+Автопополнение (plan_replenishment) на тех же матрицах считает, сколько
+каждому магазину заказать с центрального склада до запаса на N дней продаж,
+и сохраняет результат черновиками заявок.
+"""
+from dataclasses import dataclass
+from datetime import timedelta
+
+import numpy as np
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Peremeshchenie, PeremeshchenieItem, Zayavka, ZayavkaItem
+
+
+@dataclass
+class StockMatrix:
+    magazin_ids: np.ndarray          # (M,) отсортированные id магазинов
+    tovar_ids: np.ndarray            # (T,) отсортированные id товаров
+    stock: np.ndarray                # (M, T) остаток
+    velocity: np.ndarray             # (M, T) продажи в день
+    central: np.ndarray              # (T,) остаток центрального склада
+    minimum: np.ndarray              # (M, T) неснижаемый остаток (0 — не задан)
+
+
+@dataclass
+class RebalancePlan:
+    # перемещения между магазинами: параллельные массивы (из магазина, в магазин, товар, количество)
+    src: np.ndarray
+    dst: np.ndarray
+    tovar: np.ndarray
+    qty: np.ndarray
+    # остаток дефицита, закрываемый с центрального склада: (магазин, товар, количество)
+    central_magazin: np.ndarray
+    central_tovar: np.ndarray
+    central_qty: np.ndarray
+
+    def transfer_docs(self):
+        """Документы перемещения: [((из магазина, в магазин), [(товар, количество)])]."""
+        return _group((self.src, self.dst), self.tovar, self.qty)
+
+    def central_docs(self):
+        """Заявки на центральный склад: [(магазин, [(товар, количество)])]."""
+        return [(key[0], items) for key, items in _group((self.central_magazin,), self.central_tovar, self.central_qty)]
+
+
+def _group(keys, tovar, qty):
+    if not len(qty):
+        return []
+    order = np.lexsort((tovar,) + tuple(reversed(keys)))
+    keys = [k[order] for k in keys]
+    tovar, qty = tovar[order].tolist(), qty[order].tolist()
+    change = np.zeros(len(order), dtype=bool)
+    change[0] = True
+    for k in keys:
+        change[1:] |= k[1:] != k[:-1]
+    bounds = np.append(np.flatnonzero(change), len(order)).tolist()
+    heads = [k[change].tolist() for k in keys]
+    return [
+        (tuple(h[n] for h in heads), list(zip(tovar[a:b], qty[a:b])))
+        for n, (a, b) in enumerate(zip(bounds[:-1], bounds[1:]))
+    ]
+
+
+def _fetch_array(sql, params, width):
+    with connection.cursor() as cur:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+    if not rows:
+        return np.empty((0, width), dtype=np.int64)
+    return np.array(rows, dtype=np.float64)
+
+
+def load_stock_matrix(days: int = 28) -> StockMatrix:
+    """Загружает остатки и скорость продаж за последние days дней одной выборкой на таблицу."""
+    magazin_ids = _fetch_array("SELECT id FROM magazin ORDER BY id", [], 1)[:, 0].astype(np.int64)
+    tovar = _fetch_array("SELECT id, COALESCE(kolichestvo_na_sklade, 0) FROM tovar ORDER BY id", [], 2)
+    tovar_ids = tovar[:, 0].astype(np.int64)
+
+    shape = (len(magazin_ids), len(tovar_ids))
+    stock = np.zeros(shape, dtype=np.int64)
+    velocity = np.zeros(shape, dtype=np.float64)
+    minimum = np.zeros(shape, dtype=np.int64)
+
+    rows = _fetch_array(
+        "SELECT id_magazin, id_tovar, COALESCE(kolichestvo, 0), COALESCE(min_kolichestvo, 0) FROM magazin_tovar",
+        [], 4,
+    )
+    if len(rows):
+        i = np.searchsorted(magazin_ids, rows[:, 0])
+        j = np.searchsorted(tovar_ids, rows[:, 1])
+        np.add.at(stock, (i, j), rows[:, 2].astype(np.int64))
+        minimum[i, j] = rows[:, 3].astype(np.int64)
+
+    since = timezone.localdate() - timedelta(days=days)
+    rows = _fetch_array(
+        """
+        SELECT v.id_magazin, tv.id_tovar, SUM(COALESCE(tv.kolichestvo, 0))
+          FROM tovar_vyruchka AS tv
+          JOIN vyruchka AS v ON v.id = tv.id_vyruchka AND v.data = tv.data
+         WHERE tv.data >= %s AND v.data >= %s AND v.id_magazin IS NOT NULL
+         GROUP BY v.id_magazin, tv.id_tovar
+        """,
+        [since, since], 3,
+    )
+    if len(rows):
+        i = np.searchsorted(magazin_ids, rows[:, 0])
+        j = np.searchsorted(tovar_ids, rows[:, 1])
+        velocity[i, j] = rows[:, 2] / days
+
+    # под-счётчики центрального склада (tovar_stripe) входят в остаток
+    central = tovar[:, 1].astype(np.int64)
+    rows = _fetch_array("SELECT id_tovar, SUM(delta) FROM tovar_stripe GROUP BY id_tovar", [], 2)
+    if len(rows):
+        np.add.at(central, np.searchsorted(tovar_ids, rows[:, 0]), rows[:, 1].astype(np.int64))
+
+    return StockMatrix(magazin_ids, tovar_ids, stock, velocity, central, minimum)
+
+
+def _match(supply, demand):
+    """
+    Сопоставляет избытки и дефициты по всем товарам сразу.
+    supply, demand: (M, T) неотрицательные матрицы.
+    Возвращает массивы (источник, получатель, товар, количество).
+    """
+    moved = np.minimum(supply.sum(axis=0), demand.sum(axis=0))     # (T,) сколько товара двигать
+
+    def cells(mat):
+        # ячейки > 0 по товарам, внутри товара — от большего объёма к меньшему,
+        # объём обрезан так, чтобы в сумме по товару было ровно moved
+        i, j = np.nonzero(mat.T)                                     # i — товар, j — магазин
+        qty = mat.T[i, j]
+        order = np.lexsort((-qty, i))
+        t, m, qty = i[order], j[order], qty[order]
+        start = np.searchsorted(t, t, side="left")
+        cum = np.cumsum(qty)
+        before = cum - qty - np.where(start > 0, cum[start - 1], 0)  # накоплено внутри товара
+        qty = np.clip(moved[t] - before, 0, qty)
+        keep = qty > 0
+        return t[keep], m[keep], np.cumsum(qty[keep])
+
+    st, sm, s_end = cells(supply)
+    dt, dm, d_end = cells(demand)
+    if not len(s_end):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, empty
+
+    # суммы по товарам совпадают, поэтому границы товаров на обеих осях одни и те же;
+    # обе оси уже отсортированы — слияние вместо union1d (тот работает через хеш)
+    ends = np.sort(np.concatenate((s_end, d_end)), kind="stable")
+    ends = ends[np.append(True, ends[1:] != ends[:-1])]
+    starts = np.concatenate(([0], ends[:-1]))
+    si = np.searchsorted(s_end, ends, side="left")
+    di = np.searchsorted(d_end, ends, side="left")
+    return sm[si], dm[di], st[si], ends - starts
+
+
+def plan_rebalance(matrix: StockMatrix, cover_days: float = 14, max_cover_days: float = 60) -> RebalancePlan:
+    """
+    Дефицит — нехватка до запаса на cover_days дней продаж, но не меньше неснижаемого остатка.
+    Избыток — всё, что сверх запаса на max_cover_days дней и сверх собственной цели
+    магазина (с неснижаемым остатком): донор не опускается ниже своего минимума.
+    Дефициты сначала закрываются избытками других магазинов, остаток — с центрального склада.
+    """
+    v = matrix.velocity
+    target = np.maximum(np.ceil(v * cover_days).astype(np.int64), matrix.minimum)
+    keep = np.maximum(np.ceil(v * max_cover_days).astype(np.int64), target)
+    demand = np.clip(target - matrix.stock, 0, None)
+    supply = np.clip(matrix.stock - keep, 0, None)
+
+    src, dst, tov, qty = _match(supply, demand)
+
+    # остаток дефицита — с центрального склада, пока хватает (магазины по убыванию дефицита)
+    np.subtract.at(demand, (dst, tov), qty)
+    central = np.clip(matrix.central, 0, None)[None, :]
+    order = np.argsort(-demand, axis=0, kind="stable")
+    sorted_demand = np.take_along_axis(demand, order, axis=0)
+    before = np.cumsum(sorted_demand, axis=0) - sorted_demand
+    given_sorted = np.clip(central - before, 0, sorted_demand)
+    given = np.zeros_like(demand)
+    np.put_along_axis(given, order, given_sorted, axis=0)
+    i, j = np.nonzero(given)
+
+    m, t = matrix.magazin_ids, matrix.tovar_ids
+    return RebalancePlan(m[src], m[dst], t[tov], qty, m[i], t[j], given[i, j])
+
+
+@transaction.atomic
+def create_transfer_drafts(plan: RebalancePlan, user=None) -> list[Peremeshchenie]:
+    """Сохраняет предложенные перемещения черновиками (по документу на пару магазинов)."""
+    docs = plan.transfer_docs()
+    today = timezone.localdate()
+    headers = Peremeshchenie.objects.bulk_create([
+        Peremeshchenie(
+            id_magazin_iz_id=src, id_magazin_v_id=dst, data=today, created_by=user,
+            comment="Предложено планировщиком перемещений",
+        )
+        for (src, dst), _ in docs
+    ])
+    PeremeshchenieItem.objects.bulk_create([
+        PeremeshchenieItem(id_peremeshchenie=h, id_tovar_id=tid, kolichestvo=qty)
+        for h, (_, items) in zip(headers, docs)
+        for tid, qty in items
+    ], batch_size=5000)
+    return headers
+
+
+# ===== Автопополнение =====
+
+@dataclass
+class ReplenishPlan:
+    # что заказать с центрального склада: параллельные массивы (магазин, товар, количество)
+    magazin: np.ndarray
+    tovar: np.ndarray
+    qty: np.ndarray
+
+    def zayavka_docs(self):
+        """Черновики заявок: [(магазин, [(товар, количество)])]."""
+        return [(key[0], items) for key, items in _group((self.magazin,), self.tovar, self.qty)]
+
+
+def load_open_zayavki(matrix: StockMatrix) -> np.ndarray:
+    """(M, T): сколько уже заказано черновиками и отправленными заявками — одной выборкой."""
+    pending = np.zeros(matrix.stock.shape, dtype=np.int64)
+    rows = _fetch_array(
+        """
+        SELECT z.id_magazin, zi.id_tovar, SUM(COALESCE(zi.kolichestvo, 0))
+          FROM zayavka_item AS zi
+          JOIN zayavka AS z ON z.id = zi.id_zayavka
+         WHERE z.status IN (%s, %s)
+         GROUP BY z.id_magazin, zi.id_tovar
+        """,
+        [Zayavka.Status.DRAFT, Zayavka.Status.SENT], 3,
+    )
+    if len(rows):
+        i = np.searchsorted(matrix.magazin_ids, rows[:, 0])
+        j = np.searchsorted(matrix.tovar_ids, rows[:, 1])
+        np.add.at(pending, (i, j), rows[:, 2].astype(np.int64))
+    return pending
+
+
+def plan_replenishment(matrix: StockMatrix, cover_days: float = 14, pending: np.ndarray | None = None) -> ReplenishPlan:
+    """
+    Цель — запас на cover_days дней продаж, но не ниже неснижаемого остатка.
+    Заказ = цель - остаток - уже заказанное (pending), если положителен.
+    """
+    target = np.maximum(np.ceil(matrix.velocity * cover_days).astype(np.int64), matrix.minimum)
+    need = target - matrix.stock
+    if pending is not None:
+        need -= pending
+    i, j = np.nonzero(need > 0)
+    return ReplenishPlan(matrix.magazin_ids[i], matrix.tovar_ids[j], need[i, j])
+
+
+@transaction.atomic
+def create_replenishment_drafts(plan: ReplenishPlan, cover_days: float, user=None) -> list[Zayavka]:
+    """Сохраняет заказ черновиками заявок (по заявке на магазин) двумя bulk_create."""
+    docs = plan.zayavka_docs()
+    today = timezone.localdate()
+    headers = Zayavka.objects.bulk_create([
+        Zayavka(
+            id_magazin_id=mid, data_zayavki=today, status=Zayavka.Status.DRAFT, created_by=user,
+            comment=f"Автопополнение: запас на {cover_days:g} дн.",
+        )
+        for mid, _ in docs
+    ])
+    ZayavkaItem.objects.bulk_create([
+        ZayavkaItem(id_zayavka=h, id_tovar_id=tid, kolichestvo=qty)
+        for h, (_, items) in zip(headers, docs)
+        for tid, qty in items
+    ], batch_size=5000)
+    return headers
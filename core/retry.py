@@ -0,0 +1,88 @@
+"""
+Повтор складских транзакций при взаимной блокировке и ошибке сериализации.
+
+PostgreSQL при deadlock (40P01) откатывает одну из транзакций, а на уровнях
+REPEATABLE READ / SERIALIZABLE при конфликте (40001) — ту, что проиграла.
+Обе ошибки безопасно лечатся повтором транзакции целиком, поэтому
+@retry_on_conflict заменяет @transaction.atomic у функций проведения:
+повтор возможен только для внешней транзакции, внутри чужой функция
+выполняется как обычный atomic (точка сохранения) — повторит внешняя.
+
+Число повторов по имени функции считается в core.metrics ("tx_retry"),
+исчерпанные попытки — в "tx_retry_exhausted"; длительность транзакции и
+удержание блокировок — в core/lock_stats.py.
+"""
+import functools
+import random
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+
+from . import metrics
+from .lock_stats import transaction_stats
+
+RETRY_PGCODES = {"40P01", "40001"}   # deadlock_detected, serialization_failure
+
+ISOLATION_LEVELS = {
+    "read committed": "READ COMMITTED",
+    "repeatable read": "REPEATABLE READ",
+    "serializable": "SERIALIZABLE",
+}
+
+
+def _pgcode(exc) -> str | None:
+    cause = exc.__cause__
+    return getattr(cause, "pgcode", None) or getattr(cause, "sqlstate", None)
+
+
+def is_retryable(exc) -> bool:
+    return isinstance(exc, DatabaseError) and _pgcode(exc) in RETRY_PGCODES
+
+
+def _conf() -> dict:
+    return getattr(settings, "STOCK_TX_RETRY", {})
+
+
+def retry_on_conflict(name: str | None = None, attempts: int | None = None, isolation: str | None = None):
+    """
+    Выполняет функцию в транзакции и повторяет её при 40P01/40001.
+
+    attempts  — всего попыток (по умолчанию STOCK_TX_RETRY["ATTEMPTS"]);
+    isolation — уровень изоляции внешней транзакции: "repeatable read" / "serializable"
+                (по умолчанию STOCK_TX_RETRY["ISOLATION"], пусто — уровень сервера).
+    Пауза между попытками — экспоненциальная с полным разбросом (full jitter).
+    """
+    def decorator(fn):
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if connection.in_atomic_block:
+                with transaction.atomic():
+                    return fn(*args, **kwargs)
+
+            conf = _conf()
+            total = attempts or conf.get("ATTEMPTS", 5)
+            level = isolation or conf.get("ISOLATION")
+            base = conf.get("BASE_MS", 20) / 1000
+            cap = conf.get("MAX_MS", 500) / 1000
+
+            for attempt in range(1, total + 1):
+                try:
+                    with transaction_stats(label), transaction.atomic():
+                        if level:
+                            with connection.cursor() as cur:
+                                cur.execute(f"SET TRANSACTION ISOLATION LEVEL {ISOLATION_LEVELS[level.lower()]}")
+                        return fn(*args, **kwargs)
+                except DatabaseError as e:
+                    if not is_retryable(e):
+                        raise
+                    if attempt == total:
+                        metrics.incr("tx_retry_exhausted", label)
+                        raise
+                    metrics.incr("tx_retry", label)
+                    time.sleep(random.uniform(0, min(cap, base * 2 ** (attempt - 1))))
+
+        return wrapper
+    return decorator
@@ -1,98 +1,2016 @@
-from django.db import transaction
-from django.db.models import F
-from core.models import Zayavka, ZayavkaItem, Tovar, MagazinTovar
-from django.db import transaction
-from django.db.models import F
-from django.db.models.functions import Coalesce
-from .models import MagazinTovar, TovarVyruchka, Vyruchka
+import csv
+import hashlib
+import io
+import json
+import secrets
+from datetime import date, datetime, time, timedelta
+
+from django.core.cache import cache
+from django.db import DataError, connection, transaction
+from django.db.models import F, OuterRef, Subquery, Sum
 from django.db.models.functions import Coalesce
+from django.utils import timezone
 
-class ZayavkaApproveError(Exception):
-    pass
+from .lock_stats import locking
+from .retry import is_retryable, retry_on_conflict
+from .models import (
+    Zayavka, ZayavkaItem, ZayavkaApproveJob, StockMovement, StockSnapshot, TovarStripe,
+    Inventarizaciya, InventarizaciyaItem, Peremeshchenie, Tovar, TovarVyruchka, UserProfile, Vyruchka,
+)
 
-@transaction.atomic
-def approve_zayavka(z: Zayavka):
-    z = Zayavka.objects.select_for_update().get(pk=z.pk)
 
-    if z.status == Zayavka.Status.APPROVED:
+def _values_sql(rows):
+    """
+    Собирает список VALUES для raw SQL.
+    [(1, 5), (2, 7)] -> ("(%s, %s), (%s, %s)", [1, 5, 2, 7])
+    """
+    rows = list(rows)
+    row_sql = "(" + ", ".join(["%s"] * len(rows[0])) + ")"
+    params = [v for r in rows for v in r]
+    return ", ".join([row_sql] * len(rows)), params
+
+
+def _apply_central_delta(delta_by_tovar: dict[int, int]):
+    """
+    Изменяет остатки центрального склада одним запросом.
+    delta > 0 -> приход, delta < 0 -> списание.
+    Для товаров с под-счётчиками (tovar_stripe) delta пишется в случайный
+    под-счётчик, для остальных — сразу в tovar.kolichestvo_na_sklade.
+    Строки tovar блокируются по id (CTE lk) до того, как оператор коснётся
+    под-счётчиков и tovar, — как у остальных писателей центрального склада.
+    """
+    rows = sorted((tid, delta) for tid, delta in delta_by_tovar.items() if delta)
+    if not rows:
         return
-    if z.status != Zayavka.Status.SENT:
-        raise ZayavkaApproveError("Проведение возможно только из статуса 'Отправлена'")
+    values, params = _values_sql(rows)
+    with connection.cursor() as cur:
+        cur.execute(
+            f"""
+            WITH v(id_tovar, delta) AS (VALUES {values}),
+            lk AS MATERIALIZED (
+                SELECT t.id FROM tovar AS t
+                 WHERE t.id IN (SELECT id_tovar FROM v)
+                 ORDER BY t.id
+                   FOR NO KEY UPDATE OF t
+            ),
+            pick AS (
+                -- random() делает CTE материализуемым: под-счётчик выбирается один раз на товар
+                SELECT v.id_tovar, v.delta, floor(random() * s.n)::int AS stripe
+                  FROM v
+                  JOIN (SELECT id_tovar, COUNT(*) AS n
+                          FROM tovar_stripe
+                         WHERE id_tovar IN (SELECT id_tovar FROM v)
+                         GROUP BY id_tovar) AS s ON s.id_tovar = v.id_tovar
+                 WHERE (SELECT COUNT(*) FROM lk) >= 0
+            ),
+            striped AS (
+                UPDATE tovar_stripe AS ts
+                   SET delta = ts.delta + pick.delta
+                  FROM pick
+                 WHERE ts.id_tovar = pick.id_tovar AND ts.stripe = pick.stripe
+                RETURNING ts.id_tovar
+            )
+            UPDATE tovar AS t
+               SET kolichestvo_na_sklade = COALESCE(t.kolichestvo_na_sklade, 0) + v.delta
+              FROM v
+             WHERE t.id = v.id_tovar
+               AND t.id NOT IN (SELECT id_tovar FROM striped)
+               AND (SELECT COUNT(*) FROM lk) >= 0
+            """,
+            params,
+        )
 
-    items = list(ZayavkaItem.objects.select_for_update().filter(id_zayavka=z).select_related("id_tovar"))
-    if not items:
-        raise ZayavkaApproveError("В заявке нет позиций")
 
-    # проверка остатков на центральном складе
-    for it in items:
-        qty = int(it.kolichestvo or 0)
-        if qty <= 0:
-            continue
-        t = it.id_tovar
-        stock = int(t.kolichestvo_na_sklade or 0)
-        if stock < qty:
-            raise ZayavkaApproveError(f"Недостаточно товара '{t.nazvanie}' на центральном складе")
-
-    # списание/зачисление
-    for it in items:
-        qty = int(it.kolichestvo or 0)
-        if qty <= 0:
-            continue
+def central_stock_expr():
+    """
+    Выражение для annotate() по Tovar: остаток центрального склада
+    с учётом под-счётчиков.
+    """
+    stripes = (TovarStripe.objects
+               .filter(id_tovar=OuterRef("pk"))
+               .values("id_tovar")
+               .annotate(s=Sum("delta"))
+               .values("s"))
+    return Coalesce(F("kolichestvo_na_sklade"), 0) + Coalesce(Subquery(stripes), 0)
 
-        Tovar.objects.filter(pk=it.id_tovar_id).update(
-            kolichestvo_na_sklade=Coalesce(F("kolichestvo_na_sklade"), 0) - qty
+
+def _lock_central_stock(tovar_ids) -> dict:
+    """
+    Блокирует строки tovar (в порядке id) и возвращает {tovar_id: (nazvanie, остаток)}
+    с учётом под-счётчиков. Режим FOR NO KEY UPDATE — тот же, что берёт UPDATE:
+    он не ждёт проверок внешних ключей (FOR KEY SHARE) у вставок поставок и движений.
+    Остаток читается отдельным запросом уже после блокировки: в READ COMMITTED
+    запрос, дождавшийся FOR UPDATE, перечитывает только заблокированную строку tovar,
+    а подзапрос по tovar_stripe остался бы на старом снимке — списания через
+    под-счётчик tovar не меняют, и второй проводящий увидел бы устаревшую сумму.
+    """
+    tovar_ids = sorted(set(tovar_ids))
+    if not tovar_ids:
+        return {}
+    with connection.cursor() as cur:
+        with locking("tovar") as locked:
+            cur.execute(
+                "SELECT t.id FROM tovar AS t WHERE t.id = ANY(%s) ORDER BY t.id FOR NO KEY UPDATE OF t",
+                [tovar_ids],
+            )
+            locked += [(None, tid) for (tid,) in cur.fetchall()]
+        cur.execute(
+            """
+            SELECT t.id, t.nazvanie,
+                   COALESCE(t.kolichestvo_na_sklade, 0)
+                   + COALESCE((SELECT SUM(s.delta) FROM tovar_stripe AS s WHERE s.id_tovar = t.id), 0)
+              FROM tovar AS t
+             WHERE t.id = ANY(%s)
+            """,
+            [tovar_ids],
         )
+        return {tid: (name, qty) for tid, name, qty in cur.fetchall()}
+
+
+# Все, кто пишет в magazin_tovar, блокируют строки в одном порядке — (id_magazin, id_tovar),
+# поэтому складские операции не могут взаимно заблокироваться на этой таблице.
+# CTE lk блокирует существующие строки пар из v(id_magazin, id_tovar, ...) в этом порядке;
+# оператор ставит условие _LOCKED_MAGAZIN — COUNT(*) вычисляется один раз до первой
+# строки и дочитывает lk, так что UPDATE / upsert (они берут блокировки в порядке
+# своего плана) касаются уже заблокированных строк.
+_LOCK_MAGAZIN_CTE = """
+    lk AS MATERIALIZED (
+        SELECT mt.id
+          FROM magazin_tovar AS mt
+          JOIN v ON v.id_magazin = mt.id_magazin AND v.id_tovar = mt.id_tovar
+         ORDER BY mt.id_magazin, mt.id_tovar
+           FOR UPDATE OF mt
+    )"""
+_LOCKED_MAGAZIN = "(SELECT COUNT(*) FROM lk) >= 0"
+
+
+def _credit_magazin_stock(rows):
+    """
+    Зачисляет товар на склады магазинов одним INSERT ... ON CONFLICT DO UPDATE.
+    rows: [(magazin_id, tovar_id, qty)]; недостающие строки magazin_tovar создаются.
+    Существующие строки блокируются в общем порядке (_LOCK_MAGAZIN_CTE), новые
+    вставляются в том же порядке.
+    """
+    rows = sorted((mid, tid, qty) for mid, tid, qty in rows if qty)
+    if not rows:
+        return
+    values, params = _values_sql(rows)
+    with connection.cursor() as cur:
+        cur.execute(
+            f"""
+            WITH v(id_magazin, id_tovar, qty) AS (VALUES {values}),
+            {_LOCK_MAGAZIN_CTE}
+            INSERT INTO magazin_tovar (id_magazin, id_tovar, kolichestvo)
+            SELECT v.id_magazin, v.id_tovar, v.qty
+              FROM v
+             WHERE {_LOCKED_MAGAZIN}
+             ORDER BY v.id_magazin, v.id_tovar
+            ON CONFLICT (id_magazin, id_tovar) DO UPDATE
+               SET kolichestvo = COALESCE(magazin_tovar.kolichestvo, 0) + EXCLUDED.kolichestvo
+            """,
+            params,
+        )
+    _magazin_stock_changed((mid, tid) for mid, tid, _ in rows)
+
+
+def _lock_magazin_stock(keys) -> dict:
+    """
+    Блокирует строки magazin_tovar для пар (magazin_id, tovar_id) одним запросом
+    в общем порядке (id_magazin, id_tovar) — том же, что у _LOCK_MAGAZIN_CTE.
+    Возвращает {(magazin_id, tovar_id): остаток}; отсутствующих строк в ответе нет.
+    """
+    keys = sorted(set(keys))
+    if not keys:
+        return {}
+    values, params = _values_sql(keys)
+    with connection.cursor() as cur, locking("magazin_tovar") as locked:
+        cur.execute(
+            f"""
+            SELECT mt.id_magazin, mt.id_tovar, COALESCE(mt.kolichestvo, 0)
+              FROM magazin_tovar AS mt
+              JOIN (VALUES {values}) AS v(id_magazin, id_tovar)
+                ON v.id_magazin = mt.id_magazin AND v.id_tovar = mt.id_tovar
+             ORDER BY mt.id_magazin, mt.id_tovar
+               FOR UPDATE OF mt
+            """,
+            params,
+        )
+        stock = {(mid, tid): current for mid, tid, current in cur.fetchall()}
+        locked += stock
+    return stock
+
+
+def _debit_magazin_stock(rows):
+    """
+    Списывает товар со складов магазинов одним UPDATE ... FROM (VALUES ...).
+    rows: [(magazin_id, tovar_id, qty)]; остатки должны быть заранее проверены
+    под блокировкой (_lock_magazin_stock).
+    """
+    rows = sorted((mid, tid, qty) for mid, tid, qty in rows if qty)
+    if not rows:
+        return
+    values, params = _values_sql(rows)
+    with connection.cursor() as cur:
+        cur.execute(
+            f"""
+            WITH v(id_magazin, id_tovar, delta) AS (VALUES {values}),
+            {_LOCK_MAGAZIN_CTE}
+            UPDATE magazin_tovar AS mt
+               SET kolichestvo = COALESCE(mt.kolichestvo, 0) - v.delta
+              FROM v
+             WHERE mt.id_magazin = v.id_magazin AND mt.id_tovar = v.id_tovar
+               AND {_LOCKED_MAGAZIN}
+            """,
+            params,
+        )
+    _magazin_stock_changed((mid, tid) for mid, tid, _ in rows)
+
+
+STOCK_CHANNEL = "stock_changed"
+NOTIFY_PAYLOAD_MAX = 7900     # лимит payload NOTIFY — 8000 байт
+
 
-        mt, _ = MagazinTovar.objects.get_or_create(
-            id_magazin=z.id_magazin, id_tovar=it.id_tovar,
-            defaults={"kolichestvo": 0}
+def _magazin_stock_changed(keys):
+    """Общий хвост всех изменений magazin_tovar: низкие остатки + уведомление кэша остатков."""
+    keys = sorted(set(keys))
+    refresh_stock_alerts(keys)
+    notify_stock_changed(keys)
+
+
+def notify_stock_changed(keys):
+    """
+    Сообщает процессам с кэшем остатков (core/stock_cache.py), какие позиции
+    magazin_tovar изменились: payload — "magazin:tovar,magazin:tovar,...".
+    NOTIFY транзакционен — уведомление уходит только после COMMIT, при откате
+    не уходит вовсе. Длинные списки режутся на несколько уведомлений.
+    """
+    payloads, buf, size = [], [], 0
+    for mid, tid in sorted(set(keys)):
+        part = f"{mid}:{tid}"
+        if buf and size + len(part) + 1 > NOTIFY_PAYLOAD_MAX:
+            payloads.append(",".join(buf))
+            buf, size = [], 0
+        buf.append(part)
+        size += len(part) + 1
+    if buf:
+        payloads.append(",".join(buf))
+    if not payloads:
+        return
+    with connection.cursor() as cur:
+        cur.execute("SELECT pg_notify(%s, p) FROM unnest(%s::text[]) AS p", [STOCK_CHANNEL, payloads])
+
+
+def refresh_stock_alerts(keys):
+    """
+    Пересчитывает «низкие остатки» только по изменившимся позициям
+    keys: [(magazin_id, tovar_id)]. Один оператор закрывает открытые записи stock_alert,
+    где остаток поднялся до минимума, и открывает новые, где опустился ниже.
+    Позиции без min_kolichestvo не проверяются.
+    """
+    keys = sorted(set(keys))
+    if not keys:
+        return
+    values, params = _values_sql(keys)
+    with connection.cursor() as cur:
+        cur.execute(
+            f"""
+            WITH cur AS (
+                SELECT mt.id_magazin, mt.id_tovar, mt.kolichestvo AS qty, mt.min_kolichestvo AS min_qty
+                  FROM magazin_tovar AS mt
+                  JOIN (VALUES {values}) AS v(id_magazin, id_tovar)
+                    ON mt.id_magazin = v.id_magazin AND mt.id_tovar = v.id_tovar
+                 WHERE mt.min_kolichestvo IS NOT NULL
+            ),
+            closed AS (
+                UPDATE stock_alert AS a
+                   SET closed_at = now()
+                  FROM cur
+                 WHERE a.closed_at IS NULL
+                   AND a.id_magazin = cur.id_magazin AND a.id_tovar = cur.id_tovar
+                   AND cur.qty >= cur.min_qty
+            )
+            INSERT INTO stock_alert (id_magazin, id_tovar, kolichestvo, min_kolichestvo, opened_at)
+            SELECT cur.id_magazin, cur.id_tovar, cur.qty, cur.min_qty, now()
+              FROM cur
+             WHERE cur.qty < cur.min_qty
+            ON CONFLICT (id_magazin, id_tovar) WHERE closed_at IS NULL DO NOTHING
+            """,
+            params,
         )
-        MagazinTovar.objects.filter(pk=mt.pk).update(
-            kolichestvo=Coalesce(F("kolichestvo"), 0) + qty
+
+
+def _record_movements(doc_type: str, rows):
+    """
+    Пишет движения в журнал stock_movement одним bulk-insert'ом.
+    rows: [(doc_id, magazin_id | None, tovar_id, qty)]; magazin_id = None — центральный склад.
+    """
+    StockMovement.objects.bulk_create([
+        StockMovement(doc_type=doc_type, doc_id=doc_id, id_magazin_id=mid, id_tovar_id=tid, kolichestvo=qty)
+        for doc_id, mid, tid, qty in rows
+        if qty
+    ])
+
+
+class ZayavkaApproveError(Exception):
+    def __init__(self, message, shortfalls=None):
+        super().__init__(message)
+        # [(tovar_id, nazvanie, ostatok, nuzhno)] — по всем позициям сразу
+        self.shortfalls = shortfalls or []
+
+
+def _shortfall_message(shortfalls) -> str:
+    parts = [f"'{name}' (остаток {stock}, нужно {qty})" for _, name, stock, qty in shortfalls]
+    return "Недостаточно товара на центральном складе: " + "; ".join(parts)
+
+
+def _approve_locked(pks) -> dict:
+    """
+    Проводит набор заявок в текущей транзакции.
+    Все затронутые строки блокируются один раз на набор, каждая таблица — в общем
+    для всех складских операций порядке: zayavka и tovar — по id, magazin_tovar —
+    по (id_magazin, id_tovar) (_LOCK_MAGAZIN_CTE), поэтому параллельные проведения
+    не могут взаимно заблокироваться. Возвращает {zayavka_id: None | ZayavkaApproveError}.
+    """
+    zayavki = list(Zayavka.objects.select_for_update().filter(pk__in=pks).order_by("pk"))
+    result = {}
+    pending = []
+    for z in zayavki:
+        if z.status == Zayavka.Status.APPROVED:
+            result[z.pk] = None
+        elif z.status != Zayavka.Status.SENT:
+            result[z.pk] = ZayavkaApproveError("Проведение возможно только из статуса 'Отправлена'")
+        else:
+            pending.append(z)
+    if not pending:
+        return result
+
+    items_by_z = {z.pk: [] for z in pending}
+    for zid, tid, qty in (ZayavkaItem.objects
+                          .filter(id_zayavka__in=items_by_z)
+                          .order_by("id_tovar_id")
+                          .values_list("id_zayavka_id", "id_tovar_id", "kolichestvo")):
+        items_by_z[zid].append((tid, int(qty or 0)))
+
+    tovar_ids = sorted({tid for items in items_by_z.values() for tid, qty in items if qty > 0})
+    pairs = sorted({(z.id_magazin_id, tid) for z in pending for tid, qty in items_by_z[z.pk] if qty > 0})
+    stock, names = {}, {}
+    for tid, (name, qty) in _lock_central_stock(tovar_ids).items():
+        stock[tid], names[tid] = qty, name
+    with connection.cursor() as cur:
+        if pairs:
+            values, params = _values_sql(pairs)
+            with locking("magazin_tovar") as locked:
+                cur.execute(
+                    f"""
+                    SELECT mt.id_magazin, mt.id_tovar
+                      FROM magazin_tovar AS mt
+                      JOIN (VALUES {values}) AS v(id_magazin, id_tovar)
+                        ON mt.id_magazin = v.id_magazin AND mt.id_tovar = v.id_tovar
+                     ORDER BY mt.id_magazin, mt.id_tovar
+                       FOR UPDATE OF mt
+                    """,
+                    params,
+                )
+                locked += cur.fetchall()
+
+    # проверка остатков — заявки «расходуют» склад по очереди, в порядке id
+    debit, credit, approved, movements = {}, {}, [], []
+    for z in pending:
+        items = [(tid, qty) for tid, qty in items_by_z[z.pk] if qty > 0]
+        if not items_by_z[z.pk]:
+            result[z.pk] = ZayavkaApproveError("В заявке нет позиций")
+            continue
+        shortfalls = [(tid, names[tid], stock[tid], qty) for tid, qty in items if stock[tid] < qty]
+        if shortfalls:
+            result[z.pk] = ZayavkaApproveError(_shortfall_message(shortfalls), shortfalls)
+            continue
+        for tid, qty in items:
+            stock[tid] -= qty
+            debit[tid] = debit.get(tid, 0) - qty
+            key = (z.id_magazin_id, tid)
+            credit[key] = credit.get(key, 0) + qty
+            movements += [(z.pk, None, tid, -qty), (z.pk, z.id_magazin_id, tid, qty)]
+        approved.append(z.pk)
+        result[z.pk] = None
+
+    # списание/зачисление — по одному запросу на весь набор
+    _apply_central_delta(debit)
+    _credit_magazin_stock((mid, tid, qty) for (mid, tid), qty in credit.items())
+    _record_movements(StockMovement.DocType.ZAYAVKA, movements)
+    if approved:
+        Zayavka.objects.filter(pk__in=approved).update(status=Zayavka.Status.APPROVED)
+    return result
+
+
+@retry_on_conflict("approve_zayavka")
+def approve_zayavka(z: Zayavka):
+    """
+    Проводит заявку фиксированным числом запросов независимо от числа позиций.
+    """
+    error = _approve_locked([z.pk]).get(z.pk)
+    if error is not None:
+        raise error
+
+
+def approve_zayavki(pks, chunk_size: int | None = None) -> dict:
+    """
+    Массовое проведение заявок. Каждая порция (по умолчанию — все сразу)
+    проводится в одной транзакции; ошибка по одной заявке не мешает остальным.
+    Возвращает {zayavka_id: None | ZayavkaApproveError} в порядке id.
+    """
+    pks = sorted(set(int(pk) for pk in pks))
+    step = chunk_size or len(pks) or 1
+    result = {}
+    approve_chunk = retry_on_conflict("approve_zayavki")(_approve_locked)
+    for i in range(0, len(pks), step):
+        result.update(approve_chunk(pks[i:i + step]))
+    return dict(sorted(result.items()))
+
+# ===== Распределение дефицита между заявками =====
+
+def _fair_share(total: int, want: list[int], weight: list[float]) -> list[int]:
+    """
+    Делит total единиц между запросами want пропорционально weight, не выдавая
+    никому больше, чем он просил: кто упёрся в свой запрос, выбывает, а остаток
+    делится между остальными заново. Целые единицы — методом наибольшего остатка
+    (при равенстве — тому, кто раньше в списке).
+    """
+    alloc = [0] * len(want)
+    active = [i for i, w in enumerate(want) if w > 0]
+    left = total
+    while active and left > 0:
+        wsum = sum(weight[i] for i in active)
+        share = {i: left * (weight[i] / wsum if wsum > 0 else 1 / len(active)) for i in active}
+        capped = [i for i in active if share[i] >= want[i] - alloc[i]]
+        if capped:
+            for i in capped:
+                left -= want[i] - alloc[i]
+                alloc[i] = want[i]
+            active = [i for i in active if i not in capped]
+            continue
+        base = {i: int(share[i]) for i in active}
+        for i in active:
+            alloc[i] += base[i]
+        rest = left - sum(base.values())
+        for i in sorted(active, key=lambda i: base[i] - share[i])[:rest]:
+            alloc[i] += 1
+        break
+    return alloc
+
+
+@retry_on_conflict("consolidate_zayavki")
+def consolidate_zayavki(rule: str = "demand", days: int = 28) -> dict:
+    """
+    Проводит все отправленные заявки сети одним проходом.
+
+    Спрос по товарам считается одним GROUP BY и сравнивается с остатком центрального
+    склада (строки tovar блокируются сразу, в порядке id). Где спроса больше остатка,
+    остаток делится между заявками (_fair_share):
+      rule="demand"   — пропорционально запрошенному количеству;
+      rule="velocity" — пропорционально продажам магазина за days дней
+                        (+1, чтобы магазин без продаж не остался совсем без товара).
+    Урезанные строки сохраняют исходный запрос в kolichestvo_zaprosheno, после чего
+    все заявки проводятся одним _approve_locked. Заявки, которым по всем позициям
+    досталось 0, не меняются и остаются отправленными.
+
+    Возвращает {"approved": [id], "postponed": [id], "errors": {id: ошибка},
+                "cut": [(zayavka_id, tovar_id, запрошено, выдано)]}.
+    """
+    if rule not in ("demand", "velocity"):
+        raise ValueError(f"Неизвестное правило распределения: {rule}")
+
+    pks = list(Zayavka.objects.select_for_update()
+               .filter(status=Zayavka.Status.SENT)
+               .order_by("pk")
+               .values_list("pk", flat=True))
+    result = {"approved": [], "postponed": [], "errors": {}, "cut": []}
+    if not pks:
+        return result
+
+    with connection.cursor() as cur:
+        cur.execute(
+            """
+            SELECT id_tovar, SUM(kolichestvo)
+              FROM zayavka_item
+             WHERE id_zayavka = ANY(%s) AND kolichestvo > 0
+             GROUP BY id_tovar
+            """,
+            [pks],
         )
+        demand = dict(cur.fetchall())
+        stock = _lock_central_stock(demand)
+        supply = {tid: max(qty, 0) for tid, (_, qty) in stock.items() if demand[tid] > qty}
+
+        lines = []
+        if supply:
+            cur.execute(
+                """
+                SELECT zi.id, zi.id_zayavka, z.id_magazin, zi.id_tovar, zi.kolichestvo
+                  FROM zayavka_item AS zi
+                  JOIN zayavka AS z ON z.id = zi.id_zayavka
+                 WHERE zi.id_zayavka = ANY(%s) AND zi.id_tovar = ANY(%s) AND zi.kolichestvo > 0
+                 ORDER BY zi.id_tovar, zi.id_zayavka
+                """,
+                [pks, list(supply)],
+            )
+            lines = cur.fetchall()
+
+        sold = {}
+        if lines and rule == "velocity":
+            cur.execute(
+                """
+                SELECT v.id_magazin, tv.id_tovar, SUM(COALESCE(tv.kolichestvo, 0))
+                  FROM tovar_vyruchka AS tv
+                  JOIN vyruchka AS v ON v.id = tv.id_vyruchka AND v.data = tv.data
+                 WHERE tv.data >= %(since)s AND v.data >= %(since)s
+                   AND tv.id_tovar = ANY(%(tovary)s) AND v.id_magazin = ANY(%(magaziny)s)
+                 GROUP BY v.id_magazin, tv.id_tovar
+                """,
+                {"since": timezone.localdate() - timedelta(days=days), "tovary": list(supply),
+                 "magaziny": list({mid for _, _, mid, _, _ in lines if mid})},
+            )
+            sold = {(mid, tid): qty for mid, tid, qty in cur.fetchall()}
+
+    # распределение по каждому дефицитному товару
+    given = {}
+    by_tovar = {}
+    for line in lines:
+        by_tovar.setdefault(line[3], []).append(line)
+    for tid, rows in by_tovar.items():
+        want = [qty for *_, qty in rows]
+        if rule == "velocity":
+            weight = [sold.get((mid, tid), 0) + 1 for _, _, mid, _, _ in rows]
+        else:
+            weight = want
+        for (item_id, zid, _, _, qty), got in zip(rows, _fair_share(supply[tid], want, weight)):
+            given[item_id] = (zid, tid, qty, got)
+
+    # заявка, которой по дефицитным товарам не досталось ничего, а других позиций нет, — ждёт
+    has_other = set(ZayavkaItem.objects
+                    .filter(id_zayavka__in=pks, kolichestvo__gt=0)
+                    .exclude(id_tovar__in=list(supply))
+                    .values_list("id_zayavka_id", flat=True))
+    got_any = {zid for zid, _, _, got in given.values() if got > 0}
+    postponed = {zid for zid, _, _, _ in given.values()} - got_any - has_other
+
+    cut = [(item_id, zid, tid, qty, got) for item_id, (zid, tid, qty, got) in given.items()
+           if got < qty and zid not in postponed]
+    if cut:
+        values, params = _values_sql([(item_id, got) for item_id, _, _, _, got in cut])
+        with connection.cursor() as cur:
+            cur.execute(
+                f"""
+                UPDATE zayavka_item AS zi
+                   SET kolichestvo_zaprosheno = COALESCE(zi.kolichestvo_zaprosheno, zi.kolichestvo),
+                       kolichestvo = v.got
+                  FROM (VALUES {values}) AS v(id, got)
+                 WHERE zi.id = v.id
+                """,
+                params,
+            )
+
+    for pk, error in _approve_locked([pk for pk in pks if pk not in postponed]).items():
+        if error is None:
+            result["approved"].append(pk)
+        else:
+            result["errors"][pk] = error
+    result["postponed"] = sorted(postponed)
+    result["cut"] = sorted((zid, tid, qty, got) for _, zid, tid, qty, got in cut)
+    return result
+
+
+# ===== Фоновое проведение заявок =====
+
+def enqueue_zayavka_approval(z: Zayavka, user=None) -> ZayavkaApproveJob:
+    """Ставит заявку в очередь на проведение (повторно не ставит, если уже ждёт)."""
+    job = ZayavkaApproveJob.objects.filter(id_zayavka=z, status=ZayavkaApproveJob.Status.PENDING).first()
+    if job is None:
+        job = ZayavkaApproveJob.objects.create(id_zayavka=z, created_by=user)
+    return job
+
+
+@retry_on_conflict("run_approval_job")
+def run_approval_job() -> ZayavkaApproveJob | None:
+    """
+    Берёт одно задание из очереди (SELECT ... FOR UPDATE SKIP LOCKED) и проводит заявку.
+    Задание и проведение — одна транзакция: если процесс упадёт, задание останется в очереди,
+    а другие воркеры в это время берут следующие задания, не дожидаясь блокировки.
+    При взаимной блокировке задание берётся и проводится заново (core/retry.py);
+    любая другая ошибка проведения помечает задание FAILED с текстом ошибки —
+    иначе оно откатывалось бы в PENDING и выбиралось снова бесконечно.
+    Возвращает обработанное задание или None, если очередь пуста.
+    """
+    job = (ZayavkaApproveJob.objects
+           .select_for_update(skip_locked=True)
+           .filter(status=ZayavkaApproveJob.Status.PENDING)
+           .order_by("id")
+           .first())
+    if job is None:
+        return None
+
+    try:
+        # точка сохранения: при ошибке откатывается только проведение, задание остаётся
+        with transaction.atomic():
+            approve_zayavka(Zayavka(pk=job.id_zayavka_id))
+        job.status, job.error = ZayavkaApproveJob.Status.DONE, None
+    except ZayavkaApproveError as e:
+        job.status, job.error = ZayavkaApproveJob.Status.FAILED, str(e)
+    except Exception as e:
+        # deadlock / ошибку сериализации повторяет retry_on_conflict вместе с выбором задания
+        if is_retryable(e):
+            raise
+        job.status, job.error = ZayavkaApproveJob.Status.FAILED, f"{type(e).__name__}: {e}"
+    job.finished_at = timezone.now()
+    job.save(update_fields=["status", "error", "finished_at"])
+    return job
 
-    z.status = Zayavka.Status.APPROVED
-    z.save(update_fields=["status"])
 
 class StockError(Exception):
     pass
 
-@transaction.atomic
-def apply_vyruchka_stock(magazin_id: int, delta_by_tovar: dict[int, int]):
+@retry_on_conflict("apply_vyruchka_stock")
+def apply_vyruchka_stock(magazin_id: int, delta_by_tovar: dict[int, int], doc_id: int | None = None):
     """
     delta_by_tovar: {tovar_id: delta_qty}
     delta_qty > 0  -> СПИСАТЬ со склада магазина
     delta_qty < 0  -> ВЕРНУТЬ на склад магазина
+    doc_id — id выручки для журнала движения товара.
+
+    Все списания делаются одним условным UPDATE ... WHERE kolichestvo >= delta RETURNING
+    по строкам, заблокированным в общем порядке (_LOCK_MAGAZIN_CTE): строка, которой
+    нет в RETURNING, — это нехватка товара (предварительного чтения нет).
+    Возвраты зачисляются одним upsert'ом, недостающие строки создаются им же.
     """
     if not magazin_id:
         return
 
-    for tovar_id, delta in delta_by_tovar.items():
-        if not delta:
+    sales = sorted((magazin_id, tid, delta) for tid, delta in delta_by_tovar.items() if delta > 0)
+    returns = [(magazin_id, tid, -delta) for tid, delta in delta_by_tovar.items() if delta < 0]
+
+    if sales:
+        values, params = _values_sql(sales)
+        with connection.cursor() as cur:
+            # UPDATE сам берёт блокировки строк — ожидание замеряется на нём
+            with locking("magazin_tovar") as locked:
+                cur.execute(
+                    f"""
+                    WITH v(id_magazin, id_tovar, delta) AS (VALUES {values}),
+                    {_LOCK_MAGAZIN_CTE}
+                    UPDATE magazin_tovar AS mt
+                       SET kolichestvo = COALESCE(mt.kolichestvo, 0) - v.delta
+                      FROM v
+                     WHERE mt.id_magazin = v.id_magazin AND mt.id_tovar = v.id_tovar
+                       AND COALESCE(mt.kolichestvo, 0) >= v.delta
+                       AND {_LOCKED_MAGAZIN}
+                    RETURNING mt.id_tovar
+                    """,
+                    params,
+                )
+                done = {row[0] for row in cur.fetchall()}
+                locked += [(magazin_id, tid) for tid in done]
+
+            short = [(tid, delta) for _, tid, delta in sales if tid not in done]
+            if short:
+                # только на пути ошибки: читаем остатки, чтобы показать их в сообщении
+                cur.execute(
+                    """
+                    SELECT t.id, t.nazvanie, COALESCE(mt.kolichestvo, 0)
+                      FROM tovar AS t
+                      LEFT JOIN magazin_tovar AS mt ON mt.id_tovar = t.id AND mt.id_magazin = %s
+                     WHERE t.id = ANY(%s)
+                    """,
+                    [magazin_id, [tid for tid, _ in short]],
+                )
+                info = {tid: (name, current) for tid, name, current in cur.fetchall()}
+                parts = [
+                    f"'{info[tid][0]}' (остаток={info[tid][1]}, нужно={delta})"
+                    for tid, delta in short
+                ]
+                raise StockError("Недостаточно товара на складе магазина: " + "; ".join(parts))
+
+        _magazin_stock_changed((magazin_id, tid) for tid in done)
+
+    _credit_magazin_stock(returns)
+    _record_movements(
+        StockMovement.DocType.VYRUCHKA,
+        [(doc_id, magazin_id, tid, -delta) for tid, delta in delta_by_tovar.items()],
+    )
+
+
+@retry_on_conflict("post_vyruchka_batch")
+def post_vyruchka_batch(receipts) -> list:
+    """
+    Проводит пачку новых чеков одной транзакцией (групповая запись, core/group_commit.py).
+    receipts: [(Vyruchka, [TovarVyruchka])] — несохранённые объекты.
+
+    Строки magazin_tovar всей пачки блокируются одним запросом (в общем порядке,
+    _lock_magazin_stock), затем чеки проверяются по очереди поступления: чек,
+    которому не хватает остатка, отклоняется, остальные сохраняются bulk_create'ом,
+    а остатки списываются одним UPDATE по суммарной дельте.
+    Возвращает список той же длины: None — чек сохранён, StockError — отклонён.
+    """
+    need = []
+    for vyr, items in receipts:
+        # при повторе транзакции (core/retry.py) pk остались от откатанной попытки
+        vyr.pk = None
+        for it in items:
+            it.pk = None
+        qty = {}
+        for it in items:
+            qty[it.id_tovar_id] = qty.get(it.id_tovar_id, 0) + (it.kolichestvo or 0)
+        need.append({tid: q for tid, q in qty.items() if q > 0})
+
+    stock = _lock_magazin_stock(
+        (vyr.id_magazin_id, tid)
+        for (vyr, _), qty in zip(receipts, need) if vyr.id_magazin_id
+        for tid in qty
+    )
+
+    results = []
+    accepted = []
+    debit = {}
+    for (vyr, items), qty in zip(receipts, need):
+        mid = vyr.id_magazin_id
+        short = [(tid, stock.get((mid, tid), 0), q) for tid, q in qty.items()
+                 if mid and stock.get((mid, tid), 0) < q]
+        if short:
+            results.append(short)
             continue
+        if mid:
+            for tid, q in qty.items():
+                stock[(mid, tid)] -= q
+                debit[(mid, tid)] = debit.get((mid, tid), 0) + q
+        results.append(None)
+        accepted.append((vyr, items, qty))
+
+    Vyruchka.objects.bulk_create([vyr for vyr, _, _ in accepted])
+    lines = []
+    for vyr, items, _ in accepted:
+        for it in items:
+            it.id_vyruchka = vyr
+            it.data = vyr.data
+            lines.append(it)
+    TovarVyruchka.objects.bulk_create(lines)
+
+    _debit_magazin_stock((mid, tid, q) for (mid, tid), q in debit.items())
+    _record_movements(
+        StockMovement.DocType.VYRUCHKA,
+        [(vyr.pk, vyr.id_magazin_id, tid, -q) for vyr, _, qty in accepted if vyr.id_magazin_id
+         for tid, q in qty.items()],
+    )
 
-        # Блокируем строку magazin_tovar на время операции
-        mt = (MagazinTovar.objects
-              .select_for_update()
-              .filter(id_magazin_id=magazin_id, id_tovar_id=tovar_id)
-              .first())
+    names = dict(
+        Tovar.objects.filter(pk__in={tid for r in results if r for tid, _, _ in r})
+                     .values_list("pk", "nazvanie")
+    )
+    return [
+        None if r is None else StockError(
+            "Недостаточно товара на складе магазина: " + "; ".join(
+                f"'{names.get(tid)}' (остаток={current}, нужно={q})" for tid, current, q in r
+            )
+        )
+        for r in results
+    ]
+
+
+# ===== Итоги чеков =====
+
+def backfill_vyruchka_totals(batch: int = 10000) -> int:
+    """
+    Пересчитывает vyruchka.qty / amount / items_cnt по строкам чеков.
+    Текущие записи итоги ведут сами (триггеры tovar_vyruchka) — пересчёт нужен
+    для чеков, записанных до их появления, и как сверка. Идёт пачками по id,
+    каждая пачка — своя короткая транзакция; меняются только расходящиеся чеки.
+    Возвращает число исправленных чеков.
+    """
+    fixed = 0
+    last = 0
+    while True:
+        with transaction.atomic(), connection.cursor() as cur:
+            cur.execute(
+                "SELECT MAX(id) FROM (SELECT id FROM vyruchka WHERE id > %s ORDER BY id LIMIT %s) AS b",
+                [last, batch],
+            )
+            upto = cur.fetchone()[0]
+            if upto is None:
+                return fixed
+            cur.execute(
+                """
+                UPDATE vyruchka AS v
+                   SET qty = s.qty, amount = s.amount, items_cnt = s.cnt
+                  FROM (SELECT v.id,
+                               COALESCE(SUM(tv.kolichestvo), 0) AS qty,
+                               COALESCE(SUM(tv.summa), 0) AS amount,
+                               COUNT(tv.id) AS cnt
+                          FROM vyruchka AS v
+                          LEFT JOIN tovar_vyruchka AS tv ON tv.id_vyruchka = v.id AND tv.data = v.data
+                         WHERE v.id > %s AND v.id <= %s
+                         GROUP BY v.id) AS s
+                 WHERE v.id = s.id
+                   AND (v.qty, v.amount, v.items_cnt) IS DISTINCT FROM (s.qty, s.amount, s.cnt)
+                """,
+                [last, upto],
+            )
+            fixed += cur.rowcount
+        last = upto
+
+
+# ===== Помесячные секции выручки =====
 
-        if mt is None:
-            mt = MagazinTovar.objects.create(id_magazin_id=magazin_id, id_tovar_id=tovar_id, kolichestvo=0)
-            mt = (MagazinTovar.objects
-                  .select_for_update()
-                  .get(pk=mt.pk))
+# порядок важен: строки (tovar_vyruchka) ссылаются на чеки (vyruchka) по (id, data)
+VYRUCHKA_PARTITIONED = ("vyruchka", "tovar_vyruchka")
+PARTITION_LOCK_TIMEOUT = "5s"
 
-        current = int(mt.kolichestvo or 0)
 
-        if delta > 0 and current < delta:
-            raise StockError(f"Недостаточно товара на складе магазина (tovar_id={tovar_id}). Остаток={current}, нужно={delta}")
+def _add_months(d: date, n: int) -> date:
+    y, m = divmod(d.year * 12 + d.month - 1 + n, 12)
+    return date(y, m + 1, 1)
 
-        if delta > 0:
-            MagazinTovar.objects.filter(pk=mt.pk).update(
-                kolichestvo=Coalesce(F("kolichestvo"), 0) - delta
+
+def vyruchka_partition_name(table: str, month: date) -> str:
+    return f"{table}_y{month:%Y}m{month:%m}"
+
+
+def vyruchka_partitions() -> dict[str, list[date]]:
+    """{таблица: [первые числа месяцев подключённых секций]} — без секции DEFAULT."""
+    with connection.cursor() as cur:
+        cur.execute(
+            """
+            SELECT parent.relname,
+                   substring(pg_get_expr(child.relpartbound, child.oid) FROM 'FROM \(''([0-9-]+)''\)')::date
+              FROM pg_inherits AS i
+              JOIN pg_class AS parent ON parent.oid = i.inhparent
+              JOIN pg_class AS child ON child.oid = i.inhrelid
+             WHERE parent.relname = ANY(%s) AND parent.relnamespace = 'public'::regnamespace
+             ORDER BY 1, 2
+            """,
+            [list(VYRUCHKA_PARTITIONED)],
+        )
+        result = {table: [] for table in VYRUCHKA_PARTITIONED}
+        for table, month in cur.fetchall():
+            if month is not None:
+                result[table].append(month)
+        return result
+
+
+def _attach_month(cur, table: str, month: date) -> str:
+    """
+    Секция table за month: отдельная таблица, строки этого месяца из DEFAULT,
+    затем ATTACH PARTITION. ATTACH держит на родителе только SHARE UPDATE EXCLUSIVE
+    (CREATE TABLE ... PARTITION OF заблокировал бы его целиком), а CHECK с границами
+    избавляет ATTACH от проверочного прохода по новой секции.
+    """
+    name = vyruchka_partition_name(table, month)
+    bounds = [month, _add_months(month, 1)]
+    cur.execute(f'CREATE TABLE "{name}" (LIKE "{table}" INCLUDING DEFAULTS)')
+    cur.execute(f'ALTER TABLE "{name}" ADD CONSTRAINT "{name}_bound" CHECK (data >= %s AND data < %s)', bounds)
+    cur.execute(
+        f"""
+        WITH moved AS (DELETE FROM "{table}_default" WHERE data >= %s AND data < %s RETURNING *)
+        INSERT INTO "{name}" SELECT * FROM moved
+        """,
+        bounds,
+    )
+    cur.execute(f'ALTER TABLE "{table}" ATTACH PARTITION "{name}" FOR VALUES FROM (%s) TO (%s)', bounds)
+    cur.execute(f'ALTER TABLE "{name}" DROP CONSTRAINT "{name}_bound"')
+    return name
+
+
+def ensure_vyruchka_partitions(ahead: int = 3, today: date | None = None) -> list[str]:
+    """
+    Создаёт недостающие секции vyruchka/tovar_vyruchka с текущего месяца на ahead
+    месяцев вперёд. Каждый месяц — своя транзакция. Возвращает имена созданных секций.
+    """
+    month = (today or timezone.localdate()).replace(day=1)
+    existing = vyruchka_partitions()
+    created = []
+    for n in range(ahead + 1):
+        m = _add_months(month, n)
+        missing = [t for t in VYRUCHKA_PARTITIONED if m not in existing[t]]
+        if not missing:
+            continue
+        with transaction.atomic(), connection.cursor() as cur:
+            cur.execute("SET LOCAL lock_timeout = %s", [PARTITION_LOCK_TIMEOUT])
+            for table in missing:
+                created.append(_attach_month(cur, table, m))
+    return created
+
+
+def detach_vyruchka_partitions(keep_months: int, today: date | None = None) -> list[str]:
+    """
+    Отсоединяет секции месяцев старше keep_months полных месяцев до текущего.
+    Отсоединённые секции остаются обычными таблицами (архив: выгрузить или удалить
+    вручную) — чеки и строки в них в выручку и аналитику больше не попадают.
+    Итоги продаж месяца перед отсоединением сохраняются в vyruchka_arkhiv —
+    по ним сверка остатков (magazin_stock_diff) учитывает архивные продажи.
+    Возвращает имена отсоединённых секций.
+    """
+    cutoff = _add_months((today or timezone.localdate()).replace(day=1), -keep_months)
+    existing = vyruchka_partitions()
+    months = sorted({m for t in VYRUCHKA_PARTITIONED for m in existing[t] if m < cutoff})
+    detached = []
+    for m in months:
+        with transaction.atomic(), connection.cursor() as cur:
+            cur.execute("SET LOCAL lock_timeout = %s", [PARTITION_LOCK_TIMEOUT])
+            # секции месяца закрываются на запись до подсчёта итогов — иначе продажа,
+            # проведённая между подсчётом и DETACH, ушла бы в архив неучтённой
+            for table in VYRUCHKA_PARTITIONED:
+                if m in existing[table]:
+                    cur.execute(f'LOCK TABLE "{vyruchka_partition_name(table, m)}" IN SHARE MODE')
+            cur.execute(
+                """
+                INSERT INTO vyruchka_arkhiv (mesyac, id_magazin, id_tovar, kolichestvo, summa)
+                SELECT %(m)s, v.id_magazin, tv.id_tovar,
+                       SUM(COALESCE(tv.kolichestvo, 0)), SUM(COALESCE(tv.summa, 0))
+                  FROM tovar_vyruchka AS tv
+                  JOIN vyruchka AS v ON v.id = tv.id_vyruchka AND v.data = tv.data
+                 WHERE tv.data >= %(m)s AND tv.data < %(next)s
+                 GROUP BY v.id_magazin, tv.id_tovar
+                ON CONFLICT (mesyac, id_magazin, id_tovar) DO UPDATE
+                   SET kolichestvo = EXCLUDED.kolichestvo, summa = EXCLUDED.summa
+                """,
+                {"m": m, "next": _add_months(m, 1)},
             )
+            # сначала строки: отсоединённая секция уносит копию составного FK на vyruchka —
+            # её снимаем, иначе чеки этого месяца не отсоединить
+            for table in reversed(VYRUCHKA_PARTITIONED):
+                if m not in existing[table]:
+                    continue
+                name = vyruchka_partition_name(table, m)
+                cur.execute(f'ALTER TABLE "{table}" DETACH PARTITION "{name}"')
+                cur.execute(
+                    "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f' "
+                    "AND confrelid = ANY(%s::regclass[])",
+                    [name, list(VYRUCHKA_PARTITIONED)],
+                )
+                for (conname,) in cur.fetchall():
+                    cur.execute(f'ALTER TABLE "{name}" DROP CONSTRAINT "{conname}"')
+                detached.append(name)
+    return detached
+
+
+# ===== Ключи API внешних систем =====
+
+def _api_token_hash(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def issue_api_token(user) -> str:
+    """Выдаёт пользователю новый ключ API (прежний перестаёт действовать). Ключ не хранится — только хэш."""
+    key = secrets.token_urlsafe(32)
+    profile, _ = UserProfile.objects.get_or_create(user=user)
+    profile.api_token_hash = _api_token_hash(key)
+    profile.save(update_fields=["api_token_hash"])
+    return key
+
+
+def revoke_api_token(user):
+    UserProfile.objects.filter(user=user).update(api_token_hash=None)
+
+
+def user_by_api_token(key: str):
+    """Активный пользователь по ключу API или None."""
+    if not key:
+        return None
+    profile = (UserProfile.objects.select_related("user")
+               .filter(api_token_hash=_api_token_hash(key), user__is_active=True).first())
+    return profile.user if profile else None
+
+
+# ===== Массовая загрузка чеков =====
+
+class VyruchkaImportError(Exception):
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        # ["строка N: ..."] — первые IMPORT_MAX_ERRORS ошибок
+        self.errors = errors or []
+
+
+IMPORT_MAX_ERRORS = 50
+IMPORT_COLUMNS = ("chek", "magazin", "data", "rabotnik", "tovar", "kolichestvo", "cena")
+IMPORT_REQUIRED = ("chek", "magazin", "data", "tovar", "kolichestvo")
+
+
+def _copy_field(value) -> str:
+    """Значение для COPY ... FORMAT text: NULL -> \\N, спецсимволы экранируются."""
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+class _CopyStream:
+    """Файлоподобная обёртка над генератором строк для cursor.copy_expert()."""
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buf = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buf += line
+        if size < 0:
+            size = len(self._buf)
+        out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+
+def _jsonl_copy_rows(f):
+    """
+    JSON lines -> строки COPY (n + столбцы IMPORT_COLUMNS, как есть, текстом).
+    Объект — позиция {"chek", "magazin", ..., "cena"} или чек целиком
+    {"chek", "magazin", "data", "rabotnik", "items": [{"tovar", "kolichestvo", "cena"}]}.
+    Нечитаемая строка попадает в COPY пустой — её отловит проверка обязательных полей.
+    """
+    for n, line in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            obj = None
+        if not isinstance(obj, dict):
+            rows = [{}]
+        elif "items" in obj:
+            rows = [{**obj, **item} if isinstance(item, dict) else {} for item in obj["items"] or [{}]]
         else:
-            MagazinTovar.objects.filter(pk=mt.pk).update(
-                kolichestvo=Coalesce(F("kolichestvo"), 0) + abs(delta)
-            )
\ No newline at end of file
+            rows = [obj]
+        for row in rows:
+            yield "\t".join([str(n)] + [_copy_field(row.get(c)) for c in IMPORT_COLUMNS]) + "\n"
+
+
+def _import_copy(cur, f, fmt: str):
+    """
+    Заливает файл в vyruchka_raw (все столбцы — текст).
+    CSV уходит в COPY как есть, без разбора в Python: по строке заголовка
+    определяются разделитель и порядок столбцов, n — номер строки файла.
+    """
+    if fmt == "jsonl":
+        cur.copy_expert(
+            f"COPY vyruchka_raw (n, {', '.join(IMPORT_COLUMNS)}) FROM STDIN",
+            _CopyStream(_jsonl_copy_rows(f)),
+        )
+        return
+
+    head = f.readline()
+    try:
+        delimiter = csv.Sniffer().sniff(head, delimiters=",;\t").delimiter
+    except csv.Error:
+        delimiter = ","
+    names = [c.strip().lower() for c in next(csv.reader([head], delimiter=delimiter), [])]
+    unknown = [c for c in names if c not in IMPORT_COLUMNS]
+    missing = [c for c in IMPORT_REQUIRED if c not in names]
+    if unknown or missing or len(set(names)) != len(names):
+        raise VyruchkaImportError(
+            "Неверная строка заголовка: нужны столбцы " + ", ".join(IMPORT_REQUIRED)
+            + " (необязательные — rabotnik, cena)",
+            [f"неизвестный столбец {c}" for c in unknown] + [f"нет столбца {c}" for c in missing],
+        )
+    # номера строк: первая строка данных — вторая строка файла
+    cur.execute("ALTER SEQUENCE vyruchka_raw_n_seq RESTART WITH 2")
+    delim = "E'\\t'" if delimiter == "\t" else f"'{delimiter}'"
+    cur.copy_expert(
+        f"COPY vyruchka_raw ({', '.join(names)}) FROM STDIN WITH (FORMAT csv, DELIMITER {delim})",
+        f,
+    )
+
+
+def _import_check_types(cur) -> list[str]:
+    """Проверка значений сырых строк одним запросом: обязательные поля, числа, даты."""
+    cur.execute(
+        """
+        SELECT n, msg FROM (
+            SELECT r.n, CASE
+                WHEN NULLIF(trim(r.chek), '') IS NULL THEN 'не заполнено поле chek'
+                WHEN length(trim(r.chek)) > 64 THEN 'chek: длиннее 64 символов'
+                WHEN NOT COALESCE(pg_input_is_valid(trim(r.magazin), 'integer'), false) THEN 'magazin: неверное значение ''' || COALESCE(r.magazin, '') || ''''
+                WHEN NOT COALESCE(pg_input_is_valid(trim(r.data), 'date'), false) THEN 'data: неверное значение ''' || COALESCE(r.data, '') || ''''
+                WHEN NULLIF(trim(r.rabotnik), '') IS NOT NULL
+                     AND NOT pg_input_is_valid(trim(r.rabotnik), 'integer') THEN 'rabotnik: неверное значение ''' || r.rabotnik || ''''
+                WHEN NOT COALESCE(pg_input_is_valid(trim(r.tovar), 'integer'), false) THEN 'tovar: неверное значение ''' || COALESCE(r.tovar, '') || ''''
+                WHEN NOT COALESCE(pg_input_is_valid(trim(r.kolichestvo), 'integer'), false) THEN 'kolichestvo: неверное значение ''' || COALESCE(r.kolichestvo, '') || ''''
+                WHEN trim(r.kolichestvo)::integer <= 0 THEN 'количество должно быть больше нуля'
+                WHEN NULLIF(trim(r.cena), '') IS NOT NULL
+                     AND NOT pg_input_is_valid(trim(r.cena), 'numeric(10, 2)') THEN 'cena: неверное значение ''' || r.cena || ''''
+                WHEN NULLIF(trim(r.cena), '') IS NOT NULL
+                     AND NOT trim(r.cena)::numeric BETWEEN 0 AND 99999999.99 THEN 'неверная цена'
+            END AS msg
+              FROM vyruchka_raw AS r
+        ) AS e
+        WHERE msg IS NOT NULL
+        ORDER BY n
+        LIMIT %s
+        """,
+        [IMPORT_MAX_ERRORS],
+    )
+    return [f"строка {n}: {msg}" for n, msg in cur.fetchall()]
+
+
+def _import_check_refs(cur, magazin_id) -> list[str]:
+    """Ссылочные проверки загруженной пачки одним запросом: первые IMPORT_MAX_ERRORS ошибок."""
+    cur.execute(
+        """
+        SELECT n, msg FROM (
+            SELECT s.n, 'магазин ' || s.id_magazin || ' не найден' AS msg
+              FROM vyruchka_stage AS s
+             WHERE NOT EXISTS (SELECT 1 FROM magazin AS m WHERE m.id = s.id_magazin)
+            UNION ALL
+            SELECT s.n, 'нет доступа к магазину ' || s.id_magazin
+              FROM vyruchka_stage AS s
+             WHERE %(mag)s::integer IS NOT NULL AND s.id_magazin <> %(mag)s
+            UNION ALL
+            SELECT s.n, 'товар ' || s.id_tovar || ' не найден'
+              FROM vyruchka_stage AS s
+             WHERE NOT EXISTS (SELECT 1 FROM tovar AS t WHERE t.id = s.id_tovar)
+            UNION ALL
+            SELECT s.n, 'работник ' || s.id_rabotnik || ' не найден'
+              FROM vyruchka_stage AS s
+             WHERE s.id_rabotnik IS NOT NULL
+               AND NOT EXISTS (SELECT 1 FROM rabotnik AS r WHERE r.id = s.id_rabotnik)
+            UNION ALL
+            SELECT MIN(s.n), 'чек ' || s.chek || ': у позиций разные работники'
+              FROM vyruchka_stage AS s
+             GROUP BY s.id_magazin, s.chek, s.data
+            HAVING COUNT(DISTINCT ROW(s.id_rabotnik)) > 1
+        ) AS e
+        ORDER BY n
+        LIMIT %(lim)s
+        """,
+        {"mag": magazin_id, "lim": IMPORT_MAX_ERRORS},
+    )
+    return [f"строка {n}: {msg}" for n, msg in cur.fetchall()]
+
+
+@retry_on_conflict("import_vyruchka")
+def import_vyruchka(f, fmt: str = "csv", magazin_id: int | None = None) -> dict:
+    """
+    Загружает выгрузку касс (тысячи чеков) одной транзакцией.
+    f — бинарный файл с возможностью seek (перечитывается при повторе транзакции),
+    fmt — "csv" (строка заголовка chek, magazin, data, rabotnik, tovar, kolichestvo, cena;
+    rabotnik и cena необязательны, цена по умолчанию — из карточки товара; по позиции
+    чека на строку) или "jsonl"; magazin_id — разрешённый магазин (None — любой).
+    Чек — позиции с одинаковыми (magazin, chek, data): номера чеков касс уникальны
+    только в пределах магазина и дня, в выгрузке сети они повторяются.
+
+    Файл потоком идёт COPY во временную таблицу, дальше всё множествами: проверка
+    значений и ссылок — по запросу, потребность по (магазин, товар) — одним GROUP BY,
+    блокировка и списание остатков — по одному запросу на всю пачку, чеки, позиции
+    и журнал движения — одним INSERT ... SELECT.
+    Магазин, которому хоть по одному товару не хватает остатка, отклоняется целиком
+    (его чеки не загружаются), остальные магазины загружаются.
+    Загрузка идемпотентна: чек, уже загруженный раньше (тот же магазин, номер chek
+    и дата — уникальный ключ vyruchka), пропускается вместе с позициями и списанием,
+    так что повтор запроса кассы после обрыва связи ничего не задваивает.
+    Ошибки формата и ссылок отклоняют файл целиком (VyruchkaImportError).
+    Возвращает {"receipts", "lines", "magazins", "duplicates", "rejected": {magazin_id: сообщение}}.
+    """
+    f.seek(0)
+    text = io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+    with connection.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TEMP TABLE IF NOT EXISTS vyruchka_raw (
+                n bigserial, chek text, magazin text, data text, rabotnik text,
+                tovar text, kolichestvo text, cena text
+            ) ON COMMIT DROP;
+            CREATE TEMP TABLE IF NOT EXISTS vyruchka_stage (
+                n bigint, chek text, id_magazin integer, data date, id_rabotnik integer,
+                id_tovar integer, kolichestvo integer, cena numeric(10, 2)
+            ) ON COMMIT DROP;
+            TRUNCATE vyruchka_raw, vyruchka_stage;
+            -- группировки по сотням тысяч строк не должны уходить на диск
+            SET LOCAL work_mem = '64MB';
+            """
+        )
+        try:
+            # copy_expert — метод драйвера, ошибки БД приводим к исключениям Django сами
+            with connection.wrap_database_errors:
+                _import_copy(cur, text, fmt)
+        except (DataError, UnicodeDecodeError) as e:
+            # COPY прерывается на первой нечитаемой строке — текст ошибки PostgreSQL содержит её номер
+            raise VyruchkaImportError("Не удалось прочитать файл", [str(e).strip()])
+        finally:
+            text.detach()
+
+        errors = _import_check_types(cur)
+        if errors:
+            raise VyruchkaImportError("Ошибки в значениях файла", errors)
+        cur.execute(
+            """
+            INSERT INTO vyruchka_stage
+            SELECT n, trim(chek), trim(magazin)::integer, trim(data)::date,
+                   NULLIF(trim(rabotnik), '')::integer, trim(tovar)::integer,
+                   trim(kolichestvo)::integer, NULLIF(trim(cena), '')::numeric(10, 2)
+              FROM vyruchka_raw
+            """
+        )
+        cur.execute("ANALYZE vyruchka_stage")
+
+        errors = _import_check_refs(cur, magazin_id)
+        if errors:
+            raise VyruchkaImportError("Файл ссылается на несуществующие данные", errors)
+
+        cur.execute("SELECT DISTINCT id_magazin, id_tovar FROM vyruchka_stage")
+        stock = _lock_magazin_stock(cur.fetchall())
+
+        # уже загруженные чеки — после блокировки остатков: параллельная загрузка того же
+        # файла ждёт на ней и здесь видит чеки, зафиксированные первой
+        cur.execute(
+            """
+            WITH dup AS (
+                DELETE FROM vyruchka_stage AS s
+                 USING vyruchka AS v
+                 WHERE v.id_magazin = s.id_magazin AND v.chek = s.chek AND v.data = s.data
+                RETURNING s.id_magazin, s.chek, s.data
+            )
+            SELECT COUNT(DISTINCT (id_magazin, chek, data)) FROM dup
+            """
+        )
+        duplicates = cur.fetchone()[0]
+
+        cur.execute(
+            "SELECT id_magazin, id_tovar, SUM(kolichestvo) FROM vyruchka_stage GROUP BY id_magazin, id_tovar"
+        )
+        need = {(mid, tid): int(qty) for mid, tid, qty in cur.fetchall()}
+        short = {}
+        for (mid, tid), qty in need.items():
+            if stock.get((mid, tid), 0) < qty:
+                short.setdefault(mid, []).append((tid, stock.get((mid, tid), 0), qty))
+        if short:
+            cur.execute("DELETE FROM vyruchka_stage WHERE id_magazin = ANY(%s)", [list(short)])
+
+        cur.execute(
+            "SELECT COUNT(DISTINCT (id_magazin, chek, data)), COUNT(*), COUNT(DISTINCT id_magazin) FROM vyruchka_stage"
+        )
+        receipts, lines, magazins = cur.fetchone()
+
+        # id чеков берутся из последовательности заранее — позиции и журнал ссылаются на них в том же запросе
+        cur.execute(
+            """
+            WITH head AS MATERIALIZED (
+                SELECT h.chek, nextval(pg_get_serial_sequence('vyruchka', 'id')) AS id,
+                       h.id_magazin, h.id_rabotnik, h.data
+                  FROM (SELECT id_magazin, chek, data, MIN(n) AS n, MIN(id_rabotnik) AS id_rabotnik
+                          FROM vyruchka_stage
+                         GROUP BY id_magazin, chek, data
+                         ORDER BY n) AS h
+            ),
+            -- страховка от гонки с чеком, записанным не загрузкой: такой чек пропускается,
+            -- позиции и журнал пишутся только для реально вставленных (RETURNING)
+            v AS (
+                INSERT INTO vyruchka (id, id_magazin, id_rabotnik, data, chek)
+                SELECT id, id_magazin, id_rabotnik, data, chek FROM head
+                ON CONFLICT (id_magazin, chek, data) WHERE chek IS NOT NULL DO NOTHING
+                RETURNING id, id_magazin, chek, data
+            ),
+            tv AS (
+                INSERT INTO tovar_vyruchka (id_tovar, id_vyruchka, data, kolichestvo, cena_prodazhi, summa)
+                SELECT s.id_tovar, v.id, v.data, s.kolichestvo, p.cena, p.cena * s.kolichestvo
+                  FROM vyruchka_stage AS s
+                  JOIN v ON v.id_magazin = s.id_magazin AND v.chek = s.chek AND v.data = s.data
+                  JOIN tovar AS t ON t.id = s.id_tovar
+                 CROSS JOIN LATERAL (SELECT COALESCE(s.cena, t.cena_prodazhi, 0) AS cena) AS p
+            )
+            INSERT INTO stock_movement (doc_type, doc_id, id_magazin, id_tovar, kolichestvo, created_at)
+            SELECT %s, v.id, s.id_magazin, s.id_tovar, -SUM(s.kolichestvo), now()
+              FROM vyruchka_stage AS s
+              JOIN v ON v.id_magazin = s.id_magazin AND v.chek = s.chek AND v.data = s.data
+             GROUP BY v.id, s.id_magazin, s.id_tovar
+            RETURNING id_magazin, id_tovar, -kolichestvo
+            """,
+            [StockMovement.DocType.VYRUCHKA],
+        )
+        debit = {}
+        for mid, tid, qty in cur.fetchall():
+            debit[mid, tid] = debit.get((mid, tid), 0) + qty
+
+    # остатки — одним UPDATE по суммарной дельте (магазин, товар) вставленных чеков
+    _debit_magazin_stock((mid, tid, qty) for (mid, tid), qty in debit.items())
+
+    names = dict(Tovar.objects.filter(pk__in={tid for r in short.values() for tid, _, _ in r})
+                              .values_list("pk", "nazvanie"))
+    return {
+        "receipts": receipts,
+        "lines": lines,
+        "magazins": magazins,
+        "duplicates": duplicates,
+        "rejected": {
+            mid: "Недостаточно товара на складе магазина: " + "; ".join(
+                f"'{names.get(tid)}' (остаток={current}, нужно={qty})" for tid, current, qty in r
+            )
+            for mid, r in short.items()
+        },
+    }
+
+
+# ===== Перемещения между магазинами =====
+
+class PeremeshchenieError(Exception):
+    pass
+
+
+@retry_on_conflict("post_peremeshchenie")
+def post_peremeshchenie(p: Peremeshchenie):
+    """
+    Проводит перемещение: списывает товар со склада-источника и зачисляет на
+    склад-получатель в одной транзакции, за несколько запросов независимо от
+    числа строк:
+      1) строки magazin_tovar обоих магазинов блокируются одним SELECT ... FOR UPDATE
+         в общем для всех складских операций порядке (id_magazin, id_tovar),
+         _lock_magazin_stock;
+      2) списание — один UPDATE по всем строкам;
+      3) зачисление — один INSERT ... ON CONFLICT DO UPDATE (недостающие строки создаются).
+    """
+    p = Peremeshchenie.objects.select_for_update().get(pk=p.pk)
+    if p.status != Peremeshchenie.Status.DRAFT:
+        raise PeremeshchenieError(f"Перемещение #{p.pk} уже проведено")
+
+    qty = {
+        tid: (q, name)
+        for tid, q, name in p.peremeshchenieitem_set.values_list("id_tovar_id", "kolichestvo", "id_tovar__nazvanie")
+        if q and q > 0
+    }
+    if not qty:
+        raise PeremeshchenieError("В перемещении нет позиций")
+
+    src, dst = p.id_magazin_iz_id, p.id_magazin_v_id
+    stock = _lock_magazin_stock((mid, tid) for tid in qty for mid in (src, dst))
+
+    short = [(name, stock.get((src, tid), 0), q) for tid, (q, name) in sorted(qty.items())
+             if stock.get((src, tid), 0) < q]
+    if short:
+        raise PeremeshchenieError("Недостаточно товара на складе магазина-источника: " + "; ".join(
+            f"'{name}' (остаток={current}, нужно={q})" for name, current, q in short
+        ))
+
+    _debit_magazin_stock((src, tid, q) for tid, (q, _) in qty.items())
+    _credit_magazin_stock([(dst, tid, q) for tid, (q, _) in qty.items()])
+    _record_movements(
+        StockMovement.DocType.PEREMESHCHENIE,
+        [(p.pk, mid, tid, sign * q) for tid, (q, _) in qty.items() for mid, sign in ((src, -1), (dst, 1))],
+    )
+
+    Peremeshchenie.objects.filter(pk=p.pk).update(status=Peremeshchenie.Status.DONE)
+
+
+# ===== Инвентаризация =====
+
+class InventarizaciyaError(Exception):
+    pass
+
+
+def load_inventarizaciya_items(inv: Inventarizaciya, counted: dict[int, int]) -> int:
+    """
+    Загружает посчитанные количества {tovar_id: факт} в инвентаризацию одним
+    INSERT ... ON CONFLICT: повторная загрузка того же товара перезаписывает факт.
+    """
+    if inv.status != Inventarizaciya.Status.DRAFT:
+        raise InventarizaciyaError(f"Инвентаризация #{inv.pk} уже проведена")
+    InventarizaciyaItem.objects.bulk_create(
+        [InventarizaciyaItem(id_inventarizaciya=inv, id_tovar_id=tid, kolichestvo_fakt=qty)
+         for tid, qty in sorted(counted.items())],
+        update_conflicts=True,
+        unique_fields=["id_inventarizaciya", "id_tovar"],
+        update_fields=["kolichestvo_fakt"],
+        batch_size=5000,
+    )
+    return len(counted)
+
+
+def inventarizaciya_variance(inv: Inventarizaciya, only_diff: bool = False) -> list[dict]:
+    """
+    Расхождения по всей инвентаризации одним запросом: строки пересчёта
+    LEFT JOIN magazin_tovar. Для проведённой — учётный остаток на момент проведения.
+    """
+    where_diff = "WHERE v.fakt <> v.uchet" if only_diff else ""
+    with connection.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT v.id_tovar, v.nazvanie, v.uchet, v.fakt, v.fakt - v.uchet
+              FROM (
+                    SELECT i.id_tovar, t.nazvanie, i.kolichestvo_fakt AS fakt,
+                           COALESCE(i.kolichestvo_uchet, mt.kolichestvo, 0) AS uchet
+                      FROM inventarizaciya_item AS i
+                      JOIN tovar AS t ON t.id = i.id_tovar
+                      LEFT JOIN magazin_tovar AS mt
+                        ON mt.id_magazin = %s AND mt.id_tovar = i.id_tovar
+                     WHERE i.id_inventarizaciya = %s
+              ) AS v
+              {where_diff}
+             ORDER BY v.nazvanie, v.id_tovar
+            """,
+            [inv.id_magazin_id, inv.pk],
+        )
+        cols = ("id_tovar", "nazvanie", "uchet", "fakt", "diff")
+        return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+
+@retry_on_conflict("post_inventarizaciya")
+def post_inventarizaciya(inv: Inventarizaciya) -> int:
+    """
+    Проводит инвентаризацию: остаток магазина по каждому посчитанному товару
+    становится равен факту. Строки magazin_tovar блокируются заранее (в общем порядке
+    id_magazin, id_tovar), затем один оператор с CTE пишет новые остатки (upsert),
+    запоминает учётный остаток в строках инвентаризации и записывает расхождения в журнал.
+    Возвращает число строк с расхождением.
+    """
+    inv = Inventarizaciya.objects.select_for_update().get(pk=inv.pk)
+    if inv.status != Inventarizaciya.Status.DRAFT:
+        raise InventarizaciyaError(f"Инвентаризация #{inv.pk} уже проведена")
+    if not inv.inventarizaciyaitem_set.exists():
+        raise InventarizaciyaError("В инвентаризации нет позиций")
+
+    params = {"inv": inv.pk, "mag": inv.id_magazin_id, "doc_type": StockMovement.DocType.INVENTARIZACIYA}
+    with connection.cursor() as cur:
+        with locking("magazin_tovar") as locked:
+            cur.execute(
+                """
+                SELECT mt.id_magazin, mt.id_tovar FROM magazin_tovar AS mt
+                 WHERE mt.id_magazin = %(mag)s
+                   AND mt.id_tovar IN (SELECT id_tovar FROM inventarizaciya_item WHERE id_inventarizaciya = %(inv)s)
+                 ORDER BY mt.id_magazin, mt.id_tovar
+                   FOR UPDATE
+                """,
+                params,
+            )
+            locked += cur.fetchall()
+
+        # строки заблокированы: снимок этого оператора видит их актуальные остатки
+        cur.execute(
+            """
+            WITH cnt AS (
+                SELECT i.id, i.id_tovar, i.kolichestvo_fakt AS fakt, COALESCE(mt.kolichestvo, 0) AS uchet
+                  FROM inventarizaciya_item AS i
+                  LEFT JOIN magazin_tovar AS mt ON mt.id_magazin = %(mag)s AND mt.id_tovar = i.id_tovar
+                 WHERE i.id_inventarizaciya = %(inv)s
+            ),
+            stock AS (
+                INSERT INTO magazin_tovar (id_magazin, id_tovar, kolichestvo)
+                SELECT %(mag)s, cnt.id_tovar, cnt.fakt FROM cnt WHERE cnt.fakt <> cnt.uchet
+                ON CONFLICT (id_magazin, id_tovar) DO UPDATE SET kolichestvo = EXCLUDED.kolichestvo
+            ),
+            items AS (
+                UPDATE inventarizaciya_item AS i SET kolichestvo_uchet = cnt.uchet
+                  FROM cnt
+                 WHERE i.id = cnt.id
+            )
+            INSERT INTO stock_movement (doc_type, doc_id, id_magazin, id_tovar, kolichestvo, created_at)
+            SELECT %(doc_type)s, %(inv)s, %(mag)s, cnt.id_tovar, cnt.fakt - cnt.uchet, now()
+              FROM cnt
+             WHERE cnt.fakt <> cnt.uchet
+            """,
+            params,
+        )
+        changed = cur.rowcount
+
+    _magazin_stock_changed(
+        (inv.id_magazin_id, tid)
+        for tid in inv.inventarizaciyaitem_set.values_list("id_tovar_id", flat=True)
+    )
+    Inventarizaciya.objects.filter(pk=inv.pk).update(status=Inventarizaciya.Status.DONE)
+    return changed
+
+
+# ===== Журнал движения: свёртка и остатки =====
+
+def compact_stock_movements() -> int:
+    """
+    Сворачивает журнал движения в stock_balance.
+    Граница — xmin текущего снимка: транзакции с меньшим xid уже зафиксированы
+    или откатаны, их движения видны все и больше не появятся. Движения ещё
+    идущих транзакций (даже с меньшим id) остаются в «хвосте» до следующей свёртки.
+    Возвращает xid, до которого свернули.
+    """
+    with transaction.atomic(), connection.cursor() as cur:
+        # параллельная свёртка не нужна — вторая просто подождёт
+        cur.execute("LOCK TABLE stock_balance IN EXCLUSIVE MODE")
+        # каждая свёртка сворачивает всё до своего upto, так что максимум — общая граница
+        cur.execute(
+            """
+            SELECT since, GREATEST(since, pg_snapshot_xmin(pg_current_snapshot())::text::bigint)
+              FROM (SELECT COALESCE(MAX(upto_xid), 0) AS since FROM stock_balance) AS b
+            """
+        )
+        since, upto = cur.fetchone()
+        if upto == since:
+            return since
+
+        fold = """
+            INSERT INTO stock_balance (id_magazin, id_tovar, kolichestvo, upto_xid)
+            SELECT sm.id_magazin, sm.id_tovar, SUM(sm.kolichestvo), %(upto)s
+              FROM stock_movement AS sm
+             WHERE sm.xid >= %(since)s AND sm.xid < %(upto)s
+               AND sm.id_magazin IS {magazin}
+             GROUP BY sm.id_magazin, sm.id_tovar
+            ON CONFLICT {target} DO UPDATE
+               SET kolichestvo = stock_balance.kolichestvo + EXCLUDED.kolichestvo,
+                   upto_xid = EXCLUDED.upto_xid
+        """
+        params = {"since": since, "upto": upto}
+        cur.execute(fold.format(magazin="NULL", target="(id_tovar) WHERE id_magazin IS NULL"), params)
+        cur.execute(fold.format(magazin="NOT NULL", target="(id_magazin, id_tovar)"), params)
+    return upto
+
+
+def ledger_balance(tovar_id: int, magazin_id: int | None = None) -> int:
+    """
+    Остаток по журналу: свёрнутый снимок + «хвост» движений после него.
+    magazin_id = None — центральный склад.
+    Рабочим остатком остаются счётчики (tovar.kolichestvo_na_sklade + под-счётчики,
+    magazin_tovar.kolichestvo): по ним проверяется нехватка под блокировкой строки.
+    Журнал — аудит и срезы; ledger_balance объясняет и проверяет счётчик.
+    """
+    key_sql = "id_magazin IS NULL" if magazin_id is None else "id_magazin = %(magazin)s"
+    with connection.cursor() as cur:
+        cur.execute(
+            f"""
+            WITH snap AS (
+                SELECT kolichestvo, upto_xid
+                  FROM stock_balance
+                 WHERE id_tovar = %(tovar)s AND {key_sql}
+            )
+            SELECT COALESCE((SELECT kolichestvo FROM snap), 0)
+                 + COALESCE((
+                       SELECT SUM(kolichestvo)
+                         FROM stock_movement
+                        WHERE id_tovar = %(tovar)s AND {key_sql}
+                          AND xid >= COALESCE((SELECT upto_xid FROM snap), 0)
+                   ), 0)
+            """,
+            {"tovar": tovar_id, "magazin": magazin_id},
+        )
+        return int(cur.fetchone()[0])
+
+
+# ===== Под-счётчики центрального склада =====
+
+def fold_tovar_stripes(tovar_ids=None) -> int:
+    """
+    Переносит накопленные delta под-счётчиков в tovar.kolichestvo_na_sklade.
+    Блокировки берутся в том же порядке, что и при проведении заявок:
+    сначала строки tovar (по id), затем под-счётчики. Возвращает число товаров.
+    """
+    only = "AND id_tovar = ANY(%(ids)s)" if tovar_ids is not None else ""
+    params = {"ids": list(tovar_ids or [])}
+    with transaction.atomic(), connection.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT id FROM tovar
+             WHERE id IN (SELECT id_tovar FROM tovar_stripe WHERE delta <> 0 {only})
+             ORDER BY id
+               FOR NO KEY UPDATE
+            """,
+            params,
+        )
+        cur.execute(
+            f"SELECT id FROM tovar_stripe WHERE delta <> 0 {only} ORDER BY id_tovar, stripe FOR NO KEY UPDATE",
+            params,
+        )
+        # строки заблокированы — значения delta уже не изменятся до конца транзакции
+        cur.execute(
+            f"""
+            WITH old AS (
+                SELECT id, id_tovar, delta FROM tovar_stripe WHERE delta <> 0 {only}
+            ),
+            zeroed AS (
+                UPDATE tovar_stripe AS ts SET delta = 0
+                  FROM old
+                 WHERE ts.id = old.id
+                RETURNING old.id_tovar, old.delta
+            )
+            UPDATE tovar AS t
+               SET kolichestvo_na_sklade = COALESCE(t.kolichestvo_na_sklade, 0) + agg.delta
+              FROM (SELECT id_tovar, SUM(delta) AS delta FROM zeroed GROUP BY id_tovar) AS agg
+             WHERE t.id = agg.id_tovar
+            """,
+            params,
+        )
+        return cur.rowcount
+
+
+def set_tovar_stripes(tovar_ids, stripes: int):
+    """
+    Включает режим под-счётчиков (stripes > 0) или выключает его (stripes = 0)
+    для указанных товаров. Перед пересозданием накопленное сворачивается.
+    """
+    tovar_ids = sorted(set(tovar_ids))
+    with transaction.atomic():
+        fold_tovar_stripes(tovar_ids)
+        TovarStripe.objects.filter(id_tovar__in=tovar_ids).delete()
+        TovarStripe.objects.bulk_create([
+            TovarStripe(id_tovar_id=tid, stripe=i, delta=0)
+            for tid in tovar_ids
+            for i in range(stripes)
+        ])
+
+
+
+# ===== Сверка остатков =====
+
+def magazin_stock_diff(magazin_ids) -> list[tuple]:
+    """
+    Сверка остатков магазинов с документами: ожидаемый остаток =
+    проведённые заявки − продажи (вместе с архивными, vyruchka_arkhiv)
+    ± проведённые перемещения и инвентаризации.
+    Считается агрегатами по всему набору магазинов сразу.
+    Возвращает [(id_magazin, id_tovar, факт, ожидается)] только для расходящихся пар.
+    """
+    with connection.cursor() as cur:
+        cur.execute(
+            """
+            WITH src AS (
+                SELECT z.id_magazin, zi.id_tovar, SUM(COALESCE(zi.kolichestvo, 0)) AS qty
+                  FROM zayavka_item AS zi
+                  JOIN zayavka AS z ON z.id = zi.id_zayavka
+                 WHERE z.status = 'APPROVED' AND z.id_magazin = ANY(%(ids)s)
+                 GROUP BY z.id_magazin, zi.id_tovar
+                UNION ALL
+                SELECT v.id_magazin, tv.id_tovar, -SUM(COALESCE(tv.kolichestvo, 0))
+                  FROM tovar_vyruchka AS tv
+                  JOIN vyruchka AS v ON v.id = tv.id_vyruchka AND v.data = tv.data
+                 WHERE v.id_magazin = ANY(%(ids)s)
+                 GROUP BY v.id_magazin, tv.id_tovar
+                UNION ALL
+                SELECT a.id_magazin, a.id_tovar, -SUM(a.kolichestvo)
+                  FROM vyruchka_arkhiv AS a
+                 WHERE a.id_magazin = ANY(%(ids)s)
+                 GROUP BY a.id_magazin, a.id_tovar
+                UNION ALL
+                SELECT p.id_magazin_iz, pi.id_tovar, -SUM(COALESCE(pi.kolichestvo, 0))
+                  FROM peremeshchenie_item AS pi
+                  JOIN peremeshchenie AS p ON p.id = pi.id_peremeshchenie
+                 WHERE p.status = 'DONE' AND p.id_magazin_iz = ANY(%(ids)s)
+                 GROUP BY p.id_magazin_iz, pi.id_tovar
+                UNION ALL
+                SELECT p.id_magazin_v, pi.id_tovar, SUM(COALESCE(pi.kolichestvo, 0))
+                  FROM peremeshchenie_item AS pi
+                  JOIN peremeshchenie AS p ON p.id = pi.id_peremeshchenie
+                 WHERE p.status = 'DONE' AND p.id_magazin_v = ANY(%(ids)s)
+                 GROUP BY p.id_magazin_v, pi.id_tovar
+                UNION ALL
+                SELECT inv.id_magazin, ii.id_tovar, SUM(ii.kolichestvo_fakt - COALESCE(ii.kolichestvo_uchet, 0))
+                  FROM inventarizaciya_item AS ii
+                  JOIN inventarizaciya AS inv ON inv.id = ii.id_inventarizaciya
+                 WHERE inv.status = 'DONE' AND inv.id_magazin = ANY(%(ids)s)
+                 GROUP BY inv.id_magazin, ii.id_tovar
+            ),
+            exp AS (
+                SELECT id_magazin, id_tovar, SUM(qty) AS qty FROM src GROUP BY id_magazin, id_tovar
+            ),
+            fact AS (
+                SELECT id_magazin, id_tovar, COALESCE(kolichestvo, 0) AS qty
+                  FROM magazin_tovar
+                 WHERE id_magazin = ANY(%(ids)s)
+            )
+            SELECT COALESCE(exp.id_magazin, fact.id_magazin), COALESCE(exp.id_tovar, fact.id_tovar),
+                   COALESCE(fact.qty, 0), COALESCE(exp.qty, 0)::bigint
+              FROM exp
+              FULL JOIN fact ON fact.id_magazin = exp.id_magazin AND fact.id_tovar = exp.id_tovar
+             WHERE COALESCE(fact.qty, 0) <> COALESCE(exp.qty, 0)
+             ORDER BY 1, 2
+            """,
+            {"ids": list(magazin_ids)},
+        )
+        return cur.fetchall()
+
+
+def central_stock_diff() -> list[tuple]:
+    """
+    Сверка центрального склада: ожидаемый остаток = поставки − проведённые заявки.
+    Фактический остаток учитывает под-счётчики. Возвращает [(None, id_tovar, факт, ожидается)].
+    """
+    with connection.cursor() as cur:
+        cur.execute(
+            """
+            WITH src AS (
+                SELECT id_tovar, SUM(round(COALESCE(kolichestvo, 0))::int) AS qty
+                  FROM postavka
+                 GROUP BY id_tovar
+                UNION ALL
+                SELECT zi.id_tovar, -SUM(COALESCE(zi.kolichestvo, 0))
+                  FROM zayavka_item AS zi
+                  JOIN zayavka AS z ON z.id = zi.id_zayavka
+                 WHERE z.status = 'APPROVED'
+                 GROUP BY zi.id_tovar
+            ),
+            exp AS (
+                SELECT id_tovar, SUM(qty) AS qty FROM src GROUP BY id_tovar
+            ),
+            fact AS (
+                SELECT t.id AS id_tovar,
+                       COALESCE(t.kolichestvo_na_sklade, 0) + COALESCE(s.delta, 0) AS qty
+                  FROM tovar AS t
+                  LEFT JOIN (SELECT id_tovar, SUM(delta) AS delta FROM tovar_stripe GROUP BY id_tovar) AS s
+                    ON s.id_tovar = t.id
+            )
+            SELECT NULL, fact.id_tovar, fact.qty::bigint, COALESCE(exp.qty, 0)::bigint
+              FROM fact
+              LEFT JOIN exp ON exp.id_tovar = fact.id_tovar
+             WHERE fact.qty <> COALESCE(exp.qty, 0)
+             ORDER BY 2
+            """
+        )
+        return cur.fetchall()
+
+
+@retry_on_conflict("fix_stock_diff")
+def fix_stock_diff(rows):
+    """
+    Исправляет расхождения, найденные magazin_stock_diff / central_stock_diff.
+    Применяется разница (ожидается − факт), а не абсолютное значение: движения,
+    проведённые между сверкой и исправлением, меняют обе стороны одинаково.
+    """
+    central = {}
+    magazin = []
+    movements = []
+    for magazin_id, tovar_id, actual, expected in rows:
+        delta = expected - actual
+        if magazin_id is None:
+            central[tovar_id] = central.get(tovar_id, 0) + delta
+        else:
+            magazin.append((magazin_id, tovar_id, delta))
+        movements.append((None, magazin_id, tovar_id, delta))
+
+    # тот же порядок блокировок, что и при проведении заявок: tovar, затем magazin_tovar
+    _apply_central_delta(central)
+    _credit_magazin_stock(magazin)
+    _record_movements(StockMovement.DocType.KORREKTIROVKA, movements)
+
+
+# ===== Дневные срезы остатков =====
+
+def _day_end(d: date) -> datetime:
+    """Граница «на конец дня d»: начало следующего дня в текущей временной зоне."""
+    return timezone.make_aware(datetime.combine(d + timedelta(days=1), time.min))
+
+
+def take_stock_snapshot(d: date | None = None) -> StockSnapshot | None:
+    """
+    Пишет срез остатков на конец дня d (по умолчанию — вчера) по журналу движения.
+    В срез попадают движения, созданные до конца дня транзакциями, которые к моменту
+    среза уже завершились (xid ниже xmin снимка, как в compact_stock_movements);
+    движения транзакций, шедших в момент среза, добавляются к остатку на дату при чтении.
+    Пишутся только пары, остаток которых изменился с предыдущего среза.
+    Срезы идут только вперёд: если срез на d или более позднюю дату уже есть — None.
+    """
+    if d is None:
+        d = timezone.localdate() - timedelta(days=1)
+    with transaction.atomic(), connection.cursor() as cur:
+        cur.execute("LOCK TABLE stock_snapshot IN EXCLUSIVE MODE")
+        prev = StockSnapshot.objects.order_by("-data").first()
+        if prev is not None and prev.data >= d:
+            return None
+
+        # всё, что не вошло в предыдущий срез, лежит в xid >= prev.tail_xid
+        params = {
+            "since": prev.tail_xid if prev is not None else 0,
+            "prev_upto": prev.upto_xid if prev is not None else 0,
+            "prev_end": _day_end(prev.data) if prev is not None else None,
+            "end": _day_end(d),
+        }
+        cur.execute(
+            "SELECT GREATEST(%(prev_upto)s, pg_snapshot_xmin(pg_current_snapshot())::text::bigint)", params
+        )
+        params["upto"] = cur.fetchone()[0]
+        # граница хвоста нового среза: завершённые движения после конца дня и всё с xid >= upto
+        cur.execute(
+            """
+            SELECT LEAST(%(upto)s, MIN(xid))
+              FROM stock_movement
+             WHERE xid >= %(since)s AND xid < %(upto)s AND created_at >= %(end)s
+            """,
+            params,
+        )
+        snap = StockSnapshot.objects.create(data=d, upto_xid=params["upto"], tail_xid=cur.fetchone()[0])
+        params["snap"] = snap.pk
+
+        cur.execute(
+            """
+            INSERT INTO stock_snapshot_item (id_snapshot, id_magazin, id_tovar, kolichestvo)
+            SELECT %(snap)s, d.id_magazin, d.id_tovar, COALESCE(last.kolichestvo, 0) + d.delta
+              FROM (SELECT id_magazin, id_tovar, SUM(kolichestvo) AS delta
+                      FROM stock_movement
+                     WHERE xid >= %(since)s AND xid < %(upto)s AND created_at < %(end)s
+                       AND NOT (xid < %(prev_upto)s AND created_at < %(prev_end)s)
+                     GROUP BY id_magazin, id_tovar
+                    HAVING SUM(kolichestvo) <> 0) AS d
+              LEFT JOIN LATERAL (
+                    SELECT i.kolichestvo
+                      FROM stock_snapshot_item AS i
+                     WHERE i.id_tovar = d.id_tovar
+                       AND i.id_magazin IS NOT DISTINCT FROM d.id_magazin
+                       AND i.id_snapshot < %(snap)s
+                     ORDER BY i.id_snapshot DESC
+                     LIMIT 1
+              ) AS last ON TRUE
+            """,
+            params,
+        )
+    return snap
+
+
+def _snapshot_bounds(d: date) -> dict:
+    """
+    Параметры запроса остатков на конец дня d: ближайший срез не позже d (snap),
+    его границы (upto, tail, snap_end) и граница конца дня d (end).
+    Движения после среза: created_at < end, xid >= tail и не вошедшие в срез.
+    """
+    snap = StockSnapshot.objects.filter(data__lte=d).order_by("-data").first()
+    if snap is None:
+        # срезов ещё нет — остаток считается по всему журналу
+        return {"snap": 0, "upto": 0, "tail": 0, "snap_end": None, "end": _day_end(d)}
+    return {"snap": snap.pk, "upto": snap.upto_xid, "tail": snap.tail_xid,
+            "snap_end": _day_end(snap.data), "end": _day_end(d)}
+
+
+# движения журнала после среза _snapshot_bounds (к условию добавляется пара)
+_AFTER_SNAPSHOT_SQL = """
+    xid >= %(tail)s AND created_at < %(end)s
+    AND NOT (xid < %(upto)s AND created_at < %(snap_end)s)
+"""
+
+
+def stock_as_of(d: date, magazin_id: int | None = None, tovar_ids=None) -> dict[int, int]:
+    """
+    Остатки магазина (magazin_id=None — центрального склада) на конец дня d:
+    {id_tovar: количество}, без нулевых. Ближайший срез + движения журнала после него.
+    """
+    where_mag = "id_magazin IS NULL" if magazin_id is None else "id_magazin = %(mag)s"
+    only = "WHERE t.id = ANY(%(ids)s)" if tovar_ids is not None else ""
+    with connection.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT t.id, COALESCE(s.kolichestvo, 0) + COALESCE(m.qty, 0) AS qty
+              FROM tovar AS t
+              LEFT JOIN LATERAL (
+                    SELECT i.kolichestvo
+                      FROM stock_snapshot_item AS i
+                     WHERE i.{where_mag} AND i.id_tovar = t.id AND i.id_snapshot <= %(snap)s
+                     ORDER BY i.id_snapshot DESC
+                     LIMIT 1
+              ) AS s ON TRUE
+              LEFT JOIN (
+                    SELECT id_tovar, SUM(kolichestvo) AS qty
+                      FROM stock_movement
+                     WHERE {where_mag} AND {_AFTER_SNAPSHOT_SQL}
+                     GROUP BY id_tovar
+              ) AS m ON m.id_tovar = t.id
+              {only}
+            """,
+            {**_snapshot_bounds(d), "mag": magazin_id, "ids": list(tovar_ids or [])},
+        )
+        return {tid: int(qty) for tid, qty in cur.fetchall() if qty}
+
+
+def tovar_stock_as_of(d: date, tovar_id: int, magazin_ids=None) -> dict[int | None, int]:
+    """
+    Остатки товара на конец дня d по магазинам: {id_magazin: количество};
+    ключ None — центральный склад (только если magazin_ids не задан).
+    """
+    only = "WHERE mg.id = ANY(%(ids)s)" if magazin_ids is not None else ""
+    with connection.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT mg.id, COALESCE(s.kolichestvo, 0) + COALESCE(m.qty, 0) AS qty
+              FROM magazin AS mg
+              LEFT JOIN LATERAL (
+                    SELECT i.kolichestvo
+                      FROM stock_snapshot_item AS i
+                     WHERE i.id_magazin = mg.id AND i.id_tovar = %(tovar)s AND i.id_snapshot <= %(snap)s
+                     ORDER BY i.id_snapshot DESC
+                     LIMIT 1
+              ) AS s ON TRUE
+              LEFT JOIN (
+                    SELECT id_magazin, SUM(kolichestvo) AS qty
+                      FROM stock_movement
+                     WHERE id_tovar = %(tovar)s AND id_magazin IS NOT NULL AND {_AFTER_SNAPSHOT_SQL}
+                     GROUP BY id_magazin
+              ) AS m ON m.id_magazin = mg.id
+              {only}
+            """,
+            {**_snapshot_bounds(d), "tovar": tovar_id, "ids": list(magazin_ids or [])},
+        )
+        result = {mid: int(qty) for mid, qty in cur.fetchall() if qty}
+    if magazin_ids is None:
+        central = stock_as_of(d, None, [tovar_id]).get(tovar_id)
+        if central:
+            result[None] = central
+    return result
+
+
+# ===== План закупок =====
+
+PURCHASE_PLAN_RULES = ("recent", "frequent")
+PURCHASE_PLAN_TIMEOUT = 60 * 60
+PURCHASE_PLAN_COMPACT_ROWS = 1000
+
+
+def _purchase_plan_version(cur) -> int | None:
+    """
+    Версия данных плана закупок: сумма purchase_plan_change (её пополняют триггеры
+    миграции 0023 при любом изменении поставок, заявок и остатков центрального склада).
+    Строка изменения видна только после COMMIT, поэтому версия растёт вместе
+    с зафиксированными данными, в каком бы процессе они ни менялись.
+    None — текущая транзакция сама что-то писала: её версию могут увидеть другие
+    только после COMMIT (а при откате — никогда), такой план не кэшируется.
+    """
+    cur.execute(
+        "SELECT COALESCE(SUM(n), 0), COUNT(*), pg_current_xact_id_if_assigned() IS NOT NULL "
+        "FROM purchase_plan_change"
+    )
+    version, rows, own_writes = cur.fetchone()
+    if own_writes:
+        return None
+    if rows > PURCHASE_PLAN_COMPACT_ROWS:
+        # свёртка в одну строку сумму не меняет — ключи кэша остаются верными
+        cur.execute(
+            """
+            WITH d AS (DELETE FROM purchase_plan_change RETURNING n)
+            INSERT INTO purchase_plan_change (n) SELECT SUM(n) FROM d HAVING COUNT(*) > 0
+            """
+        )
+    return int(version)
+
+
+def purchase_plan(rule: str = "recent") -> list[dict]:
+    """
+    План закупок у поставщиков.
+    Потребность по товару — сумма позиций заявок в статусах DRAFT/SENT минус остаток
+    центрального склада (с под-счётчиками); поставщик выбирается по истории поставок:
+    rule="recent" — последний по дате поставки, rule="frequent" — чаще всего поставлявший.
+    Считается одним запросом. Результат кэшируется (кэш Django, по умолчанию — в памяти
+    процесса) с версией данных из БД в ключе (_purchase_plan_version): любое
+    зафиксированное изменение меняет ключ во всех процессах, общий кэш не нужен.
+    Возвращает [{"postavshchik_id", "postavshchik", "items": [...], "total"}],
+    товары без истории поставок — в группе с postavshchik_id=None.
+    """
+    if rule not in PURCHASE_PLAN_RULES:
+        raise ValueError(f"Неизвестное правило выбора поставщика: {rule}")
+    with connection.cursor() as cur:
+        version = _purchase_plan_version(cur)
+    # версия читается до плана: план считается по снимку не старше версии
+    key = f"purchase_plan:{rule}:{version}"
+    if version is not None:
+        plan = cache.get(key)
+        if plan is not None:
+            return plan
+
+    order = "last DESC NULLS LAST, n DESC" if rule == "recent" else "n DESC, last DESC NULLS LAST"
+    with connection.cursor() as cur:
+        cur.execute(
+            f"""
+            WITH demand AS (
+                SELECT zi.id_tovar, SUM(zi.kolichestvo) AS qty
+                  FROM zayavka_item AS zi
+                  JOIN zayavka AS z ON z.id = zi.id_zayavka
+                 WHERE z.status IN (%s, %s)
+                 GROUP BY zi.id_tovar
+            ),
+            deficit AS (
+                SELECT t.id AS id_tovar, t.nazvanie, d.qty AS demand,
+                       COALESCE(t.kolichestvo_na_sklade, 0) + COALESCE(s.delta, 0) AS stock
+                  FROM demand AS d
+                  JOIN tovar AS t ON t.id = d.id_tovar
+                  LEFT JOIN (SELECT id_tovar, SUM(delta) AS delta FROM tovar_stripe GROUP BY id_tovar) AS s
+                         ON s.id_tovar = t.id
+            ),
+            pick AS (
+                SELECT DISTINCT ON (id_tovar) id_tovar, id_postavshchik
+                  FROM (SELECT id_tovar, id_postavshchik, COUNT(*) AS n, MAX(data_postavki) AS last
+                          FROM postavka
+                         WHERE id_tovar IN (SELECT id_tovar FROM deficit WHERE demand > stock)
+                         GROUP BY id_tovar, id_postavshchik) AS h
+                 ORDER BY id_tovar, {order}, id_postavshchik
+            )
+            SELECT p.id_postavshchik, ps.nazvanie, d.id_tovar, d.nazvanie,
+                   d.demand, d.stock, d.demand - d.stock
+              FROM deficit AS d
+              LEFT JOIN pick AS p ON p.id_tovar = d.id_tovar
+              LEFT JOIN postavshchik AS ps ON ps.id = p.id_postavshchik
+             WHERE d.demand > d.stock
+             ORDER BY ps.nazvanie NULLS LAST, d.nazvanie
+            """,
+            [Zayavka.Status.DRAFT, Zayavka.Status.SENT],
+        )
+        rows = cur.fetchall()
+
+    groups = {}
+    for pid, pname, tid, tname, demand, stock, qty in rows:
+        g = groups.setdefault(pid, {
+            "postavshchik_id": pid,
+            "postavshchik": pname or "Поставщик не определён",
+            "items": [],
+            "total": 0,
+        })
+        g["items"].append({
+            "tovar_id": tid, "tovar": tname,
+            "demand": int(demand), "stock": int(stock), "qty": int(qty),
+        })
+        g["total"] += int(qty)
+    plan = list(groups.values())
+    if version is not None:
+        cache.set(key, plan, PURCHASE_PLAN_TIMEOUT)
+    return plan
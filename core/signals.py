@@ -1,62 +1,14 @@
-from decimal import Decimal, ROUND_HALF_UP
-
-from django.db.models.signals import pre_save, post_save, pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
-from django.db.models import F
-from django.db.models.functions import Coalesce
 from django.db.models.signals import post_migrate
 from django.contrib.auth.models import Group, Permission
-from .models import Postavka, Tovar
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import UserProfile
-
-def _qty_to_int(qty) -> int:
-    
-    if qty is None:
-        return 0
-    if isinstance(qty, Decimal):
-        return int(qty.to_integral_value(rounding=ROUND_HALF_UP))
-    return int(qty)
-
-
-@receiver(pre_save, sender=Postavka)
-def postavka_pre_save(sender, instance: Postavka, **kwargs):
-    if instance.pk:
-        old = Postavka.objects.filter(pk=instance.pk).only("kolichestvo", "id_tovar").first()
-        instance._old_qty_int = _qty_to_int(old.kolichestvo) if old else 0
-        instance._old_tovar_id = old.id_tovar_id if old else None
-    else:
-        instance._old_qty_int = 0
-        instance._old_tovar_id = None
-
-
-@receiver(post_save, sender=Postavka)
-def postavka_post_save(sender, instance: Postavka, created, **kwargs):
-    new_qty = _qty_to_int(instance.kolichestvo)
-    old_qty = getattr(instance, "_old_qty_int", 0)
-    old_tovar_id = getattr(instance, "_old_tovar_id", None)
-
-    if old_tovar_id and old_tovar_id != instance.id_tovar_id and old_qty:
-        Tovar.objects.filter(pk=old_tovar_id).update(
-            kolichestvo_na_sklade=Coalesce(F("kolichestvo_na_sklade"), 0) - old_qty
-        )
-        old_qty = 0
-
-    delta = new_qty - old_qty
-    if delta:
-        Tovar.objects.filter(pk=instance.id_tovar_id).update(
-            kolichestvo_na_sklade=Coalesce(F("kolichestvo_na_sklade"), 0) + delta
-        )
-
+from .models import MagazinTovar, StockMovement, UserProfile
+from .services import notify_stock_changed
 
-@receiver(pre_delete, sender=Postavka)
-def postavka_pre_delete(sender, instance: Postavka, **kwargs):
-    qty = _qty_to_int(instance.kolichestvo)
-    if qty:
-        Tovar.objects.filter(pk=instance.id_tovar_id).update(
-            kolichestvo_na_sklade=Coalesce(F("kolichestvo_na_sklade"), 0) - qty
-        )
+# Остатки центрального склада по поставкам ведут триггеры БД на таблице postavka
+# (миграция 0009_postavka_stock_triggers), а не сигналы Django.
 
 ROLE_GROUPS = {
     # Владелец сети — полный доступ ко всем моделям core + доступ к SQL-консоли
@@ -70,6 +22,8 @@ ROLE_GROUPS = {
         "models": [
             # операции
             "zayavka", "zayavkaitem", "vyruchka", "tovarvyruchka",
+            "peremeshchenie", "peremeshchenieitem",
+            "inventarizaciya", "inventarizaciyaitem",
             "postavka", "postavshchik",
             # магазины/склады
             "magazin", "otdel", "magazintovar", "tovar",
@@ -97,16 +51,19 @@ ROLE_GROUPS = {
         "extra": [],
     },
 
-    # Заведующий складом магазина — формирование заявок и ведение остатков магазина.
+    # Заведующий складом магазина — формирование заявок, перемещения со своего склада,
+    # инвентаризации и ведение остатков магазина.
     "Заведующий складом магазина": {
         "models": [
             "zayavka", "zayavkaitem",
+            "peremeshchenie", "peremeshchenieitem",
+            "inventarizaciya", "inventarizaciyaitem",
             "magazintovar",
             # товары/справочники ему не даём прав на редактирование через групповые perms;
             # выбор товара для заявки работает и без отдельного view_tovar.
         ],
         "actions": ["view", "add", "change"],
-        "extra": [],
+        "extra": ["post_peremeshchenie", "post_inventarizaciya"],
     },
 
     # Менеджер по закупкам — работа с поставщиками/поставками/товарами,
@@ -158,7 +115,7 @@ def create_groups_and_perms(sender, **kwargs):
             codenames = [f"{a}_{m}" for m in models for a in actions]
             perms = list(Permission.objects.filter(content_type__app_label="core", codename__in=codenames))
 
-        # кастомные права (sql_console / approve_zayavka)
+        # кастомные права (sql_console / approve_zayavka / post_peremeshchenie / post_inventarizaciya)
         extra = cfg.get("extra", [])
         if extra:
             perms += list(Permission.objects.filter(content_type__app_label="core", codename__in=extra))
@@ -170,4 +127,24 @@ User = get_user_model()
 @receiver(post_save, sender=User)
 def ensure_profile(sender, instance, created, **kwargs):
     if created:
-        UserProfile.objects.get_or_create(user=instance)
\ No newline at end of file
+        UserProfile.objects.get_or_create(user=instance)
+
+# Кэш остатков в памяти процессов (core/stock_cache.py) обновляется по NOTIFY;
+# складские сервисы шлют его сами, здесь — правки magazin_tovar через ORM (админка, формы).
+@receiver([post_save, post_delete], sender=MagazinTovar)
+def magazin_tovar_changed(sender, instance, **kwargs):
+    notify_stock_changed([(instance.id_magazin_id, instance.id_tovar_id)])
+
+
+# Удаление позиции через ORM (админка) списывает её остаток: движение в журнал, чтобы
+# журнал сходился с magazin_tovar. pre_delete приходит внутри транзакции удаления,
+# остаток перечитывается под блокировкой — объект в памяти мог устареть.
+@receiver(pre_delete, sender=MagazinTovar)
+def magazin_tovar_deleted(sender, instance, **kwargs):
+    qty = (MagazinTovar.objects.select_for_update()
+           .filter(pk=instance.pk).values_list("kolichestvo", flat=True).first())
+    if qty:
+        StockMovement.objects.create(
+            doc_type=StockMovement.DocType.KORREKTIROVKA,
+            id_magazin_id=instance.id_magazin_id, id_tovar_id=instance.id_tovar_id, kolichestvo=-qty,
+        )
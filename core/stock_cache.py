@@ -0,0 +1,232 @@
+"""
+Кэш остатков магазинов в памяти процесса.
+
+Кассы и форма выручки много раз в секунду спрашивают «сколько товара T
+в магазине M». StockCache держит остатки magazin_tovar матрицей магазин × товар
+(NumPy, int32) и отвечает на такие вопросы без обращения к БД.
+
+Матрица загружается целиком при первом обращении, дальше её поддерживает
+фоновый поток: он слушает канал services.STOCK_CHANNEL (LISTEN/NOTIFY),
+куда сервисы остатков пишут изменившиеся пары (магазин, товар), и перечитывает
+из БД только эти ячейки. Уведомления приходят после COMMIT, поэтому в матрицу
+попадают только зафиксированные остатки.
+
+Кэш честно признаёт, когда не может ответить: пока поток не подключён
+(уведомления могли потеряться) или если магазин/товар появился после загрузки
+(индекс матрицы устарел), lookup() возвращает None для таких пар, и вызывающий
+берёт значение из БД (db_stock). После переподключения матрица грузится заново.
+"""
+import logging
+import select
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, connections, transaction
+
+from . import metrics
+from .services import STOCK_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+
+class _State:
+    """Неизменяемый снимок индекса; сама матрица stock обновляется на месте."""
+    __slots__ = ("magazin", "tovar", "stock", "version")
+
+    def __init__(self, magazin: dict, tovar: dict, stock: np.ndarray, version: int):
+        self.magazin = magazin      # id магазина -> строка матрицы
+        self.tovar = tovar          # id товара -> столбец матрицы
+        self.stock = stock          # (M, T) int32
+        self.version = version      # номер загрузки
+
+
+class StockCache:
+    def __init__(self, channel: str = STOCK_CHANNEL, poll_seconds: float = 5, reconnect_seconds: float = 1):
+        self.channel = channel
+        self.poll = poll_seconds
+        self.reconnect = reconnect_seconds
+        self.synced = False
+        self.applied = 0            # применённых уведомлений с последней загрузки
+        self._state = _State({}, {}, np.zeros((0, 0), dtype=np.int32), 0)
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def version(self) -> int:
+        return self._state.version
+
+    def start(self, wait: float = 10):
+        """Запускает поток-слушатель и ждёт первой загрузки матрицы (не дольше wait секунд)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="stock-cache", daemon=True)
+            self._thread.start()
+        self._ready.wait(wait)
+
+    def stop(self, wait: float = 10):
+        """Останавливает слушателя (не дольше чем через poll секунд) и закрывает его соединение."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(wait)
+        self.synced = False
+
+    # --- чтение ---
+
+    def lookup(self, pairs) -> list:
+        """
+        pairs: [(magazin_id, tovar_id)] -> [количество | None].
+        None — ответа из памяти нет (кэш не синхронизирован или id не в индексе).
+        """
+        st = self._state
+        if not self.synced:
+            return [None] * len(pairs)
+        out = []
+        for mid, tid in pairs:
+            i = st.magazin.get(mid)
+            j = st.tovar.get(tid)
+            out.append(None if i is None or j is None else int(st.stock[i, j]))
+        return out
+
+    # --- поток-слушатель ---
+
+    def _run(self):
+        conn = connections["default"]
+        while not self._stop.is_set():
+            try:
+                conn.ensure_connection()
+                with conn.cursor() as cur:
+                    # сначала LISTEN, потом загрузка — изменения между ними не теряются
+                    cur.execute(f'LISTEN "{self.channel}"')
+                    self._load(cur)
+                self._ready.set()
+                self._listen(conn)
+            except Exception:
+                logger.exception("stock cache: соединение потеряно, перезагрузка через %ss", self.reconnect)
+                self.synced = False
+                metrics.incr("stock_cache_reconnect")
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                self._stop.wait(self.reconnect)
+        conn.close()
+
+    def _listen(self, conn):
+        raw = conn.connection
+        while not self._stop.is_set():
+            # уведомления, пришедшие во время своих запросов, уже лежат в raw.notifies;
+            # poll() и по таймауту — оборванное соединение обнаружится не позже чем через self.poll
+            if not raw.notifies:
+                select.select([raw], [], [], self.poll)
+            raw.poll()
+            keys = set()
+            while raw.notifies:
+                keys.update(_parse(raw.notifies.pop(0).payload))
+            if keys:
+                with conn.cursor() as cur:
+                    self._apply(cur, keys)
+
+    def _load(self, cur):
+        # три чтения — из одного снимка: иначе магазин/товар, созданный между ними,
+        # попал бы в magazin_tovar без строки/столбца в индексе матрицы
+        with transaction.atomic(using=cur.db.alias):
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            cur.execute("SELECT id FROM magazin ORDER BY id")
+            magazin = {mid: i for i, (mid,) in enumerate(cur.fetchall())}
+            cur.execute("SELECT id FROM tovar ORDER BY id")
+            tovar = {tid: j for j, (tid,) in enumerate(cur.fetchall())}
+            cur.execute("SELECT id_magazin, id_tovar, kolichestvo FROM magazin_tovar WHERE kolichestvo <> 0")
+            rows = cur.fetchall()
+        stock = np.zeros((len(magazin), len(tovar)), dtype=np.int32)
+        if rows:
+            a = np.array(rows, dtype=np.int64)
+            i = np.array([magazin[m] for m in a[:, 0].tolist()], dtype=np.int64)
+            j = np.array([tovar[t] for t in a[:, 1].tolist()], dtype=np.int64)
+            stock[i, j] = a[:, 2]
+        self._state = _State(magazin, tovar, stock, self._state.version + 1)
+        self.applied = 0
+        self.synced = True
+        metrics.incr("stock_cache_load")
+
+    def _apply(self, cur, keys):
+        mids, tids = zip(*keys)
+        cur.execute(
+            """
+            SELECT v.id_magazin, v.id_tovar, COALESCE(mt.kolichestvo, 0)
+              FROM unnest(%s::int[], %s::int[]) AS v(id_magazin, id_tovar)
+              LEFT JOIN magazin_tovar AS mt ON mt.id_magazin = v.id_magazin AND mt.id_tovar = v.id_tovar
+            """,
+            [list(mids), list(tids)],
+        )
+        st = self._state
+        for mid, tid, qty in cur.fetchall():
+            i = st.magazin.get(mid)
+            j = st.tovar.get(tid)
+            if i is None or j is None:
+                # новый магазин/товар — индекс устарел, проще загрузить матрицу заново
+                self._load(cur)
+                return
+            st.stock[i, j] = qty
+        self.applied += 1
+
+
+def _parse(payload: str):
+    for part in payload.split(","):
+        mid, _, tid = part.partition(":")
+        if mid and tid:
+            yield int(mid), int(tid)
+
+
+def db_stock(pairs) -> list[int]:
+    """Остатки magazin_tovar для пар [(magazin_id, tovar_id)] одним запросом (в порядке pairs)."""
+    if not pairs:
+        return []
+    mids, tids = zip(*pairs)
+    with connection.cursor() as cur:
+        cur.execute(
+            """
+            SELECT COALESCE(mt.kolichestvo, 0)
+              FROM unnest(%s::int[], %s::int[]) WITH ORDINALITY AS v(id_magazin, id_tovar, n)
+              LEFT JOIN magazin_tovar AS mt ON mt.id_magazin = v.id_magazin AND mt.id_tovar = v.id_tovar
+             ORDER BY v.n
+            """,
+            [list(mids), list(tids)],
+        )
+        return [qty for (qty,) in cur.fetchall()]
+
+
+def stock_lookup(pairs) -> tuple[list[int], str]:
+    """
+    Остатки для пар [(magazin_id, tovar_id)]: из памяти, а пары, на которые
+    кэш ответить не может, — из БД. Возвращает (количества, источник):
+    источник "memory", "db" или "mixed".
+    """
+    pairs = list(pairs)
+    cache = get_stock_cache()
+    result = cache.lookup(pairs) if cache is not None else [None] * len(pairs)
+    miss = [n for n, qty in enumerate(result) if qty is None]
+    metrics.incr("stock_cache_hit", n=len(pairs) - len(miss))
+    if not miss:
+        return result, "memory"
+    metrics.incr("stock_cache_miss", n=len(miss))
+    for n, qty in zip(miss, db_stock([pairs[n] for n in miss])):
+        result[n] = qty
+    return result, "db" if len(miss) == len(pairs) else "mixed"
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_stock_cache() -> StockCache | None:
+    """Кэш остатков процесса; None, если выключен в settings.STOCK_CACHE."""
+    global _cache
+    conf = getattr(settings, "STOCK_CACHE", {})
+    if not conf.get("ENABLED"):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = StockCache(poll_seconds=conf.get("POLL_SECONDS", 5))
+            _cache.start(wait=conf.get("LOAD_WAIT_SECONDS", 10))
+        return _cache
@@ -1,3 +1,719 @@
-from django.test import TestCase
+import io
+import threading
+import time
+from datetime import date, timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+
+from . import services
+from .group_commit import SalesGroupWriter, _Slot
+from .planning import StockMatrix, plan_rebalance
+from .stock_cache import StockCache, get_stock_cache
+from .models import (
+    Inventarizaciya, Magazin, MagazinTovar, Peremeshchenie, PeremeshchenieItem, Postavka, Postavshchik, StockBalance,
+    StockMovement, Tovar, TovarVyruchka, Vyruchka, VyruchkaArkhiv, Zayavka, ZayavkaApproveJob, ZayavkaItem,
+)
+from .services import (
+    InventarizaciyaError, StockError, ZayavkaApproveError, _fair_share, apply_vyruchka_stock, approve_zayavka,
+    approve_zayavki, central_stock_expr, compact_stock_movements, consolidate_zayavki, detach_vyruchka_partitions,
+    ensure_vyruchka_partitions, fix_stock_diff, import_vyruchka, inventarizaciya_variance, ledger_balance,
+    load_inventarizaciya_items, magazin_stock_diff, post_inventarizaciya, post_peremeshchenie, purchase_plan,
+    run_approval_job, set_tovar_stripes, stock_as_of, take_stock_snapshot, tovar_stock_as_of,
+)
+
+
+class StripedApproveConcurrencyTest(TransactionTestCase):
+    """Две параллельные заявки на один товар с под-счётчиками не продают склад дважды."""
+
+    def setUp(self):
+        self.magazin = Magazin.objects.create(nazvanie="M")
+        self.tovar = Tovar.objects.create(nazvanie="T", kolichestvo_na_sklade=10)
+        set_tovar_stripes([self.tovar.pk], 4)
+
+    def zayavka(self, qty):
+        z = Zayavka.objects.create(id_magazin=self.magazin, status=Zayavka.Status.SENT)
+        ZayavkaItem.objects.create(id_zayavka=z, id_tovar=self.tovar, kolichestvo=qty)
+        return z
+
+    def test_second_approval_sees_striped_debit(self):
+        za, zb = self.zayavka(7), self.zayavka(7)
+        a_approved, b_started = threading.Event(), threading.Event()
+        errors = {}
+
+        def first():
+            try:
+                with transaction.atomic():
+                    approve_zayavka(za)
+                    a_approved.set()
+                    # держим блокировку tovar, пока второй не встанет на ней в очередь
+                    b_started.wait(5)
+                    time.sleep(0.5)
+            finally:
+                a_approved.set()
+                connection.close()
+
+        def second():
+            a_approved.wait(5)
+            b_started.set()
+            try:
+                approve_zayavka(zb)
+            except ZayavkaApproveError as e:
+                errors["b"] = e
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=first), threading.Thread(target=second)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+
+        self.assertIn("b", errors)
+        self.assertEqual(errors["b"].shortfalls[0][2], 3)
+        za.refresh_from_db()
+        zb.refresh_from_db()
+        self.assertEqual((za.status, zb.status), (Zayavka.Status.APPROVED, Zayavka.Status.SENT))
+        stock = Tovar.objects.annotate(s=central_stock_expr()).get(pk=self.tovar.pk).s
+        self.assertEqual(stock, 3)
+
+
+class DetachedVyruchkaReconcileTest(TestCase):
+    """Продажи отсоединённых секций остаются в ожидаемом остатке сверки."""
+
+    def test_archived_sales_counted(self):
+        magazin = Magazin.objects.create(nazvanie="M")
+        tovar = Tovar.objects.create(nazvanie="T")
+        z = Zayavka.objects.create(id_magazin=magazin, status=Zayavka.Status.APPROVED)
+        ZayavkaItem.objects.create(id_zayavka=z, id_tovar=tovar, kolichestvo=10)
+        MagazinTovar.objects.create(id_magazin=magazin, id_tovar=tovar, kolichestvo=7)
+        v = Vyruchka.objects.create(id_magazin=magazin, data=date(2025, 1, 15))
+        TovarVyruchka.objects.create(id_vyruchka=v, id_tovar=tovar, kolichestvo=3, summa=30)
+        ensure_vyruchka_partitions(ahead=0, today=date(2025, 1, 1))
+        self.assertEqual(magazin_stock_diff([magazin.pk]), [])
+
+        detached = detach_vyruchka_partitions(keep_months=3, today=date(2026, 10, 18))
+        self.assertIn("vyruchka_y2025m01", detached)
+        self.assertFalse(Vyruchka.objects.filter(pk=v.pk).exists())
+        arkhiv = VyruchkaArkhiv.objects.get(id_magazin=magazin, id_tovar=tovar)
+        self.assertEqual((arkhiv.mesyac, arkhiv.kolichestvo), (date(2025, 1, 1), 3))
+        self.assertEqual(magazin_stock_diff([magazin.pk]), [])
+
+
+class StockDiffTest(TestCase):
+    """Сверка находит расхождения magazin_tovar с документами, исправление применяет разницу."""
+
+    def test_diff_and_fix(self):
+        magazin = Magazin.objects.create(nazvanie="M")
+        a = Tovar.objects.create(nazvanie="A", kolichestvo_na_sklade=10)
+        b = Tovar.objects.create(nazvanie="B")
+        z = Zayavka.objects.create(id_magazin=magazin, status=Zayavka.Status.SENT)
+        ZayavkaItem.objects.create(id_zayavka=z, id_tovar=a, kolichestvo=4)
+        approve_zayavka(z)
+
+        def sell(qty):
+            v = Vyruchka.objects.create(id_magazin=magazin)
+            TovarVyruchka.objects.create(id_vyruchka=v, id_tovar=a, kolichestvo=qty, summa=qty)
+            apply_vyruchka_stock(magazin.pk, {a.pk: qty}, doc_id=v.pk)
+
+        sell(1)
+        self.assertEqual(magazin_stock_diff([magazin.pk]), [])
+
+        # правки в обход документов: QuerySet.update / bulk_create не пишут журнал
+        MagazinTovar.objects.filter(id_magazin=magazin, id_tovar=a).update(kolichestvo=7)
+        MagazinTovar.objects.bulk_create([MagazinTovar(id_magazin=magazin, id_tovar=b, kolichestvo=2)])
+        diff = magazin_stock_diff([magazin.pk])
+        self.assertEqual(diff, [(magazin.pk, a.pk, 7, 3), (magazin.pk, b.pk, 2, 0)])
+
+        # продажа между сверкой и исправлением меняет обе стороны одинаково
+        sell(1)
+        fix_stock_diff(diff)
+
+        self.assertEqual(magazin_stock_diff([magazin.pk]), [])
+        self.assertEqual(
+            dict(MagazinTovar.objects.filter(id_magazin=magazin).values_list("id_tovar_id", "kolichestvo")),
+            {a.pk: 2, b.pk: 0},
+        )
+        self.assertEqual(StockMovement.objects.filter(doc_type=StockMovement.DocType.KORREKTIROVKA).count(), 2)
+
+
+class InventarizaciyaPostTest(TestCase):
+    """Проведение инвентаризации выставляет остаток по факту и пишет расхождения в журнал."""
+
+    def test_post(self):
+        magazin = Magazin.objects.create(nazvanie="M")
+        a, b, c = (Tovar.objects.create(nazvanie=name) for name in "ABC")
+        MagazinTovar.objects.create(id_magazin=magazin, id_tovar=a, kolichestvo=5)
+        MagazinTovar.objects.create(id_magazin=magazin, id_tovar=b, kolichestvo=3)
+        inv = Inventarizaciya.objects.create(id_magazin=magazin)
+        load_inventarizaciya_items(inv, {a.pk: 5, b.pk: 1, c.pk: 4})
+        # повторная загрузка товара перезаписывает факт
+        load_inventarizaciya_items(inv, {b.pk: 2})
+        self.assertEqual(
+            [(r["id_tovar"], r["uchet"], r["fakt"], r["diff"]) for r in inventarizaciya_variance(inv, only_diff=True)],
+            [(b.pk, 3, 2, -1), (c.pk, 0, 4, 4)],
+        )
+
+        self.assertEqual(post_inventarizaciya(inv), 2)
+
+        inv.refresh_from_db()
+        self.assertEqual(inv.status, Inventarizaciya.Status.DONE)
+        self.assertEqual(
+            dict(MagazinTovar.objects.filter(id_magazin=magazin).values_list("id_tovar_id", "kolichestvo")),
+            {a.pk: 5, b.pk: 2, c.pk: 4},
+        )
+        self.assertEqual(
+            sorted(StockMovement.objects.filter(doc_type=StockMovement.DocType.INVENTARIZACIYA, doc_id=inv.pk)
+                   .values_list("id_tovar_id", "kolichestvo")),
+            [(b.pk, -1), (c.pk, 4)],
+        )
+        self.assertEqual([ledger_balance(t.pk, magazin.pk) for t in (a, b, c)], [5, 2, 4])
+
+        # после проведения учётный остаток — на момент проведения
+        apply_vyruchka_stock(magazin.pk, {a.pk: 1})
+        self.assertEqual([r["uchet"] for r in inventarizaciya_variance(inv)], [5, 3, 0])
+        with self.assertRaises(InventarizaciyaError):
+            post_inventarizaciya(inv)
+
+
+class VyruchkaTotalsTest(TestCase):
+    """Итоги чека ищутся по (id, data) и переживают смену даты чека."""
+
+    def test_totals_follow_date_change(self):
+        magazin = Magazin.objects.create(nazvanie="M")
+        tovar = Tovar.objects.create(nazvanie="T")
+        v = Vyruchka.objects.create(id_magazin=magazin, data=date(2026, 10, 3))
+        TovarVyruchka.objects.create(id_vyruchka=v, id_tovar=tovar, kolichestvo=2, summa=20)
+        TovarVyruchka.objects.create(id_vyruchka=v, id_tovar=tovar, kolichestvo=1, summa=10)
+
+        v.data = date(2026, 11, 2)
+        v.save()
+        TovarVyruchka.objects.filter(id_vyruchka=v, kolichestvo=1).delete()
+
+        v = Vyruchka.objects.get(pk=v.pk)
+        self.assertEqual((v.qty, v.amount, v.items_cnt), (2, 20, 1))
+
+
+class ApprovalJobErrorTest(TestCase):
+    """Непредвиденная ошибка проведения помечает задание FAILED, а не оставляет его в очереди."""
+
+    def test_unexpected_error_fails_job(self):
+        magazin = Magazin.objects.create(nazvanie="M")
+        z = Zayavka.objects.create(id_magazin=magazin, status=Zayavka.Status.SENT)
+        job = ZayavkaApproveJob.objects.create(id_zayavka=z)
+
+        with mock.patch("core.services.approve_zayavka", side_effect=RuntimeError("boom")):
+            self.assertEqual(run_approval_job().pk, job.pk)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (ZayavkaApproveJob.Status.FAILED, "RuntimeError: boom"))
+        self.assertIsNotNone(job.finished_at)
+        self.assertIsNone(run_approval_job())
+
+
+class ApplyVyruchkaStockTest(TestCase):
+    """Продажа списывает условным UPDATE: нехватка откатывает весь чек, возврат создаёт недостающую строку."""
+
+    def setUp(self):
+        self.magazin = Magazin.objects.create(nazvanie="M")
+        self.a = Tovar.objects.create(nazvanie="A")
+        self.b = Tovar.objects.create(nazvanie="B")
+        MagazinTovar.objects.create(id_magazin=self.magazin, id_tovar=self.a, kolichestvo=5)
+
+    def stock(self):
+        return dict(MagazinTovar.objects.filter(id_magazin=self.magazin).values_list("id_tovar_id", "kolichestvo"))
+
+    def test_sale(self):
+        apply_vyruchka_stock(self.magazin.pk, {self.a.pk: 3}, doc_id=1)
+        self.assertEqual(self.stock(), {self.a.pk: 2})
+        self.assertEqual(ledger_balance(self.a.pk, self.magazin.pk), 2)
+
+    def test_shortage(self):
+        with self.assertRaises(StockError) as e:
+            apply_vyruchka_stock(self.magazin.pk, {self.a.pk: 3, self.b.pk: 1})
+        self.assertEqual(str(e.exception), "Недостаточно товара на складе магазина: 'B' (остаток=0, нужно=1)")
+        # списание A тем же UPDATE откатилось вместе с транзакцией
+        self.assertEqual(self.stock(), {self.a.pk: 5})
+        self.assertFalse(StockMovement.objects.filter(doc_type=StockMovement.DocType.VYRUCHKA).exists())
+
+        with self.assertRaises(StockError) as e:
+            apply_vyruchka_stock(self.magazin.pk, {self.a.pk: 6})
+        self.assertIn("'A' (остаток=5, нужно=6)", str(e.exception))
+
+    def test_return_upsert(self):
+        apply_vyruchka_stock(self.magazin.pk, {self.a.pk: -1, self.b.pk: -2})
+        self.assertEqual(self.stock(), {self.a.pk: 6, self.b.pk: 2})
+        self.assertEqual([ledger_balance(t.pk, self.magazin.pk) for t in (self.a, self.b)], [6, 2])
+
+
+class ApproveShortfallTest(TestCase):
+    """Ошибка проведения перечисляет нехватку по всем позициям сразу и ничего не списывает."""
+
+    def test_all_shortfalls(self):
+        z = Zayavka.objects.create(id_magazin=Magazin.objects.create(nazvanie="M"), status=Zayavka.Status.SENT)
+        tovary = [Tovar.objects.create(nazvanie=name, kolichestvo_na_sklade=qty) for name, qty in
+                  (("A", 2), ("B", 10), ("C", 0))]
+        for tovar, qty in zip(tovary, (5, 3, 1)):
+            ZayavkaItem.objects.create(id_zayavka=z, id_tovar=tovar, kolichestvo=qty)
+        a, _, c = tovary
+
+        with self.assertRaises(ZayavkaApproveError) as e:
+            approve_zayavka(z)
+
+        self.assertEqual(e.exception.shortfalls, [(a.pk, "A", 2, 5), (c.pk, "C", 0, 1)])
+        self.assertEqual(
+            str(e.exception),
+            "Недостаточно товара на центральном складе: 'A' (остаток 2, нужно 5); 'C' (остаток 0, нужно 1)",
+        )
+        z.refresh_from_db()
+        self.assertEqual(z.status, Zayavka.Status.SENT)
+        self.assertEqual(list(Tovar.objects.order_by("pk").values_list("kolichestvo_na_sklade", flat=True)), [2, 10, 0])
+        self.assertFalse(MagazinTovar.objects.exists())
+        self.assertFalse(StockMovement.objects.exists())
+
+
+class ApproveZayavkiTest(TestCase):
+    """Массовое проведение: результат по каждой заявке, порции — отдельными транзакциями."""
+
+    def setUp(self):
+        self.magazin = Magazin.objects.create(nazvanie="M")
+        self.tovar = Tovar.objects.create(nazvanie="T", kolichestvo_na_sklade=10)
+
+    def zayavka(self, qty, status=Zayavka.Status.SENT):
+        z = Zayavka.objects.create(id_magazin=self.magazin, status=status)
+        ZayavkaItem.objects.create(id_zayavka=z, id_tovar=self.tovar, kolichestvo=qty)
+        return z
+
+    def test_result_per_zayavka(self):
+        ok, draft, short = self.zayavka(7), self.zayavka(1, Zayavka.Status.DRAFT), self.zayavka(5)
+        empty = Zayavka.objects.create(id_magazin=self.magazin, status=Zayavka.Status.SENT)
+
+        result = approve_zayavki([empty.pk, short.pk, ok.pk, draft.pk, ok.pk])
+
+        self.assertEqual(list(result), [ok.pk, draft.pk, short.pk, empty.pk])
+        self.assertIsNone(result[ok.pk])
+        self.assertIn("Отправлена", str(result[draft.pk]))
+        self.assertEqual(result[short.pk].shortfalls, [(self.tovar.pk, "T", 3, 5)])
+        self.assertEqual(str(result[empty.pk]), "В заявке нет позиций")
+        self.assertEqual(
+            dict(Zayavka.objects.values_list("pk", "status")),
+            {ok.pk: Zayavka.Status.APPROVED, draft.pk: Zayavka.Status.DRAFT,
+             short.pk: Zayavka.Status.SENT, empty.pk: Zayavka.Status.SENT},
+        )
+        self.assertEqual(MagazinTovar.objects.get(id_magazin=self.magazin, id_tovar=self.tovar).kolichestvo, 7)
+
+    def test_chunks(self):
+        zs = [self.zayavka(3) for _ in range(5)]
+        pks = [z.pk for z in zs]
+
+        with mock.patch("core.services._approve_locked", wraps=services._approve_locked) as approve_locked:
+            result = approve_zayavki(reversed(pks), chunk_size=2)
+
+        self.assertEqual([c.args[0] for c in approve_locked.call_args_list], [pks[0:2], pks[2:4], pks[4:]])
+        self.assertEqual([pk for pk, error in result.items() if error is None], pks[:3])
+        self.assertEqual([error.shortfalls[0][2] for error in list(result.values())[3:]], [1, 1])
+        self.assertEqual(Tovar.objects.annotate(s=central_stock_expr()).get(pk=self.tovar.pk).s, 1)
+
+    def test_repeat_is_noop(self):
+        z = self.zayavka(4)
+        self.assertEqual(approve_zayavki([z.pk]), {z.pk: None})
+        self.assertEqual(approve_zayavki([z.pk]), {z.pk: None})
+        self.assertEqual(StockMovement.objects.filter(doc_id=z.pk).count(), 2)
+
+
+class FairShareTest(SimpleTestCase):
+    """Деление дефицита: не больше запроса, целые единицы, сумма — ровно остаток."""
+
+    def test_zero_weights_split_equally(self):
+        self.assertEqual(_fair_share(5, [4, 4], [0, 0]), [3, 2])
+
+    def test_total_less_than_requests(self):
+        self.assertEqual(_fair_share(2, [5, 5, 5], [1, 1, 1]), [1, 1, 0])
+
+    def test_small_request_capped_rest_redistributed(self):
+        self.assertEqual(_fair_share(10, [1, 20, 20], [1, 1, 1]), [1, 5, 4])
+
+    def test_enough_for_everyone(self):
+        self.assertEqual(_fair_share(100, [3, 0, 7], [1, 1, 1]), [3, 0, 7])
+
+    def test_largest_remainder(self):
+        self.assertEqual(_fair_share(10, [10, 5], [10, 5]), [7, 3])
+
+
+class ConsolidateZayavkiTest(TestCase):
+    """Сводное проведение урезает дефицитный товар и сохраняет исходный запрос."""
+
+    def test_cut_over_demanded_tovar(self):
+        tovar = Tovar.objects.create(nazvanie="T", kolichestvo_na_sklade=10)
+        other = Tovar.objects.create(nazvanie="O", kolichestvo_na_sklade=100)
+        zayavki = []
+        for name, items in (("A", [(tovar, 10), (other, 4)]), ("B", [(tovar, 5)])):
+            z = Zayavka.objects.create(id_magazin=Magazin.objects.create(nazvanie=name), status=Zayavka.Status.SENT)
+            for t, qty in items:
+                ZayavkaItem.objects.create(id_zayavka=z, id_tovar=t, kolichestvo=qty)
+            zayavki.append(z)
+        za, zb = zayavki
+
+        result = consolidate_zayavki("demand")
+
+        self.assertEqual(result["approved"], [za.pk, zb.pk])
+        self.assertEqual(result["cut"], [(za.pk, tovar.pk, 10, 7), (zb.pk, tovar.pk, 5, 3)])
+        self.assertEqual(
+            sorted(ZayavkaItem.objects.values_list("id_zayavka_id", "id_tovar_id", "kolichestvo",
+                                                   "kolichestvo_zaprosheno")),
+            sorted([(za.pk, tovar.pk, 7, 10), (za.pk, other.pk, 4, None), (zb.pk, tovar.pk, 3, 5)]),
+        )
+        self.assertEqual(
+            Tovar.objects.order_by("pk").annotate(s=central_stock_expr()).values_list("s", flat=True)[0], 0,
+        )
+        self.assertEqual(
+            dict(MagazinTovar.objects.filter(id_tovar=tovar).values_list("id_magazin_id", "kolichestvo")),
+            {za.id_magazin_id: 7, zb.id_magazin_id: 3},
+        )
+
+
+class MagazinTovarLedgerTest(TestCase):
+    """Правки позиции через ORM не расходятся с журналом движения."""
+
+    def test_orm_edits_keep_ledger_in_sync(self):
+        magazin = Magazin.objects.create(nazvanie="M")
+        tovar = Tovar.objects.create(nazvanie="T")
+        mt = MagazinTovar.objects.create(id_magazin=magazin, id_tovar=tovar, kolichestvo=5)
+        self.assertEqual(ledger_balance(tovar.pk, magazin.pk), 5)
+
+        # форма минимума / админка: остаток не перезаписывается
+        mt.kolichestvo, mt.min_kolichestvo = 99, 2
+        mt.save()
+        mt.refresh_from_db()
+        self.assertEqual((mt.kolichestvo, mt.min_kolichestvo), (5, 2))
+
+        MagazinTovar.objects.filter(pk=mt.pk).delete()
+        self.assertEqual(ledger_balance(tovar.pk, magazin.pk), 0)
+
+
+class SalesGroupWriterFallbackTest(TransactionTestCase):
+    """Ошибка одного чека пачки (не из-за остатков) не отклоняет соседние чеки."""
+
+    def test_bad_receipt_fails_alone(self):
+        magazin = Magazin.objects.create(nazvanie="M")
+        tovar = Tovar.objects.create(nazvanie="T")
+        MagazinTovar.objects.create(id_magazin=magazin, id_tovar=tovar, kolichestvo=5)
+
+        writer = SalesGroupWriter(window_ms=1)
+        good = _Slot(Vyruchka(id_magazin=magazin), [TovarVyruchka(id_tovar=tovar, kolichestvo=2)])
+        # несуществующий товар: FK отложенный — пачка падает на COMMIT
+        writer._pending.append(good)
+        bad = (Vyruchka(id_magazin=magazin), [TovarVyruchka(id_tovar_id=tovar.pk + 1000, kolichestvo=0)])
+
+        with self.assertRaises(IntegrityError):
+            writer.submit(*bad)
+
+        self.assertTrue(good.done)
+        self.assertIsNone(good.error)
+        self.assertEqual(Vyruchka.objects.count(), 1)
+        self.assertEqual(MagazinTovar.objects.get(id_magazin=magazin, id_tovar=tovar).kolichestvo, 3)
+
+
+class PlanRebalanceMinimumTest(SimpleTestCase):
+    """Донор отдаёт только остаток сверх своего неснижаемого минимума."""
+
+    def test_donor_keeps_minimum(self):
+        matrix = StockMatrix(
+            magazin_ids=np.array([1, 2]), tovar_ids=np.array([7]),
+            stock=np.array([[50], [0]]), velocity=np.zeros((2, 1)),
+            central=np.array([100]), minimum=np.array([[40], [30]]),
+        )
+        plan = plan_rebalance(matrix)
+        self.assertEqual(plan.transfer_docs(), [((1, 2), [(7, 10)])])
+        self.assertEqual(plan.central_docs(), [(2, [(7, 20)])])
+
+
+class VyruchkaImportTest(TestCase):
+    """Номер чека уникален в пределах магазина и дня — в выгрузке сети он повторяется."""
+
+    def test_same_chek_in_two_magazins(self):
+        m1, m2 = Magazin.objects.create(nazvanie="M1"), Magazin.objects.create(nazvanie="M2")
+        tovar = Tovar.objects.create(nazvanie="T", cena_prodazhi=10)
+        for m in (m1, m2):
+            MagazinTovar.objects.create(id_magazin=m, id_tovar=tovar, kolichestvo=10)
+        data = (
+            "chek,magazin,data,tovar,kolichestvo\n"
+            f"1,{m1.pk},2026-10-18,{tovar.pk},2\n"
+            f"1,{m2.pk},2026-10-18,{tovar.pk},3\n"
+            f"1,{m2.pk},2026-10-17,{tovar.pk},4\n"
+        )
+
+        result = import_vyruchka(io.BytesIO(data.encode()))
+        self.assertEqual((result["receipts"], result["lines"], result["duplicates"]), (3, 3, 0))
+        self.assertEqual(
+            sorted(Vyruchka.objects.values_list("id_magazin_id", "data", "qty")),
+            [(m1.pk, date(2026, 10, 18), 2), (m2.pk, date(2026, 10, 17), 4), (m2.pk, date(2026, 10, 18), 3)],
+        )
+        self.assertEqual(
+            dict(MagazinTovar.objects.values_list("id_magazin_id", "kolichestvo")), {m1.pk: 8, m2.pk: 3},
+        )
+
+        result = import_vyruchka(io.BytesIO(data.encode()))
+        self.assertEqual((result["receipts"], result["duplicates"]), (0, 3))
+
+
+class PurchasePlanCacheTest(TransactionTestCase):
+    """Кэш плана закупок сбрасывается любой зафиксированной записью, в том числе в обход ORM-сигналов."""
+
+    def setUp(self):
+        cache.clear()
+        self.postavshchik = Postavshchik.objects.create(nazvanie="P")
+        self.tovar = Tovar.objects.create(nazvanie="T", kolichestvo_na_sklade=0)
+        z = Zayavka.objects.create(id_magazin=Magazin.objects.create(nazvanie="M"), status=Zayavka.Status.SENT)
+        ZayavkaItem.objects.create(id_zayavka=z, id_tovar=self.tovar, kolichestvo=5)
+
+    def qty(self):
+        return [item["qty"] for g in purchase_plan() for item in g["items"]]
+
+    def test_bulk_write_changes_version(self):
+        self.assertEqual(self.qty(), [5])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.qty(), [5])
+
+        # bulk_create: сигналов нет, остаток меняет триггер postavka
+        Postavka.objects.bulk_create([Postavka(id_postavshchik=self.postavshchik, id_tovar=self.tovar, kolichestvo=3)])
+        self.assertEqual(self.qty(), [2])
+
+        set_tovar_stripes([self.tovar.pk], 2)
+        Tovar.objects.filter(pk=self.tovar.pk).update(kolichestvo_na_sklade=5)
+        self.assertEqual(self.qty(), [])
+
+
+class StockMovementCompactTest(TransactionTestCase):
+    """Движение долгой транзакции (с id ниже уже свёрнутых) сворачивается после её фиксации."""
+
+    def movement(self, qty):
+        return StockMovement.objects.create(
+            doc_type=StockMovement.DocType.KORREKTIROVKA,
+            id_magazin=self.magazin, id_tovar=self.tovar, kolichestvo=qty,
+        )
+
+    def test_long_transaction_folded_after_commit(self):
+        self.magazin = Magazin.objects.create(nazvanie="M")
+        self.tovar = Tovar.objects.create(nazvanie="T")
+        written, release = threading.Event(), threading.Event()
+        ids = {}
+
+        def long_transaction():
+            try:
+                with transaction.atomic():
+                    ids["long"] = self.movement(5).pk
+                    written.set()
+                    release.wait(10)
+            finally:
+                written.set()
+                connection.close()
+
+        t = threading.Thread(target=long_transaction)
+        t.start()
+        written.wait(10)
+        later = self.movement(2)
+        self.assertLess(ids["long"], later.pk)
+
+        # долгая транзакция ещё идёт — её движение и все более поздние в свёртку не попадают
+        compact_stock_movements()
+        self.assertFalse(StockBalance.objects.exists())
+        self.assertEqual(ledger_balance(self.tovar.pk, self.magazin.pk), 2)
+
+        release.set()
+        t.join(10)
+        compact_stock_movements()
+        self.assertEqual(StockBalance.objects.get(id_magazin=self.magazin, id_tovar=self.tovar).kolichestvo, 7)
+        self.assertEqual(ledger_balance(self.tovar.pk, self.magazin.pk), 7)
+
+
+class StockSnapshotTest(TransactionTestCase):
+    """Движение транзакции, шедшей в момент среза, попадает в остатки на дату после её фиксации."""
+
+    def test_open_transaction_not_lost(self):
+        magazin = Magazin.objects.create(nazvanie="M")
+        tovar = Tovar.objects.create(nazvanie="T")
+        today = timezone.localdate()
+        written, release = threading.Event(), threading.Event()
+
+        def movement(qty):
+            StockMovement.objects.create(
+                doc_type=StockMovement.DocType.KORREKTIROVKA, id_magazin=magazin, id_tovar=tovar, kolichestvo=qty,
+            )
+
+        def long_transaction():
+            try:
+                with transaction.atomic():
+                    movement(5)
+                    written.set()
+                    release.wait(10)
+            finally:
+                written.set()
+                connection.close()
+
+        t = threading.Thread(target=long_transaction)
+        t.start()
+        written.wait(10)
+        movement(2)
+        take_stock_snapshot(today)
+        self.assertEqual(stock_as_of(today, magazin.pk), {tovar.pk: 2})
+
+        release.set()
+        t.join(10)
+        self.assertEqual(stock_as_of(today, magazin.pk), {tovar.pk: 7})
+        self.assertEqual(tovar_stock_as_of(today, tovar.pk), {magazin.pk: 7})
+
+        tomorrow = today + timedelta(days=1)
+        take_stock_snapshot(tomorrow)
+        self.assertEqual(stock_as_of(tomorrow, magazin.pk), {tovar.pk: 7})
+        self.assertEqual(stock_as_of(today, magazin.pk), {tovar.pk: 7})
+
+
+class LockOrderMixin:
+    """Проверка порядка блокировок: пока чужая транзакция держит строку hold, операция
+    должна уже держать строку probe, стоящую раньше в общем порядке."""
+
+    def assert_locks_before(self, hold, probe, operation):
+        holding, release = threading.Event(), threading.Event()
+
+        def hold_row():
+            try:
+                with transaction.atomic():
+                    # FOR NO KEY UPDATE, как у складских операций: не мешает проверкам внешних ключей
+                    hold.select_for_update(no_key=True).get()
+                    holding.set()
+                    release.wait(10)
+            finally:
+                holding.set()
+                connection.close()
+
+        def run():
+            try:
+                operation()
+            finally:
+                connection.close()
+
+        holder, worker = threading.Thread(target=hold_row), threading.Thread(target=run)
+        holder.start()
+        holding.wait(10)
+        worker.start()
+        # операция ждёт строку hold — строка probe уже должна быть за ней
+        probe_locked = False
+        for _ in range(100):
+            try:
+                with transaction.atomic():
+                    probe.select_for_update(nowait=True, no_key=True).get()
+            except DatabaseError:
+                probe_locked = True
+                break
+            time.sleep(0.05)
+        release.set()
+        holder.join(10)
+        worker.join(10)
+        self.assertTrue(probe_locked)
+
+
+class MagazinStockLockOrderTest(LockOrderMixin, TransactionTestCase):
+    """Складские операции блокируют строки magazin_tovar в порядке (id_magazin, id_tovar), а не id строк."""
+
+    def setUp(self):
+        self.magazin = Magazin.objects.create(nazvanie="M")
+        self.first = Tovar.objects.create(nazvanie="A")
+        self.second = Tovar.objects.create(nazvanie="B")
+        # строка второго товара создана раньше — порядок id строк обратный порядку ключей
+        for tovar in (self.second, self.first):
+            MagazinTovar.objects.create(id_magazin=self.magazin, id_tovar=tovar, kolichestvo=10)
+
+    def assert_locks_first_row_first(self, operation):
+        self.assert_locks_before(
+            MagazinTovar.objects.filter(id_magazin=self.magazin, id_tovar=self.second),
+            MagazinTovar.objects.filter(id_magazin=self.magazin, id_tovar=self.first),
+            operation,
+        )
+
+    def test_sale(self):
+        self.assert_locks_first_row_first(
+            lambda: apply_vyruchka_stock(self.magazin.pk, {self.second.pk: 1, self.first.pk: 1}),
+        )
+        self.assertEqual(
+            sorted(MagazinTovar.objects.filter(id_magazin=self.magazin).values_list("kolichestvo", flat=True)), [9, 9],
+        )
+
+    def test_transfer(self):
+        other = Magazin.objects.create(nazvanie="M2")
+        p = Peremeshchenie.objects.create(id_magazin_iz=self.magazin, id_magazin_v=other)
+        for tovar in (self.second, self.first):
+            PeremeshchenieItem.objects.create(id_peremeshchenie=p, id_tovar=tovar, kolichestvo=2)
+        self.assert_locks_first_row_first(lambda: post_peremeshchenie(p))
+        self.assertEqual(MagazinTovar.objects.filter(id_magazin=other, kolichestvo=2).count(), 2)
+
+
+class CentralStockLockOrderTest(LockOrderMixin, TransactionTestCase):
+    """Поставки и корректировки блокируют строки tovar по id, как проведение заявок."""
+
+    def setUp(self):
+        self.first = Tovar.objects.create(nazvanie="A", kolichestvo_na_sklade=10)
+        self.second = Tovar.objects.create(nazvanie="B", kolichestvo_na_sklade=10)
+        self.postavshchik = Postavshchik.objects.create(nazvanie="P")
+
+    def assert_locks_first_tovar_first(self, operation):
+        self.assert_locks_before(
+            Tovar.objects.filter(pk=self.second.pk), Tovar.objects.filter(pk=self.first.pk), operation,
+        )
+
+    def stock(self):
+        return list(Tovar.objects.order_by("pk").annotate(s=central_stock_expr()).values_list("s", flat=True))
+
+    def test_postavka(self):
+        # строки поставки — в обратном порядке товаров
+        self.assert_locks_first_tovar_first(lambda: Postavka.objects.bulk_create([
+            Postavka(id_postavshchik=self.postavshchik, id_tovar=tovar, kolichestvo=5)
+            for tovar in (self.second, self.first)
+        ]))
+        self.assertEqual(self.stock(), [15, 15])
+
+    def test_postavka_striped(self):
+        set_tovar_stripes([self.first.pk, self.second.pk], 2)
+        self.assert_locks_first_tovar_first(lambda: Postavka.objects.bulk_create([
+            Postavka(id_postavshchik=self.postavshchik, id_tovar=tovar, kolichestvo=5)
+            for tovar in (self.second, self.first)
+        ]))
+        self.assertEqual(self.stock(), [15, 15])
+
+    def test_fix_stock_diff(self):
+        self.assert_locks_first_tovar_first(
+            lambda: fix_stock_diff([(None, self.second.pk, 10, 12), (None, self.first.pk, 10, 11)]),
+        )
+        self.assertEqual(self.stock(), [11, 12])
+
+
+class StockCacheLoadTest(TransactionTestCase):
+    """Кэш остатков выключен по умолчанию; матрица грузится одной транзакцией REPEATABLE READ."""
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(get_stock_cache())
+
+    def test_load(self):
+        magazin = Magazin.objects.create(nazvanie="M")
+        tovar = Tovar.objects.create(nazvanie="T")
+        MagazinTovar.objects.create(id_magazin=magazin, id_tovar=tovar, kolichestvo=5)
+        stock_cache = StockCache(poll_seconds=0.2)
+        self.addCleanup(stock_cache.stop)
+        isolation = []
+        load = StockCache._load
+
+        def spy(self_, cur):
+            with mock.patch.object(cur, "execute", wraps=cur.execute) as execute:
+                load(self_, cur)
+            isolation.extend(c.args[0] for c in execute.call_args_list if "ISOLATION" in c.args[0])
+
+        with mock.patch.object(StockCache, "_load", spy):
+            stock_cache.start()
+
+        self.assertTrue(stock_cache.synced)
+        self.assertEqual(stock_cache.lookup([(magazin.pk, tovar.pk)]), [5])
+        self.assertEqual(isolation, ["SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY"])
@@ -69,6 +69,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'ui.context_processors.low_stock',
             ],
         },
     },
@@ -127,3 +128,35 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/6.0/howto/static-files/
 
 STATIC_URL = 'static/'
+
+
+# Групповая запись чеков (core/group_commit.py): чеки, пришедшие в течение
+# WINDOW_MS миллисекунд (или до MAX_BATCH штук), проводятся одной транзакцией.
+VYRUCHKA_GROUP_COMMIT = {
+    "ENABLED": False,
+    "WINDOW_MS": 10,
+    "MAX_BATCH": 50,
+}
+
+# Повтор складских транзакций при deadlock/serialization failure (core/retry.py):
+# всего ATTEMPTS попыток, пауза — случайная до min(MAX_MS, BASE_MS * 2^n) мс.
+# ISOLATION — уровень изоляции проводок ("repeatable read" / "serializable"),
+# None — уровень сервера (READ COMMITTED).
+STOCK_TX_RETRY = {
+    "ATTEMPTS": 5,
+    "BASE_MS": 20,
+    "MAX_MS": 500,
+    "ISOLATION": None,
+}
+
+# Кэш остатков магазинов в памяти процесса (core/stock_cache.py) для /api/stock/:
+# матрица грузится при первом запросе и обновляется по LISTEN/NOTIFY.
+# POLL_SECONDS — как часто слушатель проверяет соединение,
+# LOAD_WAIT_SECONDS — сколько первый запрос ждёт загрузки (дальше — ответ из БД).
+# По умолчанию выключен: каждый процесс держит своё соединение-слушатель и копию
+# матрицы — включается там, где /api/stock/ действительно нагружен.
+STOCK_CACHE = {
+    "ENABLED": False,
+    "POLL_SECONDS": 5,
+    "LOAD_WAIT_SECONDS": 10,
+}
@@ -0,0 +1,32 @@
+import functools
+
+from django.db import connection
+
+
+def low_stock(request):
+    """
+    Счётчик «низких остатков» для значка в шапке (base.html).
+    Считается лениво — только если шаблон обратился к low_stock_count —
+    и читает только частичный индекс magazin_tovar_low_idx.
+    """
+    u = getattr(request, "user", None)
+    if not (u and u.is_authenticated and u.has_perm("core.view_magazintovar")):
+        return {}
+
+    @functools.cache
+    def count():
+        if u.is_superuser or u.groups.filter(name="Владелец сети").exists():
+            where, params = "", []
+        else:
+            mid = getattr(getattr(u, "profile", None), "id_magazin_id", None)
+            if not mid:
+                return 0
+            where, params = "AND id_magazin = %s", [mid]
+        with connection.cursor() as cur:
+            cur.execute(
+                f"SELECT COUNT(*) FROM magazin_tovar WHERE kolichestvo < min_kolichestvo {where}",
+                params,
+            )
+            return cur.fetchone()[0]
+
+    return {"low_stock_count": count}
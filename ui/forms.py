@@ -1,3 +1,6 @@
+import csv
+import io
+
 from django import forms
 from core.models import (
     Tovar, Postavka, Vyruchka,
@@ -8,6 +11,9 @@ from core.models import (
 )
 from core.models import TovarVyruchka
 from core.models import Zayavka, ZayavkaItem
+from core.models import Peremeshchenie, PeremeshchenieItem
+from core.models import Inventarizaciya
+from core.models import MagazinTovar
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.forms import UserCreationForm
 from core.models import Magazin, Otdel
@@ -32,6 +38,7 @@ class UlitsaForm(forms.ModelForm):
 
 class BaseZayavkaItemFormSet(BaseInlineFormSet):
     """Проверяет, что один и тот же товар не добавлен в заявку дважды."""
+    duplicate_message = "Один и тот же товар указан в заявке несколько раз. Объедините строки."
 
     def clean(self):
         super().clean()
@@ -46,11 +53,67 @@ class BaseZayavkaItemFormSet(BaseInlineFormSet):
                 continue
             tid = tovar.pk
             if tid in seen:
-                raise forms.ValidationError(
-                    "Один и тот же товар указан в заявке несколько раз. Объедините строки."
-                )
+                raise forms.ValidationError(self.duplicate_message)
             seen.add(tid)
 
+
+class BasePeremeshchenieItemFormSet(BaseZayavkaItemFormSet):
+    duplicate_message = "Один и тот же товар указан в перемещении несколько раз. Объедините строки."
+
+
+class PrefetchedModelChoiceField(forms.ModelChoiceField):
+    """
+    ModelChoiceField, которому формсет заранее передаёт выбранные объекты
+    (prefetched = {pk: объект}) — проверка значения не делает запрос на каждую строку.
+    """
+    prefetched = None
+
+    def to_python(self, value):
+        if self.prefetched is not None and value not in self.empty_values:
+            try:
+                obj = self.prefetched.get(int(value))
+            except (TypeError, ValueError):
+                obj = None
+            if obj is not None:
+                return obj
+        return super().to_python(value)
+
+
+class BaseVyruchkaItemFormSet(BaseInlineFormSet):
+    """
+    Товары всех строк чека (вместе с ценами) загружаются одним in_bulk,
+    существующие строки берутся из уже загруженного queryset'а formset'а —
+    число запросов на проверку не зависит от длины чека.
+    """
+
+    def _construct_form(self, i, **kwargs):
+        form = super()._construct_form(i, **kwargs)
+        field = form.fields["id_tovar"]
+        field.prefetched = self._tovary(field.queryset)
+        return form
+
+    def add_fields(self, form, index):
+        super().add_fields(form, index)
+        name = self.model._meta.pk.name
+        field = form.fields[name]
+        if self.is_bound and isinstance(field, forms.ModelChoiceField):
+            pk = PrefetchedModelChoiceField(
+                field.queryset, initial=field.initial, required=False, widget=field.widget
+            )
+            pk.prefetched = {obj.pk: obj for obj in self.get_queryset()}
+            form.fields[name] = pk
+
+    def _tovary(self, queryset):
+        if not self.is_bound:
+            return None
+        if getattr(self, "_tovary_cache", None) is None:
+            pre, suffix = f"{self.prefix}-", "-id_tovar"
+            ids = {int(v) for k, v in self.data.items()
+                   if k.startswith(pre) and k.endswith(suffix) and str(v).isdigit()}
+            self._tovary_cache = queryset.in_bulk(ids)
+        return self._tovary_cache
+
+
 def _user_magazin_id(user):
     """
     Возвращает:
@@ -152,6 +215,126 @@ class ZayavkaItemForm(forms.ModelForm):
             raise forms.ValidationError("Количество должно быть > 0")
         return v
 
+class PeremeshchenieForm(forms.ModelForm):
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # сотрудник магазина перемещает товар только со своего склада
+        mid = _user_magazin_id(user)
+        if mid:
+            self.fields["id_magazin_iz"].queryset = Magazin.objects.filter(pk=mid)
+            self.fields["id_magazin_iz"].initial = mid
+            self.fields["id_magazin_iz"].disabled = True
+
+    class Meta:
+        model = Peremeshchenie
+        fields = ["id_magazin_iz", "id_magazin_v", "data", "comment"]
+        widgets = {"data": forms.DateInput(attrs={"type": "date"})}
+
+    def clean(self):
+        cleaned = super().clean()
+        if cleaned.get("id_magazin_iz") and cleaned.get("id_magazin_iz") == cleaned.get("id_magazin_v"):
+            raise forms.ValidationError("Магазин-источник и магазин-получатель должны различаться")
+        return cleaned
+
+
+class PeremeshchenieItemForm(forms.ModelForm):
+    class Meta:
+        model = PeremeshchenieItem
+        fields = ["id_tovar", "kolichestvo"]
+
+    def clean_kolichestvo(self):
+        v = self.cleaned_data.get("kolichestvo")
+        if v is None or v <= 0:
+            raise forms.ValidationError("Количество должно быть > 0")
+        return v
+
+class InventarizaciyaForm(forms.ModelForm):
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        mid = _user_magazin_id(user)
+        if mid:
+            self.fields["id_magazin"].queryset = Magazin.objects.filter(pk=mid)
+            self.fields["id_magazin"].initial = mid
+            self.fields["id_magazin"].disabled = True
+
+    class Meta:
+        model = Inventarizaciya
+        fields = ["id_magazin", "data", "comment"]
+        widgets = {"data": forms.DateInput(attrs={"type": "date"})}
+
+
+class InventarizaciyaUploadForm(forms.Form):
+    """
+    CSV с результатами пересчёта: товар (id или название), количество.
+    Разделитель — запятая, точка с запятой или табуляция; строка заголовка необязательна.
+    Один товар может встречаться несколько раз (разные полки) — количества складываются.
+    """
+    fail = forms.FileField(label="Файл пересчёта (CSV)", required=False)
+
+    def clean_fail(self):
+        f = self.cleaned_data.get("fail")
+        if not f:
+            return {}
+        try:
+            text = f.read().decode("utf-8-sig")
+        except UnicodeDecodeError:
+            raise forms.ValidationError("Файл должен быть в кодировке UTF-8")
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+
+        lines, errors = [], []
+        for n, row in enumerate(csv.reader(io.StringIO(text), dialect), start=1):
+            row = [c.strip() for c in row]
+            if not any(row):
+                continue
+            if len(row) < 2:
+                errors.append(f"строка {n}: нужно два столбца — товар и количество")
+                continue
+            try:
+                qty = int(row[1])
+            except ValueError:
+                if n == 1:
+                    continue  # заголовок
+                errors.append(f"строка {n}: количество '{row[1]}' не число")
+                continue
+            if qty < 0:
+                errors.append(f"строка {n}: количество не может быть отрицательным")
+                continue
+            lines.append((n, row[0], qty))
+
+        ids = {int(ref) for _, ref, _ in lines if ref.isdigit()}
+        names = {ref for _, ref, _ in lines if not ref.isdigit()}
+        known_ids = set(Tovar.objects.filter(pk__in=ids).values_list("pk", flat=True))
+        by_name = {}
+        for pk, name in Tovar.objects.filter(nazvanie__in=names).values_list("pk", "nazvanie"):
+            by_name.setdefault(name, []).append(pk)
+
+        counted = {}
+        for n, ref, qty in lines:
+            if ref.isdigit():
+                tid = int(ref) if int(ref) in known_ids else None
+            else:
+                found = by_name.get(ref, [])
+                if len(found) > 1:
+                    errors.append(f"строка {n}: несколько товаров с названием '{ref}', укажите id")
+                    continue
+                tid = found[0] if found else None
+            if tid is None:
+                errors.append(f"строка {n}: товар '{ref}' не найден")
+                continue
+            counted[tid] = counted.get(tid, 0) + qty
+
+        if errors:
+            more = f" (и ещё {len(errors) - 10})" if len(errors) > 10 else ""
+            raise forms.ValidationError("; ".join(errors[:10]) + more)
+        if not counted:
+            raise forms.ValidationError("В файле нет строк пересчёта")
+        return counted
+
 class TovarForm(forms.ModelForm):
     class Meta:
         model = Tovar
@@ -209,6 +392,14 @@ class TovarVyruchkaForm(forms.ModelForm):
     class Meta:
         model = TovarVyruchka
         fields = ["id_tovar", "kolichestvo"]
+        field_classes = {"id_tovar": PrefetchedModelChoiceField}
+
+    def _get_validation_exclusions(self):
+        # товар уже найден полем формы (in_bulk formset'а) — повторная проверка
+        # ForeignKey в full_clean() сделала бы по запросу на строку
+        exclude = super()._get_validation_exclusions()
+        exclude.add("id_tovar")
+        return exclude
 
     def clean_kolichestvo(self):
         v = self.cleaned_data.get("kolichestvo")
@@ -225,6 +416,13 @@ class MagazinForm(forms.ModelForm):
             "nomer_doma",
         ]
 
+class MagazinTovarMinForm(forms.ModelForm):
+    class Meta:
+        model = MagazinTovar
+        fields = ["min_kolichestvo"]
+        labels = {"min_kolichestvo": "Неснижаемый остаток"}
+        help_texts = {"min_kolichestvo": "Ниже этого количества позиция попадает в «Низкие остатки». Пусто — не следить."}
+
 class PostavshchikForm(forms.ModelForm):
     class Meta:
         model = Postavshchik
@@ -337,3 +535,20 @@ class ZapisiTrudKnizhkeForm(forms.ModelForm):
             "data_uvolenija": forms.DateInput(attrs={"type": "date"}),
             "data": forms.DateInput(attrs={"type": "date"}),
         }
+
+
+class VyruchkaImportForm(forms.Form):
+    """Выгрузка касс: CSV (строка заголовка, по позиции на строку) или JSON lines."""
+    fail = forms.FileField(label="Файл выгрузки касс")
+    fmt = forms.ChoiceField(
+        label="Формат",
+        choices=[("", "по расширению файла"), ("csv", "CSV"), ("jsonl", "JSON lines")],
+        required=False,
+    )
+
+    def clean(self):
+        cleaned = super().clean()
+        f = cleaned.get("fail")
+        if f and not cleaned.get("fmt"):
+            cleaned["fmt"] = "jsonl" if f.name.lower().endswith((".jsonl", ".ndjson", ".json")) else "csv"
+        return cleaned
@@ -1,5 +1,36 @@
-from django.db.models import Q
-from django.http import HttpResponseForbidden
+from django.db.models import Prefetch, Q
+from django.http import HttpResponseForbidden, JsonResponse
+
+from core.services import user_by_api_token
+
+
+def preview_prefetch(lookup: str, queryset, n: int, to_attr: str):
+    """
+    Prefetch первых n связанных строк каждого объекта (превью в списках).
+    Срез prefetch-queryset'а Django выполняет одним запросом с оконной
+    ROW_NUMBER() OVER (PARTITION BY <fk> ORDER BY ...) — строк читается
+    не больше «объектов на странице × n», сколько бы их ни было у объекта.
+    queryset должен быть упорядочен: от порядка зависит, какие строки попадут в превью.
+    Результат кладётся в to_attr (список), штатный *_set.all() не подменяется.
+    """
+    return Prefetch(lookup, queryset=queryset[:n], to_attr=to_attr)
+
+
+class ApiTokenAuthMixin:
+    """
+    Вход внешних систем (касс) по ключу: заголовок Authorization: Token <ключ>,
+    ключ выдаёт manage.py api_token. Сессия не используется вовсе, поэтому такие
+    view освобождаются от CSRF (csrf_exempt): межсайтовый запрос с cookie браузера
+    здесь ничего не получит. Права и магазин — как у пользователя, которому выдан ключ.
+    """
+    def dispatch(self, request, *args, **kwargs):
+        scheme, _, key = request.headers.get("Authorization", "").partition(" ")
+        user = user_by_api_token(key.strip()) if scheme.lower() == "token" else None
+        if user is None:
+            return JsonResponse({"errors": ["Нужен заголовок Authorization: Token <ключ>"]}, status=401)
+        request.user = user
+        return super().dispatch(request, *args, **kwargs)
+
 
 class OwnerOnlyMixin:
     def dispatch(self, request, *args, **kwargs):
@@ -16,13 +47,14 @@ class SortSearchListMixin:
 
     allowed_sort = ("id",)
     default_sort = "id"
+    default_dir = "asc"
 
     def get_search_q(self) -> str:
         return (self.request.GET.get(self.search_param) or "").strip()
 
     def get_sort(self):
         sort = (self.request.GET.get(self.sort_param) or self.default_sort or "id").strip()
-        direction = (self.request.GET.get(self.dir_param) or "asc").strip().lower()
+        direction = (self.request.GET.get(self.dir_param) or self.default_dir).strip().lower()
 
         # поддержка старого формата sort=-field
         if sort.startswith("-"):
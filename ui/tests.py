@@ -1,3 +1,157 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
-# Create your tests here.
+from core.models import Magazin, MagazinTovar, StockMovement, Tovar, TovarVyruchka, Vyruchka
+from core.services import issue_api_token, ledger_balance
+from ui.mixins import preview_prefetch
+
+
+class VyruchkaDeleteViewTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "x"))
+        self.magazin = Magazin.objects.create(nazvanie="M")
+        self.tovar = Tovar.objects.create(nazvanie="T")
+        self.stock = MagazinTovar.objects.create(id_magazin=self.magazin, id_tovar=self.tovar, kolichestvo=3)
+
+    def test_delete_returns_stock(self):
+        v = Vyruchka.objects.create(id_magazin=self.magazin)
+        TovarVyruchka.objects.create(id_vyruchka=v, id_tovar=self.tovar, kolichestvo=2, summa=20)
+
+        r = self.client.post(reverse("vyruchka_delete", args=[v.pk]))
+
+        self.assertRedirects(r, reverse("vyruchka_list"), fetch_redirect_response=False)
+        self.assertFalse(Vyruchka.objects.filter(pk=v.pk).exists())
+        self.assertFalse(TovarVyruchka.objects.filter(id_vyruchka_id=v.pk).exists())
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.kolichestvo, 5)
+        self.assertEqual(
+            list(StockMovement.objects.filter(doc_type=StockMovement.DocType.VYRUCHKA, doc_id=v.pk)
+                 .values_list("id_tovar_id", "kolichestvo")),
+            [(self.tovar.pk, 2)],
+        )
+
+
+class VyruchkaImportApiTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser("kassa", "kassa@example.com", "x")
+        self.magazin = Magazin.objects.create(nazvanie="M")
+        self.tovar = Tovar.objects.create(nazvanie="T", cena_prodazhi=10)
+        self.stock = MagazinTovar.objects.create(id_magazin=self.magazin, id_tovar=self.tovar, kolichestvo=10)
+        # как у кассы: без сессии, с проверкой CSRF
+        self.client = Client(enforce_csrf_checks=True)
+
+    def post(self, **headers):
+        data = f"chek,magazin,data,tovar,kolichestvo\n17,{self.magazin.pk},2026-10-18,{self.tovar.pk},3\n"
+        return self.client.post(
+            reverse("vyruchka_import_api"),
+            {"fail": SimpleUploadedFile("kassa.csv", data.encode()), "fmt": "csv"},
+            headers=headers,
+        )
+
+    def test_token_required(self):
+        self.assertEqual(self.post().status_code, 401)
+        self.assertEqual(self.post(authorization="Token wrong").status_code, 401)
+
+    def test_repeated_import_is_idempotent(self):
+        auth = f"Token {issue_api_token(self.user)}"
+
+        r = self.post(authorization=auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual((r.json()["receipts"], r.json()["duplicates"]), (1, 0))
+
+        r = self.post(authorization=auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual((r.json()["receipts"], r.json()["duplicates"]), (0, 1))
+
+        self.assertEqual(Vyruchka.objects.filter(chek="17").count(), 1)
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.kolichestvo, 7)
+
+
+class VyruchkaFormQueriesTest(TestCase):
+    """Создание и правка чека — одно и то же число запросов при любом числе строк."""
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "x"))
+        self.magazin = Magazin.objects.create(nazvanie="M")
+        self.tovary = [Tovar.objects.create(nazvanie=f"T{i}", cena_prodazhi=10) for i in range(5)]
+        for tovar in self.tovary:
+            MagazinTovar.objects.create(id_magazin=self.magazin, id_tovar=tovar, kolichestvo=100)
+
+    def form_data(self, lines, qty, initial=0):
+        data = {
+            "data": "2026-10-18", "id_magazin": self.magazin.pk, "id_rabotnik": "",
+            "tovarvyruchka_set-TOTAL_FORMS": len(lines), "tovarvyruchka_set-INITIAL_FORMS": initial,
+        }
+        for i, (line_id, tovar) in enumerate(lines):
+            data[f"tovarvyruchka_set-{i}-id"] = line_id or ""
+            data[f"tovarvyruchka_set-{i}-id_tovar"] = tovar.pk
+            data[f"tovarvyruchka_set-{i}-kolichestvo"] = qty
+        return data
+
+    def create(self, n):
+        r = self.client.post(reverse("vyruchka_add"), self.form_data([(None, t) for t in self.tovary[:n]], 1))
+        self.assertRedirects(r, reverse("vyruchka_list"), fetch_redirect_response=False)
+        return Vyruchka.objects.latest("pk")
+
+    def edit(self, vyr):
+        lines = list(TovarVyruchka.objects.filter(id_vyruchka=vyr).order_by("pk").values_list("pk", "id_tovar"))
+        data = self.form_data([(pk, Tovar(pk=tid)) for pk, tid in lines], 2, initial=len(lines))
+        r = self.client.post(reverse("vyruchka_edit", args=[vyr.pk]), data)
+        self.assertRedirects(r, reverse("vyruchka_list"), fetch_redirect_response=False)
+
+    def test_create(self):
+        with CaptureQueriesContext(connection) as one:
+            self.create(1)
+        with self.assertNumQueries(len(one)):
+            vyr = self.create(5)
+        self.assertEqual(vyr.tovarvyruchka_set.count(), 5)
+
+    def test_edit(self):
+        small, big = self.create(1), self.create(5)
+        with CaptureQueriesContext(connection) as one:
+            self.edit(small)
+        with self.assertNumQueries(len(one)):
+            self.edit(big)
+        self.assertEqual(sorted(big.tovarvyruchka_set.values_list("kolichestvo", flat=True)), [2] * 5)
+        # обе строки первого товара: 1 -> 2, то есть списано ещё по одной
+        self.assertEqual(MagazinTovar.objects.get(id_magazin=self.magazin, id_tovar=self.tovary[0]).kolichestvo, 96)
+        self.assertEqual(ledger_balance(self.tovary[0].pk, self.magazin.pk), 96)
+
+
+class VyruchkaPreviewTest(TestCase):
+    """Превью чека в списке — не больше N строк на чек, одним запросом на страницу."""
+
+    def setUp(self):
+        self.magazin = Magazin.objects.create(nazvanie="M")
+        self.tovary = [Tovar.objects.create(nazvanie=f"T{i}") for i in range(5)]
+        self.long = self.receipt(5)
+        self.short = self.receipt(2)
+
+    def receipt(self, n):
+        v = Vyruchka.objects.create(id_magazin=self.magazin)
+        for tovar in self.tovary[:n]:
+            TovarVyruchka.objects.create(id_vyruchka=v, id_tovar=tovar, kolichestvo=1, summa=10)
+        return v
+
+    def test_prefetch_limits_lines(self):
+        qs = Vyruchka.objects.order_by("pk").prefetch_related(
+            preview_prefetch("tovarvyruchka_set", TovarVyruchka.objects.order_by("id"), 3, to_attr="preview_items"),
+        )
+        with self.assertNumQueries(2):
+            rows = [[it.id_tovar_id for it in v.preview_items] for v in qs]
+        self.assertEqual(rows, [[t.pk for t in self.tovary[:3]], [t.pk for t in self.tovary[:2]]])
+        # штатный менеджер строк не подменён превью
+        self.assertEqual(qs[0].tovarvyruchka_set.count(), 5)
+
+    def test_list_view(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "x"))
+        r = self.client.get(reverse("vyruchka_list"))
+        self.assertEqual(
+            {v.pk: len(v.preview_items) for v in r.context["object_list"]}, {self.long.pk: 3, self.short.pk: 2},
+        )
+        self.assertContains(r, "ещё 2")
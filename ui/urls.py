@@ -15,12 +15,15 @@ urlpatterns = [
     path("postavka/add/", views.PostavkaCreateView.as_view(), name="postavka_add"),
     path("postavka/<int:pk>/edit/", views.PostavkaUpdateView.as_view(), name="postavka_edit"),
     path("postavka/<int:pk>/delete/", views.PostavkaDeleteView.as_view(), name="postavka_delete"),
+    path("zakupki/plan/", views.PurchasePlanView.as_view(), name="purchase_plan"),
 
     # ===== Выручка =====
     path("vyruchka/", views.VyruchkaListView.as_view(), name="vyruchka_list"),
     path("vyruchka/add/", views.VyruchkaCreateView.as_view(), name="vyruchka_add"),
     path("vyruchka/<int:pk>/edit/", views.VyruchkaUpdateView.as_view(), name="vyruchka_edit"),
     path("vyruchka/<int:pk>/delete/", views.VyruchkaDeleteView.as_view(), name="vyruchka_delete"),
+    path("vyruchka/import/", views.VyruchkaImportView.as_view(), name="vyruchka_import"),
+    path("api/vyruchka/import/", views.VyruchkaImportApiView.as_view(), name="vyruchka_import_api"),
 
     # ===== Справочники =====
     path("spravochnik/gruppa-tovarov/", views.GruppaTovarovListView.as_view(), name="gruppa_list"),
@@ -112,6 +115,8 @@ urlpatterns = [
     path("zayavka/add/", views.ZayavkaCreateView.as_view(), name="zayavka_add"),
     path("zayavka/<int:pk>/edit/", views.ZayavkaUpdateView.as_view(), name="zayavka_edit"),
     path("zayavka/<int:pk>/approve/", views.ZayavkaApproveView.as_view(), name="zayavka_approve"),
+    path("zayavka/approve-bulk/", views.ZayavkaBulkApproveView.as_view(), name="zayavka_approve_bulk"),
+    path("zayavka/consolidate/", views.ZayavkaConsolidateView.as_view(), name="zayavka_consolidate"),
 
     # ===== Работники =====
     path("rabotnik/", views.RabotnikListView.as_view(), name="rabotnik_list"),
@@ -121,13 +126,30 @@ urlpatterns = [
     path("analytics/", views.AnalyticsView.as_view(), name="analytics"),
     path("analytics/export.csv", views.analytics_export_csv, name="analytics_export_csv"),
     path("sql/", views.SqlConsoleView.as_view(), name="sql_console"),
+    path("api/metrics/", views.MetricsView.as_view(), name="metrics_api"),
+    path("monitoring/blokirovki/", views.LockMonitorView.as_view(), name="lock_monitor"),
     path("users/", views.UserListView.as_view(), name="user_list"),
     path("users/add/", views.UserCreateView.as_view(), name="user_add"),
     path("users/<int:pk>/edit/", views.UserUpdateView.as_view(), name="user_edit"),
     path("users/<int:pk>/delete/", views.UserDeleteView.as_view(), name="user_delete"),
     path("zayavka/<int:pk>/send/", views.ZayavkaSendView.as_view(), name="zayavka_send"),
     path("zayavka/<int:pk>/delete/", views.ZayavkaDeleteView.as_view(), name="zayavka_delete"),
+    path("peremeshchenie/", views.PeremeshchenieListView.as_view(), name="peremeshchenie_list"),
+    path("peremeshchenie/add/", views.PeremeshchenieCreateView.as_view(), name="peremeshchenie_add"),
+    path("peremeshchenie/<int:pk>/edit/", views.PeremeshchenieUpdateView.as_view(), name="peremeshchenie_edit"),
+    path("peremeshchenie/<int:pk>/post/", views.PeremeshcheniePostView.as_view(), name="peremeshchenie_post"),
+    path("peremeshchenie/<int:pk>/delete/", views.PeremeshchenieDeleteView.as_view(), name="peremeshchenie_delete"),
+    path("inventarizaciya/", views.InventarizaciyaListView.as_view(), name="inventarizaciya_list"),
+    path("inventarizaciya/add/", views.InventarizaciyaCreateView.as_view(), name="inventarizaciya_add"),
+    path("inventarizaciya/<int:pk>/", views.InventarizaciyaDetailView.as_view(), name="inventarizaciya_detail"),
+    path("inventarizaciya/<int:pk>/post/", views.InventarizaciyaPostView.as_view(), name="inventarizaciya_post"),
+    path("inventarizaciya/<int:pk>/delete/", views.InventarizaciyaDeleteView.as_view(), name="inventarizaciya_delete"),
     path("sklad-magazina/", views.MagazinTovarListView.as_view(), name="magazintovar_list"),
+    path("sklad-magazina/<int:pk>/min/", views.MagazinTovarMinView.as_view(), name="magazintovar_min"),
+    path("sklad-magazina/nizkie-ostatki/", views.LowStockView.as_view(), name="low_stock"),
+    path("sklad-magazina/na-datu/", views.StockAsOfView.as_view(), name="stock_as_of"),
+    path("api/stock-as-of/", views.StockAsOfView.as_view(as_json=True), name="stock_as_of_api"),
+    path("api/stock/", views.StockAvailabilityView.as_view(), name="stock_api"),
     
 
     path("help/user-guide/", views.UserGuideView.as_view(), name="help_user_guide"),
@@ -6,6 +6,7 @@ from datetime import date, timedelta
 from decimal import Decimal
 
 # django
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import (
     LoginRequiredMixin,
@@ -18,8 +19,9 @@ from django.db.models import (
     DecimalField,
     ExpressionWrapper,
     F,
-    Prefetch,
+    OuterRef,
     Q,
+    Subquery,
     Sum,
 )
 
@@ -27,11 +29,13 @@ from django.db.models import (
 
 from django.db.models.functions import Coalesce
 from django.forms import inlineformset_factory
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.core.exceptions import PermissionDenied
 from django.urls import reverse_lazy
+from django.utils.decorators import method_decorator
 from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import (
     CreateView,
     DeleteView,
@@ -41,21 +45,29 @@ from django.views.generic import (
 )
 
 # local apps
+from core import metrics
+from core.group_commit import get_sales_writer
 from core.models import (
     Bank,
     Dolzhnost,
     EdinitsaIzmereniya,
     GruppaTovarov,
+    Inventarizaciya,
     Magazin,
     MagazinTovar,
     Otdel,
+    Peremeshchenie,
+    PeremeshchenieItem,
     Postavka,
     Postavshchik,
     Rabotnik,
+    RabotnikVyruchka,
+    StockAlert,
     Tovar,
     TovarVyruchka,
     Vyruchka,
     Zayavka,
+    ZayavkaApproveJob,
     ZayavkaItem,
     Strana, 
     Gorod, 
@@ -68,20 +80,45 @@ from core.models import (
     ZapisiTrudKnizhke,
 
 )
+from core.retry import retry_on_conflict
+from core.stock_cache import get_stock_cache, stock_lookup
 from core.services import (
+    InventarizaciyaError,
+    PeremeshchenieError,
     StockError,
+    VyruchkaImportError,
     ZayavkaApproveError,
     apply_vyruchka_stock,
     approve_zayavka,
+    approve_zayavki,
+    central_stock_expr,
+    consolidate_zayavki,
+    enqueue_zayavka_approval,
+    import_vyruchka,
+    inventarizaciya_variance,
+    load_inventarizaciya_items,
+    post_inventarizaciya,
+    post_peremeshchenie,
+    purchase_plan,
+    refresh_stock_alerts,
+    stock_as_of,
+    tovar_stock_as_of,
 )
 from .forms import (
     BankForm,
+    BasePeremeshchenieItemFormSet,
+    BaseVyruchkaItemFormSet,
     BaseZayavkaItemFormSet,
     DolzhnostForm,
     EdinitsaIzmereniyaForm,
     GruppaTovarovForm,
+    InventarizaciyaForm,
+    InventarizaciyaUploadForm,
     MagazinForm,
+    MagazinTovarMinForm,
     OtdelForm,
+    PeremeshchenieForm,
+    PeremeshchenieItemForm,
     PostavkaForm,
     PostavshchikForm,
     RabotnikForm,
@@ -90,6 +127,7 @@ from .forms import (
     UserCreateForm,
     UserUpdateForm,
     VyruchkaForm,
+    VyruchkaImportForm,
     ZayavkaForm,
     ZayavkaItemForm,
     StranaForm, 
@@ -105,9 +143,11 @@ from .forms import (
 
 )
 from .mixins import (
+    ApiTokenAuthMixin,
     OwnerOnlyMixin,
     ScopeByMagazinMixin,
     SortSearchListMixin,
+    preview_prefetch,
 )
 
 
@@ -141,6 +181,38 @@ def _qty_map_from_formset(formset):
     return result
 
 
+def _price_vyruchka_items(items):
+    """
+    Проставляет цену (из карточки товара, если не задана) и сумму позициям чека.
+    Товары уже загружены formset'ом одним in_bulk (BaseVyruchkaItemFormSet) —
+    обращение к it.id_tovar запросов не делает.
+    """
+    for it in items:
+        if it.cena_prodazhi is None:
+            it.cena_prodazhi = it.id_tovar.cena_prodazhi or Decimal("0")
+        it.summa = it.cena_prodazhi * Decimal(it.kolichestvo or 0)
+
+
+def _save_vyruchka_items(vyr, formset):
+    """
+    Сохраняет позиции чека из валидного formset'а постоянным числом запросов:
+    новые — одним bulk_create, изменённые — одним bulk_update, удалённые — одним DELETE.
+    """
+    items = formset.save(commit=False)
+    for it in items:
+        it.id_vyruchka = vyr
+        it.data = vyr.data
+    _price_vyruchka_items(items)
+    TovarVyruchka.objects.bulk_create(formset.new_objects)
+    TovarVyruchka.objects.bulk_update(
+        [obj for obj, _ in formset.changed_objects],
+        ["id_tovar", "kolichestvo", "cena_prodazhi", "summa"],
+    )
+    deleted = [obj.pk for obj in formset.deleted_objects if obj.pk]
+    if deleted:
+        TovarVyruchka.objects.filter(pk__in=deleted).delete()
+
+
 class ZayavkaListView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, SortSearchListMixin, ListView):
     permission_required = "core.view_zayavka"
     model = Zayavka
@@ -156,8 +228,19 @@ class ZayavkaListView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazi
 
     def get_queryset(self):
         qs = super().get_queryset()
+        # результат последнего фонового проведения
+        last_job = ZayavkaApproveJob.objects.filter(id_zayavka=OuterRef("pk")).order_by("-id")
+        qs = qs.annotate(
+            job_status=Subquery(last_job.values("status")[:1]),
+            job_error=Subquery(last_job.values("error")[:1]),
+        )
         return self.scope_qs(qs, "id_magazin")
 
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        ctx["is_owner"] = self.is_network_owner()
+        return ctx
+
 class ZayavkaCreateView(LoginRequiredMixin, PermissionRequiredMixin, TemplateView):
     permission_required = "core.add_zayavka"
     template_name = "ui/zayavka_form.html"
@@ -226,6 +309,11 @@ class ZayavkaApproveView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMag
         qs = self.scope_qs(Zayavka.objects.all(), "id_magazin")
         z = get_object_or_404(qs, pk=pk)
 
+        if request.POST.get("mode") == "async":
+            enqueue_zayavka_approval(z, request.user)
+            messages.info(request, f"Заявка #{pk} поставлена в очередь на проведение")
+            return redirect("zayavka_list")
+
         try:
             approve_zayavka(z)
             messages.success(request, f"Заявка #{pk} проведена")
@@ -234,6 +322,52 @@ class ZayavkaApproveView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMag
         return redirect("zayavka_list")
 
 
+class ZayavkaBulkApproveView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, View):
+    permission_required = "core.approve_zayavka"
+
+    def post(self, request):
+        ids = [int(x) for x in request.POST.getlist("ids") if x.isdigit()]
+        qs = self.scope_qs(Zayavka.objects.filter(pk__in=ids), "id_magazin")
+        ids = list(qs.values_list("pk", flat=True))
+        if not ids:
+            messages.warning(request, "Не выбрано ни одной заявки")
+            return redirect("zayavka_list")
+
+        result = approve_zayavki(ids)
+        ok = [pk for pk, e in result.items() if e is None]
+        if ok:
+            messages.success(request, f"Проведено заявок: {len(ok)}")
+        for pk, e in result.items():
+            if e is not None:
+                messages.error(request, f"Заявка #{pk}: {e}")
+        return redirect("zayavka_list")
+
+
+class ZayavkaConsolidateView(LoginRequiredMixin, PermissionRequiredMixin, View):
+    """Проведение всех отправленных заявок сети с распределением дефицита (только владелец сети)."""
+    permission_required = "core.approve_zayavka"
+
+    def post(self, request):
+        if not _is_network_owner(request.user):
+            messages.error(request, "Распределение по всей сети доступно только владельцу сети")
+            return redirect("zayavka_list")
+
+        rule = request.POST.get("rule") if request.POST.get("rule") in ("demand", "velocity") else "demand"
+        result = consolidate_zayavki(rule=rule)
+        if result["approved"]:
+            messages.success(request, f"Проведено заявок: {len(result['approved'])}")
+        if result["cut"]:
+            messages.warning(request, f"Урезано позиций из-за нехватки на складе: {len(result['cut'])}")
+        if result["postponed"]:
+            ids = ", ".join(f"#{pk}" for pk in result["postponed"])
+            messages.warning(request, f"Не досталось товара, заявки остаются отправленными: {ids}")
+        for pk, e in result["errors"].items():
+            messages.error(request, f"Заявка #{pk}: {e}")
+        if not any(result.values()):
+            messages.info(request, "Отправленных заявок нет")
+        return redirect("zayavka_list")
+
+
 class ZayavkaSendView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, View):
     permission_required = "core.change_zayavka"
 
@@ -265,6 +399,235 @@ class ZayavkaDeleteView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMaga
         qs = super().get_queryset()
         return self.scope_qs(qs, "id_magazin")
 
+PeremeshchenieItemsFormSet = inlineformset_factory(
+    Peremeshchenie, PeremeshchenieItem,
+    form=PeremeshchenieItemForm,
+    formset=BasePeremeshchenieItemFormSet,
+    extra=1,
+    can_delete=True
+)
+
+
+class PeremeshchenieListView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, SortSearchListMixin, ListView):
+    permission_required = "core.view_peremeshchenie"
+    model = Peremeshchenie
+    template_name = "ui/peremeshchenie_list.html"
+    paginate_by = 20
+    allowed_sort = ("id", "data", "status")
+
+    def apply_search(self, qs, q: str):
+        return qs.filter(
+            Q(id_magazin_iz__nazvanie__icontains=q) |
+            Q(id_magazin_v__nazvanie__icontains=q) |
+            Q(status__icontains=q)
+        )
+
+    def get_queryset(self):
+        qs = super().get_queryset().select_related("id_magazin_iz", "id_magazin_v").annotate(
+            items_cnt=Count("peremeshchenieitem"),
+            qty=Coalesce(Sum("peremeshchenieitem__kolichestvo"), 0),
+        )
+        # магазин видит и исходящие, и входящие перемещения
+        mid = self.get_magazin_id()
+        if mid is None:
+            return qs
+        if not mid:
+            return qs.none()
+        return qs.filter(Q(id_magazin_iz_id=mid) | Q(id_magazin_v_id=mid))
+
+
+class PeremeshchenieCreateView(LoginRequiredMixin, PermissionRequiredMixin, TemplateView):
+    permission_required = "core.add_peremeshchenie"
+    template_name = "ui/peremeshchenie_form.html"
+
+    def get(self, request, *args, **kwargs):
+        form = PeremeshchenieForm(user=request.user)
+        formset = PeremeshchenieItemsFormSet()
+        return self.render_to_response({"form": form, "formset": formset, "title": "Создать перемещение"})
+
+    @transaction.atomic
+    def post(self, request, *args, **kwargs):
+        form = PeremeshchenieForm(request.POST, user=request.user)
+        formset = PeremeshchenieItemsFormSet(request.POST)
+
+        if form.is_valid() and formset.is_valid():
+            p = form.save(commit=False)
+            p.created_by = request.user
+            p.save()
+
+            items = formset.save(commit=False)
+            for it in items:
+                it.id_peremeshchenie = p
+            PeremeshchenieItem.objects.bulk_create(items)
+            return redirect("peremeshchenie_list")
+
+        return self.render_to_response({"form": form, "formset": formset, "title": "Создать перемещение"})
+
+
+class PeremeshchenieUpdateView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, TemplateView):
+    permission_required = "core.change_peremeshchenie"
+    template_name = "ui/peremeshchenie_form.html"
+
+    def get_object(self):
+        # менять можно только свои (исходящие) черновики
+        qs = self.scope_qs(Peremeshchenie.objects.filter(status=Peremeshchenie.Status.DRAFT), "id_magazin_iz")
+        return get_object_or_404(qs, pk=self.kwargs["pk"])
+
+    def get(self, request, *args, **kwargs):
+        p = self.get_object()
+        form = PeremeshchenieForm(instance=p, user=request.user)
+        formset = PeremeshchenieItemsFormSet(instance=p)
+        return self.render_to_response({"form": form, "formset": formset, "title": "Редактировать перемещение", "obj": p})
+
+    @transaction.atomic
+    def post(self, request, *args, **kwargs):
+        p = self.get_object()
+        form = PeremeshchenieForm(request.POST, instance=p, user=request.user)
+        formset = PeremeshchenieItemsFormSet(request.POST, instance=p)
+
+        if form.is_valid() and formset.is_valid():
+            form.save()
+            formset.save()
+            return redirect("peremeshchenie_list")
+
+        return self.render_to_response({"form": form, "formset": formset, "title": "Редактировать перемещение", "obj": p})
+
+
+class PeremeshcheniePostView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, View):
+    permission_required = "core.post_peremeshchenie"
+
+    def post(self, request, pk: int):
+        qs = self.scope_qs(Peremeshchenie.objects.all(), "id_magazin_iz")
+        p = get_object_or_404(qs, pk=pk)
+        try:
+            post_peremeshchenie(p)
+            messages.success(request, f"Перемещение #{pk} проведено")
+        except PeremeshchenieError as e:
+            messages.error(request, str(e))
+        return redirect("peremeshchenie_list")
+
+
+class PeremeshchenieDeleteView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, DeleteView):
+    permission_required = "core.delete_peremeshchenie"
+    model = Peremeshchenie
+    template_name = "ui/confirm_delete.html"
+    success_url = reverse_lazy("peremeshchenie_list")
+
+    def get_queryset(self):
+        # проведённое перемещение уже изменило остатки — удалять можно только черновики
+        qs = super().get_queryset().filter(status=Peremeshchenie.Status.DRAFT)
+        return self.scope_qs(qs, "id_magazin_iz")
+
+
+class InventarizaciyaListView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, SortSearchListMixin, ListView):
+    permission_required = "core.view_inventarizaciya"
+    model = Inventarizaciya
+    template_name = "ui/inventarizaciya_list.html"
+    paginate_by = 20
+    allowed_sort = ("id", "data", "status")
+
+    def apply_search(self, qs, q: str):
+        return qs.filter(Q(id_magazin__nazvanie__icontains=q) | Q(status__icontains=q))
+
+    def get_queryset(self):
+        qs = super().get_queryset().select_related("id_magazin").annotate(items_cnt=Count("inventarizaciyaitem"))
+        return self.scope_qs(qs, "id_magazin")
+
+
+class InventarizaciyaCreateView(LoginRequiredMixin, PermissionRequiredMixin, TemplateView):
+    permission_required = "core.add_inventarizaciya"
+    template_name = "ui/inventarizaciya_form.html"
+
+    def get(self, request, *args, **kwargs):
+        return self.render_to_response({
+            "form": InventarizaciyaForm(user=request.user),
+            "upload": InventarizaciyaUploadForm(),
+            "title": "Новая инвентаризация",
+        })
+
+    @transaction.atomic
+    def post(self, request, *args, **kwargs):
+        form = InventarizaciyaForm(request.POST, user=request.user)
+        upload = InventarizaciyaUploadForm(request.POST, request.FILES)
+
+        if form.is_valid() and upload.is_valid():
+            inv = form.save(commit=False)
+            inv.created_by = request.user
+            inv.save()
+            n = load_inventarizaciya_items(inv, upload.cleaned_data["fail"])
+            if n:
+                messages.success(request, f"Загружено строк пересчёта: {n}")
+            return redirect("inventarizaciya_detail", pk=inv.pk)
+
+        return self.render_to_response({"form": form, "upload": upload, "title": "Новая инвентаризация"})
+
+
+class InventarizaciyaDetailView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, TemplateView):
+    """Расхождения пересчёта с учётом + догрузка строк из CSV (пока черновик)."""
+    permission_required = "core.view_inventarizaciya"
+    template_name = "ui/inventarizaciya_detail.html"
+
+    def get_object(self):
+        qs = self.scope_qs(Inventarizaciya.objects.select_related("id_magazin"), "id_magazin")
+        return get_object_or_404(qs, pk=self.kwargs["pk"])
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        inv = kwargs.get("obj") or self.get_object()
+        show_all = self.request.GET.get("all") == "1"
+        rows = inventarizaciya_variance(inv)
+        ctx.update({
+            "obj": inv,
+            "show_all": show_all,
+            "rows": rows if show_all else [r for r in rows if r["diff"]],
+            "lines_cnt": len(rows),
+            "diff_cnt": sum(1 for r in rows if r["diff"]),
+            "surplus": sum(r["diff"] for r in rows if r["diff"] > 0),
+            "shortage": sum(-r["diff"] for r in rows if r["diff"] < 0),
+            "upload": kwargs.get("upload") or InventarizaciyaUploadForm(),
+        })
+        return ctx
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.has_perm("core.change_inventarizaciya"):
+            raise PermissionDenied
+        inv = self.get_object()
+        upload = InventarizaciyaUploadForm(request.POST, request.FILES)
+        if not upload.is_valid():
+            return self.render_to_response(self.get_context_data(obj=inv, upload=upload))
+        try:
+            n = load_inventarizaciya_items(inv, upload.cleaned_data["fail"])
+            messages.success(request, f"Загружено строк пересчёта: {n}")
+        except InventarizaciyaError as e:
+            messages.error(request, str(e))
+        return redirect("inventarizaciya_detail", pk=inv.pk)
+
+
+class InventarizaciyaPostView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, View):
+    permission_required = "core.post_inventarizaciya"
+
+    def post(self, request, pk: int):
+        qs = self.scope_qs(Inventarizaciya.objects.all(), "id_magazin")
+        inv = get_object_or_404(qs, pk=pk)
+        try:
+            changed = post_inventarizaciya(inv)
+            messages.success(request, f"Инвентаризация #{pk} проведена, исправлено остатков: {changed}")
+        except InventarizaciyaError as e:
+            messages.error(request, str(e))
+        return redirect("inventarizaciya_detail", pk=pk)
+
+
+class InventarizaciyaDeleteView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, DeleteView):
+    permission_required = "core.delete_inventarizaciya"
+    model = Inventarizaciya
+    template_name = "ui/confirm_delete.html"
+    success_url = reverse_lazy("inventarizaciya_list")
+
+    def get_queryset(self):
+        qs = super().get_queryset().filter(status=Inventarizaciya.Status.DRAFT)
+        return self.scope_qs(qs, "id_magazin")
+
+
 class MagazinTovarListView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, SortSearchListMixin, ListView):
     permission_required = "core.view_magazintovar"
     model = MagazinTovar
@@ -280,6 +643,188 @@ class MagazinTovarListView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByM
         qs = self.scope_qs(qs, "id_magazin")
         return qs
 
+class MagazinTovarMinView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, UpdateView):
+    permission_required = "core.change_magazintovar"
+    model = MagazinTovar
+    form_class = MagazinTovarMinForm
+    template_name = "ui/form.html"
+    success_url = reverse_lazy("magazintovar_list")
+
+    def get_queryset(self):
+        return self.scope_qs(super().get_queryset(), "id_magazin")
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        ctx["title"] = f"Неснижаемый остаток: {self.object.id_tovar} — {self.object.id_magazin}"
+        return ctx
+
+    @transaction.atomic
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        # минимум изменился — журнал «низких остатков» по позиции пересчитывается сразу
+        refresh_stock_alerts([(self.object.id_magazin_id, self.object.id_tovar_id)])
+        return response
+
+
+class LowStockView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, SortSearchListMixin, ListView):
+    """Позиции ниже неснижаемого остатка — выборка идёт по частичному индексу magazin_tovar_low_idx."""
+    permission_required = "core.view_magazintovar"
+    model = MagazinTovar
+    template_name = "ui/low_stock.html"
+    paginate_by = 30
+    allowed_sort = ("deficit", "id_magazin__nazvanie", "id_tovar__nazvanie", "since")
+    default_sort = "deficit"
+    default_dir = "desc"
+
+    def apply_search(self, qs, q: str):
+        return qs.filter(Q(id_tovar__nazvanie__icontains=q) | Q(id_magazin__nazvanie__icontains=q))
+
+    def get_queryset(self):
+        opened = (StockAlert.objects
+                  .filter(id_magazin=OuterRef("id_magazin"), id_tovar=OuterRef("id_tovar"), closed_at__isnull=True)
+                  .values("opened_at")[:1])
+        # условие совпадает с условием частичного индекса — планировщик берёт его
+        self.queryset = (MagazinTovar.objects
+                         .filter(kolichestvo__lt=F("min_kolichestvo"))
+                         .select_related("id_magazin", "id_tovar")
+                         .annotate(deficit=F("min_kolichestvo") - F("kolichestvo"), since=Subquery(opened)))
+        return self.scope_qs(super().get_queryset(), "id_magazin")
+
+
+class StockAsOfView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, TemplateView):
+    """
+    Остатки на конец выбранного дня: по магазину (?magazin=ID, 0 — центральный склад)
+    или по товару во всех доступных магазинах (?tovar=ID).
+    Считается по дневному срезу + движениям журнала после него.
+    """
+    permission_required = "core.view_magazintovar"
+    template_name = "ui/stock_as_of.html"
+    as_json = False
+
+    def _int_param(self, name):
+        raw = (self.request.GET.get(name) or "").strip()
+        try:
+            return int(raw) if raw else None
+        except ValueError:
+            return None
+
+    def _params(self):
+        try:
+            d = date.fromisoformat((self.request.GET.get("data") or "").strip())
+        except ValueError:
+            d = date.today()
+
+        mid = self.get_magazin_id()
+        if mid is None:
+            # владелец сети: 0 / пусто — центральный склад
+            magazin_id = self._int_param("magazin") or None
+        else:
+            magazin_id = mid
+        return d, mid, magazin_id, self._int_param("tovar")
+
+    def _rows(self, d, mid, magazin_id, tovar_id):
+        if mid == 0:
+            return []  # магазин не назначен
+
+        if tovar_id:
+            stock = tovar_stock_as_of(d, tovar_id, None if mid is None else [mid])
+            tovar = Tovar.objects.filter(pk=tovar_id).first()
+            names = Magazin.objects.in_bulk([k for k in stock if k is not None])
+            rows = [
+                {
+                    "magazin_id": k,
+                    "magazin": str(names[k]) if k is not None else "Центральный склад",
+                    "tovar_id": tovar_id,
+                    "tovar": str(tovar) if tovar else "",
+                    "kolichestvo": qty,
+                }
+                for k, qty in stock.items()
+            ]
+        else:
+            stock = stock_as_of(d, magazin_id)
+            names = Tovar.objects.in_bulk(list(stock))
+            magazin = Magazin.objects.filter(pk=magazin_id).first() if magazin_id else None
+            rows = [
+                {
+                    "magazin_id": magazin_id,
+                    "magazin": str(magazin) if magazin else "Центральный склад",
+                    "tovar_id": k,
+                    "tovar": str(names[k]),
+                    "kolichestvo": qty,
+                }
+                for k, qty in stock.items()
+            ]
+        rows.sort(key=lambda r: (r["magazin"], r["tovar"]))
+        return rows
+
+    def get(self, request, *args, **kwargs):
+        if not self.as_json:
+            return super().get(request, *args, **kwargs)
+        d, mid, magazin_id, tovar_id = self._params()
+        return JsonResponse({
+            "data": d.isoformat(),
+            "magazin": magazin_id,
+            "tovar": tovar_id,
+            "rows": self._rows(d, mid, magazin_id, tovar_id),
+        })
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        d, mid, magazin_id, tovar_id = self._params()
+        ctx.update({
+            "data": d,
+            "is_owner": mid is None,
+            "selected_magazin": magazin_id or 0,
+            "selected_tovar": tovar_id or 0,
+            "magazins": Magazin.objects.order_by("nazvanie") if mid is None else [],
+            "tovary": Tovar.objects.order_by("nazvanie"),
+            "rows": self._rows(d, mid, magazin_id, tovar_id),
+        })
+        return ctx
+
+
+class StockAvailabilityView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, View):
+    """
+    Текущие остатки для касс и формы выручки — из кэша в памяти процесса (core/stock_cache.py).
+    ?magazin=M&tovar=T1,T2,... — товары одного магазина; ?pairs=M:T,M:T,... — произвольные пары.
+    Сотрудник магазина получает остатки только своего магазина.
+    """
+    permission_required = ("core.view_magazintovar", "core.add_vyruchka")
+    max_pairs = 1000
+
+    def has_permission(self):
+        # достаточно любого из прав: склад магазина или продажи
+        return any(self.request.user.has_perm(p) for p in self.get_permission_required())
+
+    def _pairs(self):
+        g = self.request.GET
+        try:
+            if g.get("pairs"):
+                return [tuple(int(x) for x in p.split(":", 1)) for p in g["pairs"].split(",") if p.strip()]
+            magazin = int(g.get("magazin") or self.get_magazin_id() or 0)
+            if not magazin:
+                return None
+            return [(magazin, int(t)) for t in (g.get("tovar") or "").split(",") if t.strip()]
+        except ValueError:
+            return None
+
+    def get(self, request, *args, **kwargs):
+        pairs = self._pairs()
+        if not pairs or len(pairs) > self.max_pairs or any(len(p) != 2 for p in pairs):
+            return JsonResponse({"error": "Укажите magazin и tovar или pairs"}, status=400)
+        mid = self.get_magazin_id()
+        if mid is not None and any(m != mid for m, _ in pairs):
+            return JsonResponse({"error": "Нет доступа к остаткам другого магазина"}, status=403)
+
+        qty, source = stock_lookup(pairs)
+        cache = get_stock_cache()
+        return JsonResponse({
+            "version": cache.version if cache is not None else None,
+            "source": source,
+            "items": [{"magazin": m, "tovar": t, "kolichestvo": q} for (m, t), q in zip(pairs, qty)],
+        })
+
+
 class SpravochnikHomeView(LoginRequiredMixin, TemplateView):
     template_name = "ui/spravochnik_home.html"
 
@@ -340,6 +885,14 @@ class TovarListView(LoginRequiredMixin, PermissionRequiredMixin, SortSearchListM
             | Q(id_edinitsa_izmereniya__nazvanie__icontains=q)
         )
 
+    def get_queryset(self):
+        # остаток с учётом под-счётчиков «горячих» товаров
+        qs = super().get_queryset().annotate(na_sklade=central_stock_expr())
+        sort, direction = self.get_sort()
+        if sort == "kolichestvo_na_sklade":
+            qs = qs.order_by(F("na_sklade").desc() if direction == "desc" else F("na_sklade").asc())
+        return qs
+
 class TovarCreateView(LoginRequiredMixin, PermissionRequiredMixin, CreateView):
     permission_required = "core.add_tovar"
     model = Tovar
@@ -386,6 +939,14 @@ class PostavkaCreateView(LoginRequiredMixin, PermissionRequiredMixin, CreateView
         ctx = super().get_context_data(**kwargs)
         ctx["title"] = "Добавить поставку"
         return ctx
+
+    # остатки центрального склада меняют триггеры postavka — запись повторяется при 40P01/40001
+    @retry_on_conflict("postavka_create")
+    def form_valid(self, form):
+        # при повторе транзакции pk остался от откатанной попытки
+        form.instance.pk = None
+        return super().form_valid(form)
+
 class PostavkaUpdateView(LoginRequiredMixin, PermissionRequiredMixin, UpdateView):
     permission_required = "core.change_postavka"
     model = Postavka
@@ -393,12 +954,56 @@ class PostavkaUpdateView(LoginRequiredMixin, PermissionRequiredMixin, UpdateView
     template_name = "ui/form.html"
     success_url = reverse_lazy("postavka_list")
 
+    @retry_on_conflict("postavka_update")
+    def form_valid(self, form):
+        return super().form_valid(form)
+
 class PostavkaDeleteView(LoginRequiredMixin, PermissionRequiredMixin, DeleteView):
     permission_required = "core.delete_postavka"
     model = Postavka
     template_name = "ui/confirm_delete.html"
     success_url = reverse_lazy("postavka_list")
 
+    @retry_on_conflict("postavka_delete")
+    def form_valid(self, form):
+        return super().form_valid(form)
+
+
+class PurchasePlanView(LoginRequiredMixin, PermissionRequiredMixin, TemplateView):
+    """
+    План закупок по поставщикам: потребность незакрытых заявок минус остаток
+    центрального склада. ?rule=recent|frequent — выбор поставщика, ?format=csv — выгрузка.
+    """
+    permission_required = "core.add_postavka"
+    template_name = "ui/purchase_plan.html"
+
+    def get_rule(self):
+        rule = (self.request.GET.get("rule") or "recent").strip()
+        return rule if rule in ("recent", "frequent") else "recent"
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get("format") == "csv":
+            return self.render_csv(purchase_plan(self.get_rule()))
+        return super().get(request, *args, **kwargs)
+
+    def render_csv(self, plan):
+        resp = HttpResponse(content_type="text/csv; charset=utf-8")
+        resp["Content-Disposition"] = f'attachment; filename="purchase_plan_{self.get_rule()}.csv"'
+        w = csv.writer(resp)
+        w.writerow(["supplier_id", "supplier", "tovar_id", "tovar", "demand", "stock", "qty"])
+        for g in plan:
+            for it in g["items"]:
+                w.writerow([g["postavshchik_id"] or "", g["postavshchik"],
+                            it["tovar_id"], it["tovar"], it["demand"], it["stock"], it["qty"]])
+        return resp
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        ctx["rule"] = self.get_rule()
+        ctx["plan"] = purchase_plan(ctx["rule"])
+        ctx["total"] = sum(g["total"] for g in ctx["plan"])
+        return ctx
+
 
 # ===== Выручка =====
 class VyruchkaListView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, SortSearchListMixin, ListView):
@@ -407,6 +1012,7 @@ class VyruchkaListView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagaz
     template_name = "ui/vyruchka_list.html"
     paginate_by = 20
     allowed_sort = ("id", "data", "qty", "amount")
+    preview_size = 3    # строк чека в превью (шаблон показывает «ещё N» сверх них)
 
     def apply_search(self, qs, q: str):
         return qs.filter(
@@ -422,16 +1028,13 @@ class VyruchkaListView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagaz
             .get_queryset()
             .select_related("id_magazin", "id_rabotnik")
             .prefetch_related(
-                Prefetch(
+                preview_prefetch(
                     "tovarvyruchka_set",
-                    queryset=TovarVyruchka.objects.select_related("id_tovar").order_by("id"),
+                    TovarVyruchka.objects.select_related("id_tovar").order_by("id"),
+                    self.preview_size,
+                    to_attr="preview_items",
                 )
             )
-            .annotate(
-                qty=Coalesce(Sum("tovarvyruchka__kolichestvo"), 0),
-                amount=Coalesce(Sum("tovarvyruchka__summa"), Decimal("0")),
-                items_cnt=Coalesce(Count("tovarvyruchka", distinct=True), 0),
-            )
         )
 
 
@@ -456,8 +1059,30 @@ class VyruchkaCreateView(LoginRequiredMixin, PermissionRequiredMixin, TemplateVi
         formset = VyruchkaItemsFormSet()
         return self.render_to_response({"form": form, "formset": formset, "title": "Добавить выручку"})
 
-    @transaction.atomic
     def post(self, request, *args, **kwargs):
+        if getattr(settings, "VYRUCHKA_GROUP_COMMIT", {}).get("ENABLED"):
+            return self.post_grouped(request)
+        return self.post_single(request)
+
+    def post_grouped(self, request):
+        """Чек проводится вместе с чеками соседних запросов одной транзакцией."""
+        form = VyruchkaForm(request.POST, user=request.user)
+        formset = VyruchkaItemsFormSet(request.POST)
+
+        if form.is_valid() and formset.is_valid():
+            vyr = form.save(commit=False)
+            items = formset.save(commit=False)
+            _price_vyruchka_items(items)
+
+            error = get_sales_writer().submit(vyr, items)
+            if error is None:
+                return redirect("vyruchka_list")
+            messages.error(request, str(error))
+
+        return self.render_to_response({"form": form, "formset": formset, "title": "Добавить выручку"})
+
+    @retry_on_conflict("vyruchka_create")
+    def post_single(self, request):
         form = VyruchkaForm(request.POST, user=request.user)
         formset = VyruchkaItemsFormSet(request.POST)
 
@@ -466,24 +1091,13 @@ class VyruchkaCreateView(LoginRequiredMixin, PermissionRequiredMixin, TemplateVi
             vyr.save()
             new_map = _qty_map_from_formset(formset)
             try:
-                apply_vyruchka_stock(vyr.id_magazin_id, new_map)
+                apply_vyruchka_stock(vyr.id_magazin_id, new_map, doc_id=vyr.pk)
             except StockError as e:
                 transaction.set_rollback(True)
                 messages.error(request, str(e))
                 return self.render_to_response({"form": form, "formset": formset, "title": "Добавить выручку"})
-            
-            items = formset.save(commit=False)
-            for it in items:
-                if it.cena_prodazhi is None:
-                    it.cena_prodazhi = it.id_tovar.cena_prodazhi or Decimal("0")
-                qty = it.kolichestvo or 0
-                it.summa = (it.cena_prodazhi or Decimal("0")) * Decimal(qty)
-                it.id_vyruchka = vyr
-                it.save()
-
-            for obj in formset.deleted_objects:
-                obj.delete()
 
+            _save_vyruchka_items(vyr, formset)
             return redirect("vyruchka_list")
 
         return self.render_to_response({"form": form, "formset": formset, "title": "Добавить выручку"})
@@ -491,6 +1105,7 @@ class VyruchkaCreateView(LoginRequiredMixin, PermissionRequiredMixin, TemplateVi
 VyruchkaItemsFormSet = inlineformset_factory(
     Vyruchka, TovarVyruchka,
     form=TovarVyruchkaForm,
+    formset=BaseVyruchkaItemFormSet,
     extra=1,
     can_delete=True
 )
@@ -508,69 +1123,43 @@ class VyruchkaUpdateView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMag
         formset = VyruchkaItemsFormSet(instance=vyr)
         return self.render_to_response({"form": form, "formset": formset, "title": "Редактировать выручку"})
 
-    @transaction.atomic
+    @retry_on_conflict("vyruchka_update")
     def post(self, request, *args, **kwargs):
         vyr = self.get_object()
         form = VyruchkaForm(request.POST, instance=vyr, user=request.user)
         formset = VyruchkaItemsFormSet(request.POST, instance=vyr)
 
-        if form.is_valid() and formset.is_valid():
-            old_map = {}
-            for it in TovarVyruchka.objects.filter(id_vyruchka=vyr).only("id_tovar_id", "kolichestvo"):
-                tid = int(it.id_tovar_id)
-                old_map[tid] = old_map.get(tid, 0) + int(it.kolichestvo or 0)
+        # старые строки берём из queryset formset'а (он всё равно его загружает) —
+        # до is_valid(), который перезапишет эти объекты данными формы
+        old_map = {}
+        for it in formset.get_queryset():
+            tid = int(it.id_tovar_id)
+            old_map[tid] = old_map.get(tid, 0) + int(it.kolichestvo or 0)
 
+        if form.is_valid() and formset.is_valid():
             new_map = _qty_map_from_formset(formset)
 
 
+            # > 0 — продано больше прежнего (списать), < 0 — меньше (вернуть на склад)
             delta = {}
             for tid in set(old_map) | set(new_map):
-                delta[tid] = old_map.get(tid, 0) - new_map.get(tid, 0)
+                delta[tid] = new_map.get(tid, 0) - old_map.get(tid, 0)
 
             try:
-                apply_vyruchka_stock(vyr.id_magazin_id, delta)
+                apply_vyruchka_stock(vyr.id_magazin_id, delta, doc_id=vyr.pk)
             except StockError as e:
                 transaction.set_rollback(True)
                 messages.error(request, str(e))
                 return self.render_to_response({"form": form, "formset": formset, "title": "Редактировать выручку"})
 
             vyr = form.save()
-
-            items = formset.save(commit=False)
-            for it in items:
-                if it.cena_prodazhi is None:
-                    it.cena_prodazhi = it.id_tovar.cena_prodazhi or Decimal("0")
-                qty = it.kolichestvo or 0
-                it.summa = (it.cena_prodazhi or Decimal("0")) * Decimal(qty)
-                it.save()
-
-            for obj in formset.deleted_objects:
-                obj.delete()
-
+            _save_vyruchka_items(vyr, formset)
             return redirect("vyruchka_list")
 
         return self.render_to_response({"form": form, "formset": formset, "title": "Редактировать выручку"})
 
 
 class VyruchkaDeleteView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, DeleteView):
-    @transaction.atomic
-    def delete(self, request, *args, **kwargs):
-        obj = self.get_object()
-
-        # вернуть товары на склад магазина
-        back = {}
-        for it in TovarVyruchka.objects.filter(id_vyruchka=obj).only("id_tovar_id", "kolichestvo"):
-            tid = int(it.id_tovar_id)
-            back[tid] = back.get(tid, 0) - int(it.kolichestvo or 0) 
-
-        try:
-            apply_vyruchka_stock(obj.id_magazin_id, back)
-        except StockError as e:
-            transaction.set_rollback(True)
-            messages.error(request, str(e))
-            return redirect("vyruchka_list")
-
-        return super().delete(request, *args, **kwargs)
     permission_required = "core.delete_vyruchka"
     model = Vyruchka
     template_name = "ui/confirm_delete.html"
@@ -580,6 +1169,83 @@ class VyruchkaDeleteView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMag
         qs = super().get_queryset()
         return self.scope_qs(qs, "id_magazin")
 
+    # с Django 4 DeleteView.post вызывает form_valid, а не delete()
+    def form_valid(self, form):
+        try:
+            self.delete_with_stock()
+        except StockError as e:
+            messages.error(self.request, str(e))
+            return redirect("vyruchka_list")
+        return redirect(self.get_success_url())
+
+    @retry_on_conflict("vyruchka_delete")
+    def delete_with_stock(self):
+        obj = get_object_or_404(Vyruchka.objects.select_for_update(), pk=self.object.pk, data=self.object.data)
+
+        lines = TovarVyruchka.objects.filter(id_vyruchka=obj, data=obj.data)
+
+        # вернуть товары на склад магазина
+        back = {}
+        for tid, qty in lines.values_list("id_tovar_id", "kolichestvo"):
+            back[tid] = back.get(tid, 0) - int(qty or 0)
+        apply_vyruchka_stock(obj.id_magazin_id, back, doc_id=obj.pk)
+
+        # строки и связи с работниками ссылаются на чек с PROTECT — удаляются первыми
+        lines.delete()
+        RabotnikVyruchka.objects.filter(id_vyruchka=obj).delete()
+        obj.delete()
+
+
+class VyruchkaImportView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinMixin, TemplateView):
+    """
+    Массовая загрузка чеков из выгрузки касс (services.import_vyruchka).
+    as_json=True — ответ в JSON (VyruchkaImportApiView).
+    """
+    permission_required = "core.add_vyruchka"
+    template_name = "ui/vyruchka_import.html"
+    as_json = False
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        ctx.setdefault("form", VyruchkaImportForm())
+        return ctx
+
+    def post(self, request, *args, **kwargs):
+        form = VyruchkaImportForm(request.POST, request.FILES)
+        mid = self.get_magazin_id()
+        result, errors = None, []
+        if mid == 0:
+            errors = ["Пользователю не назначен магазин"]
+        elif form.is_valid():
+            try:
+                result = import_vyruchka(form.cleaned_data["fail"], fmt=form.cleaned_data["fmt"], magazin_id=mid)
+            except VyruchkaImportError as e:
+                errors = [str(e)] + e.errors
+        else:
+            errors = [f"{field}: {msg}" for field, msgs in form.errors.items() for msg in msgs]
+
+        if self.as_json:
+            if result is None:
+                return JsonResponse({"errors": errors}, status=400)
+            return JsonResponse(result)
+        if result is not None:
+            messages.success(
+                request,
+                f"Загружено чеков: {result['receipts']}, позиций: {result['lines']}, магазинов: {result['magazins']}"
+                + (f"; пропущено загруженных ранее: {result['duplicates']}" if result["duplicates"] else ""),
+            )
+        return self.render_to_response(self.get_context_data(form=form, result=result, errors=errors))
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class VyruchkaImportApiView(ApiTokenAuthMixin, VyruchkaImportView):
+    """
+    Приём выгрузки от кассовых систем: POST multipart (fail, fmt) с ключом API
+    вместо сессии. Повтор того же файла безопасен — загруженные чеки пропускаются.
+    """
+    http_method_names = ["post"]
+    as_json = True
+
 
 def col(field, label, align="left"):
     return {"field": field, "label": label, "align": align}
@@ -1447,8 +2113,9 @@ class AnalyticsView(LoginRequiredMixin, PermissionRequiredMixin, ScopeByMagazinM
         return Coalesce(F("summa"), calc, Decimal("0"))
 
     def _base_tvv(self, from_d, to_d):
+        # дата и у строки (отсечение секций tovar_vyruchka), и у чека (секций vyruchka)
         qs = TovarVyruchka.objects.filter(
-            id_vyruchka__data__isnull=False,
+            data__range=(from_d, to_d),
             id_vyruchka__data__range=(from_d, to_d),
             id_vyruchka__id_magazin__isnull=False,
         )
@@ -1577,7 +2244,7 @@ def _is_network_owner(user) -> bool:
 
 def _scoped_tvv(request, from_d, to_d):
     tvv = TovarVyruchka.objects.filter(
-        id_vyruchka__data__isnull=False,
+        data__range=(from_d, to_d),
         id_vyruchka__data__range=(from_d, to_d),
         id_vyruchka__id_magazin__isnull=False,
     )
@@ -1747,6 +2414,110 @@ class SqlConsoleView(LoginRequiredMixin, TemplateView):
 
 
 
+class MetricsView(LoginRequiredMixin, OwnerOnlyMixin, View):
+    """Метрики процесса (core/metrics.py) в JSON: повторы транзакций, замеры блокировок."""
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse({
+            "counters": metrics.snapshot(),
+            "histograms": metrics.histograms(),
+            "hot": {table: metrics.hot_top(f"hot:{table}", 50) for table in LockMonitorView.HOT_TABLES},
+        })
+
+
+class LockMonitorView(LoginRequiredMixin, OwnerOnlyMixin, TemplateView):
+    """
+    Блокировки складских строк: замеры этого процесса (ожидание/удержание по сервисам,
+    самые «горячие» строки) и живая картина по серверу — кто кого ждёт (pg_stat_activity).
+    """
+    template_name = "ui/lock_monitor.html"
+    HOT_TABLES = ("magazin_tovar", "tovar")
+    WATCH_TABLES = ("magazin_tovar", "tovar", "tovar_stripe", "stock_movement", "vyruchka", "tovar_vyruchka")
+
+    def _services(self):
+        h = metrics.histograms()
+        locked = metrics.snapshot().get("locked_rows", {})
+        retries = metrics.snapshot().get("tx_retry", {})
+        names = sorted(set().union(*(h.get(n, {}) for n in ("tx_seconds", "lock_wait_seconds"))))
+
+        def ms(hist, name):
+            x = h.get(hist, {}).get(name)
+            if x is None:
+                return None
+            return {"count": x["count"], **{k: x[k] * 1000 for k in ("avg", "p50", "p95", "max")}}
+
+        return [{
+            "name": name,
+            "tx": ms("tx_seconds", name),
+            "wait": ms("lock_wait_seconds", name),
+            "hold": ms("lock_hold_seconds", name),
+            "rows": locked.get(name, 0),
+            "retries": retries.get(name, 0),
+        } for name in names]
+
+    def _hot_rows(self):
+        top = {table: metrics.hot_top(f"hot:{table}", 20) for table in self.HOT_TABLES}
+        keys = [key for rows in top.values() for key, _ in rows]
+        tovary = Tovar.objects.in_bulk({tid for _, tid in keys})
+        magaziny = Magazin.objects.in_bulk({mid for mid, _ in keys if mid})
+        return [{
+            "table": table,
+            "magazin": magaziny.get(mid) if mid else "Центральный склад",
+            "tovar": tovary.get(tid, f"#{tid}"),
+            "count": n,
+        } for table, rows in top.items() for (mid, tid), n in rows]
+
+    def _blocking(self):
+        with connection.cursor() as cur:
+            cur.execute(
+                """
+                SELECT a.pid, pg_blocking_pids(a.pid), a.usename, a.state,
+                       a.wait_event_type, a.wait_event,
+                       EXTRACT(EPOCH FROM now() - a.xact_start)::numeric(10, 1),
+                       EXTRACT(EPOCH FROM now() - a.query_start)::numeric(10, 1),
+                       LEFT(a.query, 300)
+                  FROM pg_stat_activity AS a
+                 WHERE a.datname = current_database()
+                   AND (cardinality(pg_blocking_pids(a.pid)) > 0
+                        OR a.pid IN (SELECT unnest(pg_blocking_pids(b.pid)) FROM pg_stat_activity AS b))
+                 ORDER BY a.xact_start NULLS LAST
+                """
+            )
+            cols = ["pid", "blocked_by", "user", "state", "wait_type", "wait_event", "xact_sec", "query_sec", "query"]
+            chain = [dict(zip(cols, row)) for row in cur.fetchall()]
+
+            cur.execute(
+                """
+                SELECT c.relname, l.mode, l.granted, COUNT(*)
+                  FROM pg_locks AS l
+                  JOIN pg_class AS c ON c.oid = l.relation
+                 WHERE l.database = (SELECT oid FROM pg_database WHERE datname = current_database())
+                   AND c.relname = ANY(%s)
+                 GROUP BY c.relname, l.mode, l.granted
+                 ORDER BY c.relname, l.granted, l.mode
+                """,
+                [list(self.WATCH_TABLES)],
+            )
+            locks = [dict(zip(["table", "mode", "granted", "cnt"], row)) for row in cur.fetchall()]
+
+        # корни цепочек — сессии, которые держат других и сами никого не ждут
+        for row in chain:
+            row["is_root"] = not row["blocked_by"]
+        return chain, locks
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        chain, locks = self._blocking()
+        ctx.update({
+            "services": self._services(),
+            "hot_rows": self._hot_rows(),
+            "chain": chain,
+            "locks": locks,
+        })
+        return ctx
+
+
+
 class UserListView(LoginRequiredMixin, OwnerOnlyMixin, ListView):
     model = User
     template_name = "ui/user_list.html"